@@ -0,0 +1,150 @@
+"""
+    %prog [options]
+
+Check the start up time of the read only wq commands.
+
+Each command is run with python -X importtime, with -h so that it exits
+once its modules are imported and its options parsed, without needing a
+server.  The import time is the sum of the cumulative times of the top
+level imports, less that of the interpreter starting up with nothing to
+run; the best of several runs is compared to the budget.
+
+It is also an error for one of these commands to import a module that only
+other commands need, such as yaml, asyncio or the server, since that is how
+start up regressions usually creep in.
+
+The exit status is 1 if any command is over budget or imports a module it
+should not.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import subprocess
+from optparse import OptionParser
+
+COMMANDS = ['ls', 'stat', 'users', 'user', 'refresh', 'metrics']
+
+# import time allowed, in milliseconds
+DEFAULT_BUDGET = 50.0
+
+# modules the read only commands must not import
+FORBIDDEN = [
+    'yaml',
+    'asyncio',
+    'logging',
+    'subprocess',
+    'wq.server',
+    'wq.launcher',
+    'wq.backends',
+]
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WQ = os.path.join(PACKAGE_DIR, 'bin', 'wq')
+
+
+def get_import_times(args):
+    """
+    run python with the arguments under -X importtime
+
+    Returns
+    -------
+    total: float
+        The total import time in milliseconds
+    modules: list
+        The names of all modules imported
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [PACKAGE_DIR] + [p for p in [env.get('PYTHONPATH')] if p]
+    )
+
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime'] + args,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        env=env,
+        universal_newlines=True,
+    )
+
+    total = 0.0
+    modules = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            # the header
+            continue
+
+        # names are indented by two spaces for each level of nesting,
+        # after a single space
+        name = fields[2].rstrip()
+        modules.append(name.strip())
+        if not name[1:].startswith(' '):
+            # top level import; the cumulative time includes its children
+            total += int(fields[1]) / 1000.0
+
+    return total, modules
+
+
+def get_best_time(args, nrun):
+    """
+    get the best import time of several runs, and the modules imported
+    """
+    best = None
+    for i in range(nrun):
+        total, modules = get_import_times(args)
+        if best is None or total < best:
+            best = total
+
+    return best, modules
+
+
+def check_command(command, budget, nrun, base):
+    """
+    check the command, printing the result.  Returns True if it passed
+    """
+    best, modules = get_best_time([WQ, command, '-h'], nrun)
+    best -= base
+
+    bad = [
+        f for f in FORBIDDEN
+        if any(mod == f or mod.startswith(f+'.') for mod in modules)
+    ]
+
+    ok = best <= budget and not bad
+    print('%-8s %7.1f ms  %s' % (command, best, 'ok' if ok else 'FAIL'))
+    if bad:
+        print('    imports %s' % ', '.join(bad))
+
+    return ok
+
+
+def main():
+    parser = OptionParser(__doc__)
+    parser.add_option('--budget', type='float', default=DEFAULT_BUDGET,
+                      help='import time allowed, ms.  Default %default')
+    parser.add_option('-n', '--nrun', type='int', default=5,
+                      help='runs per command, the best is used.  '
+                           'Default %default')
+    options, args = parser.parse_args()
+
+    commands = args if args else COMMANDS
+
+    base, modules = get_best_time(['-c', 'pass'], options.nrun)
+
+    print('budget: %.1f ms, interpreter start up: %.1f ms' % (
+        options.budget, base,
+    ))
+    ok = True
+    for command in commands:
+        if not check_command(command, options.budget, options.nrun, base):
+            ok = False
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
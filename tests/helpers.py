@@ -0,0 +1,83 @@
+"""
+Helpers shared by the tests
+"""
+import os
+import threading
+from unittest import mock
+
+from wq import liveness
+from wq.server import Server, JobQueue
+
+
+def write_cluster(dirname, lines=('localhost 4 32',)):
+    """
+    write a cluster description file, returning its name
+    """
+    fname = os.path.join(dirname, 'cluster.txt')
+    with open(fname, 'w') as fobj:
+        fobj.write('\n'.join(lines) + '\n')
+    return fname
+
+
+def start_server(dirname, **kw):
+    """
+    start a server on a free port, with its cluster and spool in the
+    directory.  The server loop runs in a daemon thread, so it goes away
+    with the tests.  The port is server.port
+    """
+    server = Server(
+        write_cluster(dirname), 0, os.path.join(dirname, 'spool'),
+        loglevel='warning', **kw
+    )
+    server.open_socket()
+    server.port = server.sock.getsockname()[1]
+
+    thread = threading.Thread(target=server._run, daemon=True)
+    thread.start()
+    return server
+
+
+def make_queue(dirname, lines=('localhost 4 32',), backend='memory'):
+    """
+    make a queue for a cluster with the given description lines, saving
+    its state with the named backend
+    """
+    return JobQueue(
+        write_cluster(dirname, lines), os.path.join(dirname, 'spool'),
+        loglevel='warning', backend=backend,
+    )
+
+
+def submit(queue, pid, user='jdoe', commandline='echo', **require):
+    """
+    submit a job with the given requirements, returning the response
+    """
+    queue.process_message({
+        'command': 'sub',
+        'pid': pid,
+        'user': user,
+        'commandline': commandline,
+        'require': require,
+    })
+    return queue.get_response()
+
+
+def request(queue, command, **kw):
+    """
+    process a request, returning the response
+    """
+    message = {'command': command}
+    message.update(kw)
+    queue.process_message(message)
+    return queue.get_response()
+
+
+def pretend_alive(test):
+    """
+    make every pid look alive for the rest of the test, so that jobs with
+    made up pids are not removed when the queue is refreshed
+    """
+    for name, value in [('get_live_pids', None), ('pid_exists', True)]:
+        patch = mock.patch.object(liveness, name, return_value=value)
+        patch.start()
+        test.addCleanup(patch.stop)
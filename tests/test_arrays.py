@@ -0,0 +1,115 @@
+"""
+Tests of jobs submitted with sub_many, arrays among them: the ids they
+are given, and how they count in the user totals
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from wq.server import FIRST_JOB_ID
+
+from helpers import make_queue, request
+
+
+class TestArrays(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _queue(self, backend='memory'):
+        return make_queue(self.tmpdir, ['node1 2 8'], backend=backend)
+
+    def _sub_many(self, queue, jobs):
+        return request(
+            queue, 'sub_many', owner=os.getpid(), user='jdoe',
+            commandline='echo %index%', require={'N': 1}, jobs=jobs,
+        )
+
+    def _total(self, queue):
+        return request(queue, 'user', user='jdoe')['response']['jdoe']['total']
+
+    def test_ids(self):
+        queue = self._queue()
+        response = self._sub_many(
+            queue, [{'array_start': 10, 'array_stop': 14}, {}],
+        )
+        array, job = response['jobs']
+
+        # the elements take the ids after the array
+        self.assertEqual(array['pid'], FIRST_JOB_ID)
+        self.assertEqual(
+            [(e['pid'], e['index']) for e in array['elements']],
+            [(FIRST_JOB_ID + 1, 10), (FIRST_JOB_ID + 2, 11)],
+        )
+        self.assertEqual(job['pid'], FIRST_JOB_ID + 6)
+        self.assertEqual(job['status'], 'wait')
+
+        response = self._sub_many(queue, [{}])
+        self.assertEqual(response['jobs'][0]['pid'], FIRST_JOB_ID + 7)
+        queue.close()
+
+    def test_user_total(self):
+        queue = self._queue()
+        response = self._sub_many(
+            queue, [{'array_start': 0, 'array_stop': 4}, {}],
+        )
+        array = response['jobs'][0]
+
+        # two elements run, three wait in the array, and one job waits
+        counts = request(queue, 'ls')['counts']
+        self.assertEqual(counts, {'njobs': 6, 'nrun': 2, 'nwait': 4})
+        self.assertEqual(self._total(queue), 6)
+
+        # the next elements start as these finish
+        request(
+            queue, 'notify_many',
+            pids=[e['pid'] for e in array['elements']],
+        )
+        counts = request(queue, 'ls')['counts']
+        self.assertEqual(counts['njobs'], 4)
+        self.assertEqual(self._total(queue), 4)
+
+        # the rest, until nothing is left
+        while True:
+            pids = [job['pid'] for job in queue.queue if 'array' in job]
+            if not pids:
+                break
+            request(queue, 'notify_many', pids=pids)
+        pids = [job['pid'] for job in queue.queue]
+        request(queue, 'notify_many', pids=pids)
+
+        self.assertEqual(len(queue.queue), 0)
+        self.assertEqual(self._total(queue), 0)
+        queue.close()
+
+    def test_ids_after_restart(self):
+        for backend in ('spool', 'sqlite'):
+            shutil.rmtree(os.path.join(self.tmpdir, 'spool'),
+                          ignore_errors=True)
+
+            queue = self._queue(backend)
+            response = self._sub_many(
+                queue, [{'array_start': 0, 'array_stop': 1}],
+            )
+            array = response['jobs'][0]
+            request(
+                queue, 'notify_many',
+                pids=[e['pid'] for e in array['elements']],
+            )
+            self.assertEqual(len(queue.queue), 0, backend)
+            queue.close()
+
+            # all the jobs are gone, but their ids are not used again
+            queue = self._queue(backend)
+            response = self._sub_many(queue, [{}])
+            self.assertEqual(
+                response['jobs'][0]['pid'], FIRST_JOB_ID + 3, backend,
+            )
+            queue.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,247 @@
+"""
+Tests of the backends that keep the state of the server
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from wq.backends import get_backend, MemoryBackend
+from wq.server import JobQueue, Users
+
+from helpers import write_cluster
+
+
+def _job(pid, user='jdoe', status='wait'):
+    return {
+        'pid': pid, 'user': user, 'status': status, 'priority': 'med',
+        'hosts': [], 'commandline': 'echo %d' % pid,
+    }
+
+
+def _users(limits):
+    users = Users()
+    users.fromdict({
+        user: {'user': user, 'limits': ulimits}
+        for user, ulimits in limits.items()
+    })
+    return users
+
+
+class BackendTests(object):
+    """
+    Tests run for each backend that saves to the spool directory
+    """
+    name = None
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+        self.backend = self._open()
+
+    def tearDown(self):
+        self.backend.close()
+        shutil.rmtree(self.spool_dir)
+
+    def _open(self):
+        return get_backend(self.name, self.spool_dir)
+
+    def _reopen(self):
+        self.backend.close()
+        self.backend = self._open()
+        return self.backend
+
+    def test_fresh(self):
+        # nothing saved, so the server falls back to older files
+        self.assertIsNone(self.backend.load_jobs())
+        self.assertIsNone(self.backend.load_users())
+        self.assertEqual(self.backend.load_nodes(), {})
+
+    def test_jobs(self):
+        backend = self.backend
+        for pid in (30, 10, 20):
+            backend.add_job(_job(pid))
+        backend.update_job(_job(10, status='run'), {'status': 'run'})
+        backend.remove_job(_job(20))
+        backend.commit()
+
+        jobs = self._reopen().load_jobs()
+
+        # in order of submission
+        self.assertEqual([job['pid'] for job in jobs], [30, 10])
+        self.assertEqual(jobs[0], _job(30))
+        self.assertEqual(jobs[1]['status'], 'run')
+
+    def test_save_jobs(self):
+        self.backend.add_job(_job(1))
+        self.backend.save_jobs([_job(3), _job(2)])
+        self.backend.add_job(_job(4))
+        self.backend.commit()
+
+        jobs = self._reopen().load_jobs()
+        self.assertEqual([job['pid'] for job in jobs], [3, 2, 4])
+
+        self.backend.save_jobs([])
+        self.backend.commit()
+        self.assertEqual(self._reopen().load_jobs(), [])
+
+    def test_users(self):
+        self.backend.save_users(
+            _users({'jdoe': {'Njobs': 3}, 'ann': {'Ncores': 10}})
+        )
+        self.backend.commit()
+        self.assertEqual(
+            self._reopen().load_users(),
+            {
+                'jdoe': {'user': 'jdoe', 'limits': {'Njobs': 3}},
+                'ann': {'user': 'ann', 'limits': {'Ncores': 10}},
+            },
+        )
+
+        # users no longer in the limits don't come back
+        self.backend.save_users(_users({'ann': {'Ncores': 10}}))
+        self.backend.commit()
+        self.assertEqual(list(self._reopen().load_users()), ['ann'])
+
+        self.backend.save_users(_users({}))
+        self.backend.commit()
+        self.assertEqual(self._reopen().load_users(), {})
+
+    def test_nodes(self):
+        self.backend.save_node('node1', False)
+        self.backend.save_node('node2', False)
+        self.backend.save_node('node2', True)
+        self.backend.commit()
+
+        self.assertEqual(
+            self._reopen().load_nodes(), {'node1': False, 'node2': True},
+        )
+
+    def test_next_id(self):
+        self.assertIsNone(self.backend.load_next_id())
+
+        self.backend.save_next_id(100)
+        self.backend.save_next_id(105)
+        self.backend.commit()
+        self.assertEqual(self._reopen().load_next_id(), 105)
+
+
+class TestSpoolBackend(BackendTests, unittest.TestCase):
+    name = 'spool'
+
+
+class TestSQLiteBackend(BackendTests, unittest.TestCase):
+    name = 'sqlite'
+
+    def test_durability(self):
+        # with 'always' each change is committed right away
+        self.backend.close()
+        self.backend = get_backend(
+            'sqlite', self.spool_dir, durability='always',
+        )
+        self.backend.add_job(_job(1))
+
+        other = get_backend('sqlite', self.spool_dir)
+        try:
+            self.assertEqual([job['pid'] for job in other.load_jobs()], [1])
+        finally:
+            other.close()
+
+
+class TestMemoryBackend(unittest.TestCase):
+    def test_state(self):
+        backend = MemoryBackend()
+        self.assertIsNone(backend.load_jobs())
+        self.assertIsNone(backend.load_users())
+
+        backend.add_job(_job(2))
+        backend.add_job(_job(1))
+        backend.update_job(_job(1), {'status': 'run'})
+        self.assertEqual(
+            [(job['pid'], job['status']) for job in backend.load_jobs()],
+            [(2, 'wait'), (1, 'run')],
+        )
+
+        backend.remove_job(_job(2))
+        self.assertEqual([job['pid'] for job in backend.load_jobs()], [1])
+
+        backend.save_users(_users({'jdoe': {'Njobs': 1}}))
+        self.assertEqual(list(backend.load_users()), ['jdoe'])
+
+        self.assertIsNone(backend.load_next_id())
+        backend.save_next_id(7)
+        self.assertEqual(backend.load_next_id(), 7)
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            get_backend('nosuch', '/nonexistent')
+
+
+class TestQueueBackends(unittest.TestCase):
+    """
+    the queue is recovered from each backend after a restart
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cluster_file = write_cluster(self.tmpdir, ['node1 2 8'])
+        self.spool_dir = os.path.join(self.tmpdir, 'spool')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _queue(self, backend):
+        return JobQueue(
+            self.cluster_file, self.spool_dir, loglevel='warning',
+            backend=backend,
+        )
+
+    def _submit(self, queue, pid, **kw):
+        message = {
+            'command': 'sub', 'pid': pid, 'user': 'jdoe',
+            'commandline': 'echo', 'require': {'N': 1},
+        }
+        message.update(kw)
+        queue.process_message(message)
+        return queue.get_response()
+
+    def test_restart(self):
+        pid = os.getpid()
+        for backend in ('spool', 'sqlite'):
+            shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+            queue = self._queue(backend)
+            queue.process_message({
+                'command': 'limit', 'user': 'jdoe',
+                'limits': {'Njobs': 5},
+            })
+            self.assertEqual(self._submit(queue, pid)['response'], 'run')
+            queue.process_message({
+                'command': 'node', 'node': 'node1',
+                'yamline': {'status': 'offline'},
+            })
+            queue.close()
+
+            queue = self._queue(backend)
+            job = queue.queue.get(pid)
+            self.assertEqual(job['status'], 'run', backend)
+            self.assertEqual(
+                queue.users.get('jdoe')['limits'], {'Njobs': 5}, backend,
+            )
+            self.assertFalse(queue.cluster.nodes['node1'].online, backend)
+            queue.close()
+
+    def test_bad_fields(self):
+        # these would not fit the columns of the sqlite backend
+        queue = self._queue('sqlite')
+        self.assertIn('error', self._submit(queue, 'abc'))
+        self.assertIn('error', self._submit(queue, [1]))
+        self.assertIn('error', self._submit(queue, 1, user=['jdoe']))
+        self.assertEqual(len(queue.queue), 0)
+        queue.close()
+
+        queue = self._queue('sqlite')
+        self.assertEqual(queue.backend.load_jobs(), [])
+        queue.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+"""
+Tests of the generation of the queue, the replies kept for each
+generation, and the snapshots read only commands are answered from
+"""
+import shutil
+import tempfile
+import unittest
+
+from wq.protocol import ENC_JSON, decode, encode
+from wq.server import NOT_MODIFIED
+
+from helpers import make_queue, submit, request, pretend_alive
+
+
+class TestGeneration(unittest.TestCase):
+    def setUp(self):
+        pretend_alive(self)
+        self.tmpdir = tempfile.mkdtemp()
+        self.queue = make_queue(self.tmpdir, ['node1 2 8'])
+        submit(self.queue, 101, N=1)
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _generation(self):
+        return request(self.queue, 'stat')['generation']
+
+    def test_changes(self):
+        gen = self._generation()
+
+        # reads, and requests that change nothing
+        request(self.queue, 'ls')
+        request(self.queue, 'users')
+        request(self.queue, 'notify', pid=999, notification='done')
+        request(self.queue, 'sub', pid='abc', user='jdoe',
+                commandline='echo', require={})
+        self.assertEqual(self._generation(), gen)
+
+        for change in [
+                lambda: submit(self.queue, 102, N=1),
+                lambda: request(self.queue, 'limit', user='jdoe',
+                                limits={'Njobs': 3}),
+                lambda: request(self.queue, 'node', node='node1',
+                                yamline={'status': 'offline'}),
+                lambda: request(self.queue, 'notify', pid=101,
+                                notification='done'),
+                ]:
+            change()
+            new_gen = self._generation()
+            self.assertGreater(new_gen, gen)
+            gen = new_gen
+
+    def test_not_modified(self):
+        response = request(self.queue, 'ls')
+        gen = response['generation']
+
+        response = request(self.queue, 'ls', generation=gen)
+        self.assertEqual(response['response'], NOT_MODIFIED)
+        self.assertEqual(response['generation'], gen)
+
+        # an old generation gets the listing
+        response = request(self.queue, 'ls', generation=gen - 1)
+        self.assertEqual([r['pid'] for r in response['response']], [101])
+
+        submit(self.queue, 102, N=1)
+        response = request(self.queue, 'ls', generation=gen)
+        self.assertEqual([r['pid'] for r in response['response']],
+                         [101, 102])
+        self.assertGreater(response['generation'], gen)
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        pretend_alive(self)
+        self.tmpdir = tempfile.mkdtemp()
+        self.queue = make_queue(self.tmpdir, ['node1 2 8'])
+        for pid in (101, 102, 103):
+            submit(self.queue, pid, N=1)
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _encoded(self, **message):
+        return self.queue.get_encoded_response(message, ENC_JSON)
+
+    def test_same_as_live(self):
+        for message in [
+                {'command': 'ls'},
+                {'command': 'ls', 'user': 'jdoe', 'sort': '-pid'},
+                {'command': 'lsfull'},
+                {'command': 'stat'},
+                {'command': 'users'},
+                {'command': 'user', 'user': 'jdoe'},
+                ]:
+            body = self.queue.get_encoded_response(message, ENC_JSON)
+            live = request(self.queue, **message)
+            self.assertEqual(decode(body, ENC_JSON),
+                             decode(encode(live, ENC_JSON), ENC_JSON),
+                             message)
+
+    def test_cached(self):
+        body = self._encoded(command='ls')
+        self.assertIs(self._encoded(command='ls'), body)
+
+        # the generation sent is not part of the key
+        self.assertIs(self._encoded(command='ls', generation=1), body)
+
+        reply = decode(self._encoded(command='ls', generation=_gen(body)),
+                       ENC_JSON)
+        self.assertEqual(reply['response'], NOT_MODIFIED)
+
+        # errors are not kept
+        error = self._encoded(command='ls', sort='nosuch')
+        self.assertIn('error', decode(error, ENC_JSON))
+        self.assertIsNot(self._encoded(command='ls', sort='nosuch'), error)
+
+        # a new generation, a new answer
+        submit(self.queue, 104, N=1)
+        body2 = self._encoded(command='ls')
+        self.assertIsNot(body2, body)
+        self.assertGreater(_gen(body2), _gen(body))
+
+    def test_snapshots(self):
+        queue = self.queue
+        snapshot = queue.get_snapshot()
+        self.assertIs(queue.get_snapshot(), snapshot)
+
+        # changed jobs are copied again, the others are shared; 103 runs
+        # once 101 is done
+        request(queue, 'notify', pid=101, notification='done')
+        submit(queue, 104, N=1)
+        new = queue.get_snapshot()
+        self.assertIsNot(new, snapshot)
+        self.assertEqual(list(new.jobs), [102, 103, 104])
+        self.assertIs(new.jobs[102], snapshot.jobs[102])
+        self.assertIsNot(new.jobs[103], snapshot.jobs[103])
+        for pid, job in new.jobs.items():
+            self.assertEqual(job, dict(queue.queue.get(pid)), pid)
+
+        # the old snapshot is as it was
+        self.assertEqual(list(snapshot.jobs), [101, 102, 103])
+        self.assertEqual(snapshot.jobs[103]['status'], 'wait')
+        self.assertEqual(new.jobs[103]['status'], 'run')
+
+
+def _gen(body):
+    return decode(body, ENC_JSON)['generation']
+
+
+if __name__ == '__main__':
+    unittest.main()
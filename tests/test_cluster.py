@@ -0,0 +1,199 @@
+"""
+Tests of the cluster's index of free cores, and of the group masks and
+cached eligible hosts used to match group requirements
+"""
+import random
+import shutil
+import tempfile
+import unittest
+
+from wq.server import Cluster, Requirements
+
+from helpers import write_cluster
+
+CLUSTER = [
+    'node1 4 8 gpu,fast',
+    'node2 4 16 fast',
+    'node3 2 32',
+    'node4 8 64 big',
+]
+
+
+class TestFreeIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cluster = Cluster(write_cluster(self.tmpdir, CLUSTER))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _check(self):
+        """
+        the index agrees with a scan of the nodes
+        """
+        cluster = self.cluster
+        nodes = [cluster.nodes[h] for h in sorted(cluster.nodes)]
+        online = [nd for nd in nodes if nd.online]
+
+        self.assertEqual(
+            cluster.nfree, sum(nd.ncores - nd.used for nd in online),
+        )
+        self.assertEqual(cluster.is_full(), cluster.nfree == 0)
+        self.assertEqual(
+            cluster.idle_hosts(),
+            [nd.host for nd in online if nd.used == 0],
+        )
+        for ncores in range(0, 10):
+            self.assertEqual(
+                cluster.hosts_with_free(ncores),
+                [nd.host for nd in online
+                 if nd.ncores - nd.used >= max(ncores, 1)],
+                ncores,
+            )
+
+    def test_fresh(self):
+        self.assertEqual(self.cluster.nfree, 18)
+        self.assertEqual(self.cluster.hosts_with_free(5), ['node4'])
+        self._check()
+
+    def test_reserve(self):
+        cluster = self.cluster
+        cluster.reserve(['node1', 'node1', 'node4'])
+        self.assertEqual(cluster.nfree, 15)
+        self.assertEqual(cluster.hosts_with_free(3), ['node2', 'node4'])
+        self.assertEqual(cluster.idle_hosts(), ['node2', 'node3'])
+        self._check()
+
+        cluster.unreserve(['node1', 'node4'])
+        self.assertEqual(cluster.hosts_with_free(3), ['node1', 'node2',
+                                                      'node4'])
+        self._check()
+
+    def test_full(self):
+        cluster = self.cluster
+        cluster.reserve(
+            ['node1']*4 + ['node2']*4 + ['node3']*2 + ['node4']*8
+        )
+        self.assertTrue(cluster.is_full())
+        self.assertEqual(cluster.hosts_with_free(1), [])
+        self._check()
+
+    def test_offline(self):
+        cluster = self.cluster
+        cluster.reserve(['node2'])
+
+        # offline nodes have no free cores, and keep their usage
+        cluster.set_online('node2', False)
+        cluster.set_online('node3', False)
+        self.assertEqual(cluster.nfree, 12)
+        self.assertNotIn('node3', cluster.idle_hosts())
+        self._check()
+
+        cluster.unreserve(['node2'])
+        cluster.set_online('node2', True)
+        self.assertEqual(cluster.nfree, 16)
+        self._check()
+
+    def test_free_eligible(self):
+        cluster = self.cluster
+        cluster.reserve(['node1']*3 + ['node4']*6)
+
+        eligible = cluster.get_eligible(Requirements({'min_mem': 10}))
+        self.assertEqual(eligible[0], ['node2', 'node3', 'node4'])
+        self.assertEqual(
+            cluster.get_free_eligible(eligible, 2),
+            ['node2', 'node3', 'node4'],
+        )
+        self.assertEqual(cluster.get_free_eligible(eligible, 3), ['node2'])
+        self.assertEqual(cluster.get_idle_eligible(eligible),
+                         ['node2', 'node3'])
+
+        # going through the free index rather than the eligible hosts
+        eligible = cluster.get_eligible(Requirements({}))
+        self.assertEqual(cluster.get_free_eligible(eligible, 4), ['node2'])
+
+    def test_random(self):
+        cluster = self.cluster
+        rng = random.Random(7)
+        hosts = sorted(cluster.nodes)
+        for step in range(500):
+            host = rng.choice(hosts)
+            nd = cluster.nodes[host]
+            action = rng.random()
+            if action < 0.45 and nd.used < nd.ncores:
+                cluster.reserve([host] * rng.randint(1, nd.ncores - nd.used))
+            elif action < 0.9 and nd.used > 0:
+                cluster.unreserve([host] * rng.randint(1, nd.used))
+            else:
+                cluster.set_online(host, not nd.online)
+            self._check()
+
+
+class TestGroups(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cluster = Cluster(write_cluster(self.tmpdir, CLUSTER))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _eligible(self, **reqs):
+        return self.cluster.get_eligible(Requirements(reqs))[0]
+
+    def test_masks(self):
+        cluster = self.cluster
+        self.assertEqual(sorted(cluster.group_bits),
+                         ['big', 'fast', 'gpu'])
+        self.assertEqual(
+            len(set(cluster.group_bits.values())), len(cluster.group_bits),
+        )
+        self.assertEqual(cluster.all_groups_mask, 0b111)
+
+        for h, nd in cluster.nodes.items():
+            self.assertEqual(nd.gmask, cluster.group_mask(nd.grps), h)
+        self.assertEqual(cluster.nodes['node3'].gmask, 0)
+
+        # groups not in the cluster are ignored
+        self.assertEqual(cluster.group_mask(['nosuch']), 0)
+        self.assertEqual(
+            cluster.group_mask(['gpu', 'nosuch']), cluster.group_bits['gpu'],
+        )
+        self.assertEqual(cluster.group_hosts['fast'], ['node1', 'node2'])
+
+    def test_eligible(self):
+        self.assertEqual(self._eligible(),
+                         ['node1', 'node2', 'node3', 'node4'])
+        self.assertEqual(self._eligible(group='fast'), ['node1', 'node2'])
+        self.assertEqual(self._eligible(group=['gpu', 'big']),
+                         ['node1', 'node4'])
+        self.assertEqual(self._eligible(not_group='fast'), ['node3', 'node4'])
+        self.assertEqual(self._eligible(group='fast', not_group='gpu'),
+                         ['node2'])
+        self.assertEqual(self._eligible(min_mem=20), ['node3', 'node4'])
+
+        # no node is in a group the cluster doesn't have
+        self.assertEqual(self._eligible(group='nosuch'), [])
+        self.assertEqual(self._eligible(not_group='nosuch'),
+                         ['node1', 'node2', 'node3', 'node4'])
+
+        hosts, hostset = self.cluster.get_eligible(
+            Requirements({}), min_cores=4,
+        )
+        self.assertEqual(hosts, ['node1', 'node2', 'node4'])
+        self.assertEqual(hostset, set(hosts))
+
+    def test_eligible_online(self):
+        # cached, until a node goes offline or online
+        self.assertEqual(self._eligible(group='fast'), ['node1', 'node2'])
+        self.cluster.set_online('node1', False)
+        self.assertEqual(self._eligible(group='fast'), ['node2'])
+        self.cluster.set_online('node1', True)
+        self.assertEqual(self._eligible(group='fast'), ['node1', 'node2'])
+
+        # but not by usage
+        self.cluster.reserve(['node2']*4)
+        self.assertEqual(self._eligible(group='fast'), ['node1', 'node2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,200 @@
+"""
+Tests of the client Connection: tagged requests and replies, and when
+requests are sent again
+"""
+import socket
+import threading
+import unittest
+
+from wq import util
+from wq.protocol import ENC_JSON, ENC_YAML, pack_frame, split_message
+
+
+class FakeServer(object):
+    """
+    A server that deals with each connection by calling one of the
+    handlers in turn, with the connection and the server.  The requests
+    read are kept, with their frames, in requests
+    """
+    def __init__(self, handlers):
+        self.handlers = list(handlers)
+        self.requests = []
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        for handler in self.handlers:
+            conn, _ = self.sock.accept()
+            self._buf = bytearray()
+            try:
+                handler(conn, self)
+            finally:
+                conn.close()
+
+    def read(self, conn):
+        """
+        read the next request, returning it and its frame, or None and
+        None if the client closed the connection
+        """
+        while True:
+            message, frame, nbytes = split_message(self._buf)
+            if frame is not None:
+                del self._buf[:nbytes]
+                self.requests.append((message, frame))
+                return message, frame
+
+            data = conn.recv(65536)
+            if not data:
+                return None, None
+            self._buf += data
+
+    def reply(self, conn, frame, reply, encoding=None):
+        if encoding is None:
+            encoding = frame['encoding']
+        conn.sendall(pack_frame(reply, encoding=encoding, tag=frame['tag']))
+
+    def close(self):
+        self.thread.join(10)
+        self.sock.close()
+
+
+def answer(conn, server):
+    """
+    answer each request with OK, echoing the command
+    """
+    while True:
+        message, frame = server.read(conn)
+        if frame is None:
+            return
+        server.reply(
+            conn, frame, {'command': message['command'], 'response': 'OK'},
+        )
+
+
+def hang_up(conn, server):
+    """
+    read a request and close the connection without answering it
+    """
+    server.read(conn)
+
+
+def reject_encoding(conn, server):
+    """
+    answer a request as a server that only supports json
+    """
+    _, frame = server.read(conn)
+    server.reply(
+        conn, frame,
+        {'error': 'unsupported encoding', 'encodings': [ENC_JSON]},
+        encoding=ENC_JSON,
+    )
+    # the client hangs up and sends it again
+    server.read(conn)
+
+
+class TestConnection(unittest.TestCase):
+    def _start(self, handlers, encoding=ENC_JSON):
+        self.server = FakeServer(handlers)
+        util._port_encodings[self.server.port] = encoding
+        self.conn = util.Connection(self.server.port, timeout=10)
+
+    def tearDown(self):
+        self.conn.close()
+        self.server.close()
+        util._port_encodings.pop(self.server.port, None)
+
+    def test_tags(self):
+        def out_of_order(conn, server):
+            _, frame1 = server.read(conn)
+            _, frame2 = server.read(conn)
+            conn.sendall(
+                pack_frame({'command': 'kill'}, encoding=ENC_JSON, tag=0)
+            )
+            server.reply(conn, frame2, {'response': 2})
+            server.reply(conn, frame1, {'response': 1})
+            server.read(conn)
+
+        self._start([out_of_order])
+
+        tag1 = self.conn.send({'command': 'ls'})
+        tag2 = self.conn.send({'command': 'stat'})
+        self.assertNotEqual(tag1, tag2)
+
+        self.assertEqual(self.conn.receive(tag2), {'response': 2})
+        self.assertEqual(self.conn.receive(tag1), {'response': 1})
+
+        # not asked for, so kept aside
+        self.assertEqual(self.conn.pushed, [{'command': 'kill'}])
+        self.assertEqual(
+            [frame['tag'] for _, frame in self.server.requests],
+            [tag1, tag2],
+        )
+
+    def test_pipeline(self):
+        self._start([answer])
+
+        commands = ['ls', 'stat', 'users']
+        replies = self.conn.pipeline(
+            [{'command': command} for command in commands]
+        )
+        self.assertEqual(
+            [reply['command'] for reply in replies], commands,
+        )
+
+        # the connection is kept
+        self.assertEqual(self.conn.request({'command': 'ls'})['command'], 'ls')
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_resend_read(self):
+        self._start([hang_up, answer])
+
+        reply = self.conn.request({'command': 'ls'})
+        self.assertEqual(reply['response'], 'OK')
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_no_resend(self):
+        # the server may have run it before the connection was lost
+        self._start([hang_up])
+
+        with self.assertRaises(EOFError):
+            self.conn.request({'command': 'sub', 'pid': 1})
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_no_retry(self):
+        self._start([hang_up])
+
+        with self.assertRaises(EOFError):
+            self.conn.request({'command': 'ls'}, retry=False)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_encoding_rejected(self):
+        # nothing was run, so even a sub is sent again, in json
+        self._start([reject_encoding, answer], encoding=ENC_YAML)
+
+        reply = self.conn.request({'command': 'sub', 'pid': 1})
+        self.assertEqual(reply['response'], 'OK')
+        self.assertEqual(self.conn.encoding, ENC_JSON)
+        self.assertEqual(util._port_encodings[self.server.port], ENC_JSON)
+
+        self.assertEqual(
+            [(message['command'], frame['encoding'])
+             for message, frame in self.server.requests],
+            [('sub', ENC_YAML), ('sub', ENC_JSON)],
+        )
+
+    def test_encoding_rejected_pipeline(self):
+        self._start([reject_encoding, answer], encoding=ENC_YAML)
+
+        replies = self.conn.pipeline([{'command': 'sub', 'pid': 1}])
+        self.assertEqual(replies[0]['response'], 'OK')
+        self.assertEqual(self.server.requests[-1][1]['encoding'], ENC_JSON)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,320 @@
+"""
+Tests of the index of the jobs in the queue, and of requests naming jobs
+that are not valid keys for it
+"""
+import itertools
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from wq.server import Job, JobIndex
+
+from helpers import make_queue, submit, request
+
+
+def _job(pid, user='jdoe', priority='med', status='wait', **config):
+    job = Job(
+        pid=pid, user=user, commandline='echo',
+        require={'priority': priority}, **config
+    )
+    job['status'] = status
+    return job
+
+
+class TestJobIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = JobIndex()
+        self.jobs = [
+            _job(5, 'ann', 'high', 'run'),
+            _job(3, 'bob', 'med'),
+            _job(9, 'ann', 'low'),
+            _job(1, 'cat', 'med', 'run'),
+            _job(7, 'bob', 'high'),
+        ]
+        for job in self.jobs:
+            self.index.add(job)
+
+    def _pids(self, jobs):
+        return [job['pid'] for job in jobs]
+
+    def test_lookup(self):
+        index = self.index
+        self.assertEqual(len(index), 5)
+        self.assertIn(9, index)
+        self.assertNotIn(2, index)
+        self.assertIs(index.get(9), self.jobs[2])
+        self.assertIsNone(index.get(2))
+
+        # in order of submission
+        self.assertEqual(self._pids(index), [5, 3, 9, 1, 7])
+
+    def test_get_jobs(self):
+        index = self.index
+        self.assertEqual(self._pids(index.get_jobs(status='wait')), [3, 9, 7])
+        self.assertEqual(
+            self._pids(index.get_jobs(priority='high', status='wait')), [7],
+        )
+        self.assertEqual(
+            sorted(self._pids(index.get_jobs(priority='med'))), [1, 3],
+        )
+        self.assertEqual(index.count(), 5)
+        self.assertEqual(index.count('run'), 2)
+        self.assertEqual(
+            index.count_by_key(),
+            {('high', 'run'): 1, ('med', 'wait'): 1, ('low', 'wait'): 1,
+             ('med', 'run'): 1, ('high', 'wait'): 1},
+        )
+
+    def test_get_user_jobs(self):
+        index = self.index
+        self.assertEqual(self._pids(index.get_user_jobs(['ann'])), [5, 9])
+        self.assertEqual(
+            self._pids(index.get_user_jobs(['bob', 'ann'])), [5, 3, 9, 7],
+        )
+        self.assertEqual(
+            self._pids(index.get_user_jobs(['ann', 'bob'], status='wait')),
+            [3, 9, 7],
+        )
+        self.assertEqual(index.get_user_jobs(['nobody']), [])
+
+    def test_select(self):
+        # the same as a scan of the queue, whichever index is used
+        choices = {
+            'pids': [None, [7, 1, 2], [9]],
+            'users': [None, ['ann'], ['bob', 'cat']],
+            'statuses': [None, ['wait'], ['run', 'wait']],
+            'priorities': [None, ['high'], ['med', 'low']],
+        }
+        names = sorted(choices)
+        for values in itertools.product(*[choices[n] for n in names]):
+            kw = dict(zip(names, values))
+            expected = [
+                job['pid'] for job in self.jobs
+                if (kw['pids'] is None or job['pid'] in kw['pids'])
+                and (kw['users'] is None or job['user'] in kw['users'])
+                and (kw['statuses'] is None
+                     or job['status'] in kw['statuses'])
+                and (kw['priorities'] is None
+                     or job['priority'] in kw['priorities'])
+            ]
+            self.assertEqual(self._pids(self.index.select(**kw)), expected,
+                             kw)
+
+    def test_reindex(self):
+        index = self.index
+        job = index.get(9)
+        job['status'] = 'run'
+        index.reindex(job)
+
+        self.assertEqual(self._pids(index.get_jobs(status='wait')), [3, 7])
+        self.assertEqual(
+            self._pids(index.get_jobs(priority='low', status='run')), [9],
+        )
+        self.assertEqual(self._pids(index.select(statuses=['run'])),
+                         [5, 9, 1])
+
+    def test_remove(self):
+        index = self.index
+        self.assertIs(index.remove(9), self.jobs[2])
+        self.assertIsNone(index.remove(9))
+
+        self.assertNotIn(9, index)
+        self.assertEqual(self._pids(index.get_user_jobs(['ann'])), [5])
+        self.assertEqual(index.count_by_key().get(('low', 'wait')), None)
+
+        # the last of a user's jobs
+        index.remove(1)
+        self.assertEqual(index.get_user_jobs(['cat']), [])
+        self.assertFalse(index.has_proc(1))
+
+    def test_replace(self):
+        index = self.index
+        job = _job(3, 'cat', 'low', 'run')
+        index.add(job)
+
+        self.assertIs(index.get(3), job)
+        self.assertEqual(len(index), 5)
+        self.assertEqual(self._pids(index.get_user_jobs(['bob'])), [7])
+        self.assertEqual(self._pids(index.get_user_jobs(['cat'])), [1, 3])
+
+        # now the last submitted
+        self.assertEqual(self._pids(index), [5, 9, 1, 7, 3])
+
+    def test_procs_and_arrays(self):
+        index = self.index
+        owner = 100
+        elements = [
+            _job(20 + i, owner=owner, array=20, index=i, status='run')
+            for i in range(3)
+        ]
+        for job in elements:
+            index.add(job)
+
+        self.assertTrue(index.has_proc(owner))
+        self.assertEqual(self._pids(index.get_proc_jobs(owner)),
+                         [20, 21, 22])
+        self.assertEqual(self._pids(index.get_proc_jobs(5)), [5])
+        self.assertEqual(self._pids(index.get_array_elements(20)),
+                         [20, 21, 22])
+
+        for job in elements:
+            index.remove(job['pid'])
+        self.assertFalse(index.has_proc(owner))
+        self.assertEqual(index.get_array_elements(20), [])
+
+    def test_pop_changed(self):
+        index = self.index
+
+        # not known until the first call
+        self.assertIsNone(index.pop_changed())
+        self.assertEqual(index.pop_changed(), set())
+
+        index.touch(index.get(3))
+        index.remove(7)
+        index.add(_job(11))
+        self.assertEqual(index.pop_changed(), {3, 7, 11})
+
+        # more than are in the queue
+        for pid in range(100, 110):
+            index.add(_job(pid))
+            index.remove(pid)
+        self.assertIsNone(index.pop_changed())
+
+
+class TestBlocked(unittest.TestCase):
+    """
+    the groups blocked by waiting block jobs, counted as jobs come and go
+    """
+    def setUp(self):
+        self.index = JobIndex()
+
+    def _block(self, pid, group=None, status='wait'):
+        require = {'priority': 'block'}
+        if group is not None:
+            require['group'] = group
+
+        job = Job(pid=pid, user='jdoe', commandline='echo', require=require)
+        job['status'] = status
+        self.index.add(job)
+        return job
+
+    def _blocked(self):
+        groups, block_all = self.index.get_blocked()
+        return sorted(groups), block_all
+
+    def test_groups(self):
+        index = self.index
+        self.assertEqual(self._blocked(), ([], False))
+
+        self._block(1, ['gpu', 'fast'])
+        self._block(2, 'gpu')
+        index.add(_job(3, priority='high'))
+        self.assertEqual(self._blocked(), (['fast', 'gpu'], False))
+
+        # gpu is still blocked by job 2
+        index.remove(1)
+        self.assertEqual(self._blocked(), (['gpu'], False))
+
+        # running block jobs block nothing
+        job = index.get(2)
+        job['status'] = 'run'
+        index.reindex(job)
+        self.assertEqual(self._blocked(), ([], False))
+
+    def test_all(self):
+        # a block job asking for no group blocks them all
+        self._block(1)
+        self._block(2)
+        self.assertEqual(self._blocked(), ([], True))
+        self.index.remove(1)
+        self.assertEqual(self._blocked(), ([], True))
+        self.index.remove(2)
+        self.assertEqual(self._blocked(), ([], False))
+
+    def test_generation(self):
+        index = self.index
+
+        # only changes in the set of blocked groups count
+        gen = index.block_gen
+        self._block(1, 'gpu')
+        self.assertGreater(index.block_gen, gen)
+
+        gen = index.block_gen
+        self._block(2, 'gpu')
+        index.add(_job(3))
+        self._block(4, 'gpu', status='run')
+        index.remove(2)
+        self.assertEqual(index.block_gen, gen)
+
+        index.remove(1)
+        self.assertGreater(index.block_gen, gen)
+
+    def test_random(self):
+        rng = random.Random(3)
+        index = self.index
+        groups = [None, 'a', 'b', ['a', 'b'], 'c']
+        for pid in range(300):
+            action = rng.random()
+            if action < 0.5 or len(index) == 0:
+                self._block(pid, rng.choice(groups),
+                            status=rng.choice(['wait', 'run']))
+            elif action < 0.8:
+                index.remove(rng.choice([job['pid'] for job in index]))
+            else:
+                job = rng.choice(list(index))
+                job['status'] = 'run' if job['status'] == 'wait' else 'wait'
+                index.reindex(job)
+
+            waiting = index.get_jobs(priority='block', status='wait')
+            expected = set()
+            for job in waiting:
+                expected |= job.reqs.group
+            block_all = any(not job.reqs.group for job in waiting)
+            self.assertEqual(self._blocked(), (sorted(expected), block_all))
+
+
+class TestBadPids(unittest.TestCase):
+    """
+    requests naming jobs by something other than an integer pid are
+    refused, and don't disturb the queue
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.queue = make_queue(self.tmpdir, ['node1 2 8'])
+        submit(self.queue, os.getpid())
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_requests(self):
+        bad = ['abc', [1], {'a': 1}, True, 1.5]
+        for pid in bad:
+            for command, kw in [
+                    ('sub', {'user': 'jdoe', 'commandline': 'echo',
+                             'require': {}}),
+                    ('rm', {'user': 'jdoe'}),
+                    ('get_hosts', {}),
+                    ('notify', {'notification': 'done'}),
+                    ]:
+                response = request(self.queue, command, pid=pid, **kw)
+                self.assertIn('error', response, (command, pid))
+
+            response = request(self.queue, 'notify_many', pids=[pid])
+            self.assertIn('error', response, pid)
+
+            response = request(self.queue, 'attach', owner=pid)
+            self.assertIn('error', response, pid)
+
+        self.assertEqual([job['pid'] for job in self.queue.queue],
+                         [os.getpid()])
+
+        # the queue still works
+        response = request(self.queue, 'rm', pid='all', user='jdoe')
+        self.assertEqual(response['pids_to_kill'], [os.getpid()])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+"""
+Tests of loading the journal and snapshot, as the server does on start up
+"""
+import os
+import shutil
+import marshal
+import tempfile
+import unittest
+
+from wq.journal import Journal, SnapshotError, SNAPSHOT_HEADER
+
+
+def _submit(pid):
+    return {
+        'op': 'submit',
+        'job': {'pid': pid, 'user': 'jdoe', 'status': 'wait', 'hosts': []},
+    }
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_dir)
+
+    def _write(self, records, tail=b''):
+        journal = Journal(self.spool_dir)
+        for record in records:
+            journal.append(record)
+        journal.sync()
+        journal.close()
+
+        if tail:
+            with open(journal.journal_fname, 'ab') as fobj:
+                fobj.write(tail)
+
+        return journal
+
+    def test_replay(self):
+        self._write([
+            _submit(1),
+            _submit(2),
+            {'op': 'update', 'pid': 1, 'status': 'run', 'hosts': ['a']},
+            {'op': 'done', 'pid': 2},
+        ])
+
+        jobs = Journal(self.spool_dir).load()
+        self.assertEqual(list(jobs), [1])
+        self.assertEqual(jobs[1]['status'], 'run')
+        self.assertEqual(jobs[1]['hosts'], ['a'])
+
+    def test_torn_record(self):
+        # the server died part way through writing the update
+        journal = self._write(
+            [_submit(1), _submit(2)],
+            tail=b'{"op":"update","pid":1,"sta',
+        )
+
+        journal = Journal(self.spool_dir)
+        jobs = journal.load()
+        self.assertEqual(list(jobs), [1, 2])
+        self.assertEqual(jobs[1]['status'], 'wait')
+        self.assertEqual(journal.nrecords, 2)
+
+        # the partial record is cut off the file
+        with open(journal.journal_fname, 'rb') as fobj:
+            data = fobj.read()
+        self.assertTrue(data.endswith(b'\n'))
+        self.assertEqual(len(data.splitlines()), 2)
+
+        # records appended after the restart survive the next one
+        journal.append(
+            {'op': 'update', 'pid': 1, 'status': 'run', 'hosts': ['a']}
+        )
+        journal.sync()
+        journal.close()
+
+        jobs = Journal(self.spool_dir).load()
+        self.assertEqual(jobs[1]['status'], 'run')
+        self.assertEqual(jobs[1]['hosts'], ['a'])
+
+    def test_torn_only_record(self):
+        self._write([], tail=b'{"op":"sub')
+
+        journal = Journal(self.spool_dir)
+        self.assertEqual(journal.load(), {})
+        self.assertEqual(os.path.getsize(journal.journal_fname), 0)
+
+        journal.append(_submit(1))
+        journal.sync()
+        journal.close()
+
+        self.assertEqual(list(Journal(self.spool_dir).load()), [1])
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_dir)
+
+    def test_snapshot(self):
+        journal = Journal(self.spool_dir)
+        journal.append(_submit(1))
+        journal.snapshot([_submit(1)['job'], _submit(2)['job']])
+        journal.append({'op': 'done', 'pid': 1})
+        journal.sync()
+        journal.close()
+
+        with open(journal.snapshot_fname, 'rb') as fobj:
+            self.assertTrue(fobj.read().startswith(SNAPSHOT_HEADER))
+
+        jobs = Journal(self.spool_dir).load()
+        self.assertEqual(list(jobs), [2])
+        self.assertEqual(jobs[2], _submit(2)['job'])
+
+    def test_marshal_snapshot(self):
+        # as written by older versions
+        journal = Journal(self.spool_dir)
+        with open(journal.snapshot_fname, 'wb') as fobj:
+            fobj.write(marshal.dumps([_submit(1)['job']]))
+
+        self.assertEqual(list(journal.load()), [1])
+
+    def test_bad_snapshot(self):
+        journal = Journal(self.spool_dir)
+        for data in [SNAPSHOT_HEADER + b'[{"pid": 1', b'wq-snapshot 99\n[]',
+                     b'junk']:
+            with open(journal.snapshot_fname, 'wb') as fobj:
+                fobj.write(data)
+
+            with self.assertRaises(SnapshotError):
+                journal.load()
+
+
+if __name__ == '__main__':
+    unittest.main()
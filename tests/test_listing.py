@@ -0,0 +1,145 @@
+"""
+Tests of job listings: selecting, sorting and paging on the server
+"""
+import shutil
+import tempfile
+import unittest
+
+from helpers import make_queue, submit, request
+
+
+class TestListing(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.queue = make_queue(self.tmpdir, ['node1 2 8'])
+
+        # pid: user, priority; the first two run, the rest wait
+        self.jobs = {
+            101: ('ann', 'med'),
+            102: ('bob', 'low'),
+            103: ('ann', 'high'),
+            104: ('cat', 'med'),
+            105: ('bob', 'med'),
+        }
+        for pid, (user, priority) in sorted(self.jobs.items()):
+            submit(
+                self.queue, pid, user=user, commandline='job%d' % pid,
+                priority=priority,
+            )
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _ls(self, **kw):
+        return request(self.queue, 'ls', **kw)
+
+    def _pids(self, **kw):
+        return [r['pid'] for r in self._ls(**kw)['response']]
+
+    def test_all(self):
+        response = self._ls()
+        self.assertEqual([r['pid'] for r in response['response']],
+                         [101, 102, 103, 104, 105])
+        self.assertEqual(
+            response['counts'], {'njobs': 5, 'nrun': 2, 'nwait': 3},
+        )
+
+        r = response['response'][0]
+        self.assertEqual(r['user'], 'ann')
+        self.assertEqual(r['status'], 'run')
+        self.assertEqual(r['hosts'], ['node1'])
+        self.assertEqual(r['job_name'], 'job101')
+
+    def test_select(self):
+        self.assertEqual(self._pids(user='ann'), [101, 103])
+        self.assertEqual(self._pids(user=['cat', 'bob']), [102, 104, 105])
+        self.assertEqual(self._pids(status='run'), [101, 102])
+        self.assertEqual(self._pids(priority='med'), [101, 104, 105])
+        self.assertEqual(
+            self._pids(status='wait', priority=['med', 'high']),
+            [103, 104, 105],
+        )
+        self.assertEqual(self._pids(user='bob', status='wait'), [105])
+        self.assertEqual(self._pids(pid=[105, 101, 999]), [101, 105])
+        self.assertEqual(self._pids(pid='104'), [104])
+        self.assertEqual(self._pids(pid=[101, 102], user='bob'), [102])
+        self.assertEqual(self._pids(user='nobody'), [])
+
+        response = self._ls(user='ann')
+        self.assertEqual(
+            response['counts'], {'njobs': 2, 'nrun': 1, 'nwait': 1},
+        )
+
+    def test_bad_requests(self):
+        for kw in [
+                {'user': [[1]]},
+                {'user': {'a': 1}},
+                {'pid': 'abc'},
+                {'status': 1.5},
+                {'sort': 'nosuch'},
+                {'limit': 0},
+                {'limit': True},
+                {'limit': '2'},
+                {'fields': 'pid'},
+                {'fields': [1]},
+                {'cursor': ['x'], 'sort': 'pid'},
+                ]:
+            self.assertIn('error', self._ls(**kw), kw)
+
+    def test_sort(self):
+        self.assertEqual(self._pids(sort='-pid'), [105, 104, 103, 102, 101])
+        self.assertEqual(self._pids(sort='user'), [101, 103, 102, 105, 104])
+
+        # in order of PRIORITY_LIST, ties by pid
+        self.assertEqual(
+            self._pids(sort='priority'), [103, 101, 104, 105, 102],
+        )
+
+        # waiting jobs have no time_run, so come last
+        self.assertEqual(self._pids(sort='time_run')[2:], [103, 104, 105])
+
+    def test_paging(self):
+        for sort in ('pid', '-pid', 'user', '-priority'):
+            expected = self._pids(sort=sort)
+
+            pids = []
+            message = {'sort': sort, 'limit': 2}
+            while True:
+                response = self._ls(**message)
+                pids += [r['pid'] for r in response['response']]
+                if 'next_cursor' not in response:
+                    break
+                message['cursor'] = response['next_cursor']
+
+            self.assertEqual(pids, expected, sort)
+
+    def test_fields(self):
+        response = self._ls(fields=['pid', 'status', 'nosuch'], limit=1)
+        self.assertEqual(
+            response['response'], [{'pid': 101, 'status': 'run'}],
+        )
+
+    def test_unsortable(self):
+        # a job_name given as a requirement can be a number
+        submit(self.queue, 106, commandline='x', job_name=12)
+
+        response = self._ls(sort='job_name')
+        self.assertIn("can't sort by job_name", response['error'])
+
+        # the cursor is not to blame
+        response = self._ls(sort='job_name', cursor=['a'])
+        self.assertIn("can't sort by job_name", response['error'])
+
+        response = self._ls(sort='pid', cursor=['a'])
+        self.assertIn('bad cursor', response['error'])
+
+    def test_full(self):
+        response = request(self.queue, 'lsfull', user='bob', sort='-pid')
+        jobs = response['response']
+        self.assertEqual([job['pid'] for job in jobs], [105, 102])
+        self.assertEqual(jobs[0]['commandline'], 'job105')
+
+
+if __name__ == '__main__':
+    unittest.main()
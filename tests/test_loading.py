@@ -0,0 +1,139 @@
+"""
+Tests of loading the saved queue when the server starts, a chunk at a
+time, and from the job files of older versions
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import yaml
+
+from wq.server import JobQueue
+
+from helpers import write_cluster, submit, request, pretend_alive
+
+
+class TestLoading(unittest.TestCase):
+    def setUp(self):
+        pretend_alive(self)
+        self.tmpdir = tempfile.mkdtemp()
+        self.cluster_file = write_cluster(self.tmpdir, ['node1 4 8'])
+        self.spool_dir = os.path.join(self.tmpdir, 'spool')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _queue(self, **kw):
+        return JobQueue(
+            self.cluster_file, self.spool_dir, loglevel='warning', **kw
+        )
+
+    def _fill(self, njobs=10):
+        """
+        save a queue with njobs jobs, the first four running
+        """
+        queue = self._queue()
+        for pid in range(101, 101 + njobs):
+            submit(queue, pid, user='ann' if pid % 2 else 'bob', N=1)
+        queue.close()
+
+    def _state(self, queue):
+        return (
+            [(job['pid'], job['status'], job.get('hosts'))
+             for job in queue.queue],
+            {user: (udata['total'], udata['run'], udata['cores'])
+             for user, udata in queue.users.asdict().items()},
+            queue.cluster.nfree,
+        )
+
+    def test_load(self):
+        self._fill()
+        queue = self._queue()
+        self.assertFalse(queue.loading)
+        self.assertEqual(len(queue.queue), 10)
+        self.assertEqual(
+            self._state(queue)[1], {'ann': (5, 2, 2), 'bob': (5, 2, 2)},
+        )
+        self.assertEqual(queue.cluster.nfree, 0)
+        queue.close()
+
+    def test_incremental(self):
+        self._fill()
+        queue = self._queue()
+        expected = self._state(queue)
+        queue.close()
+
+        queue = self._queue(incremental_load=True)
+        self.assertTrue(queue.loading)
+        self.assertEqual(len(queue.queue), 0)
+
+        queue.load_some(3)
+        self.assertTrue(queue.loading)
+        self.assertEqual([job['pid'] for job in queue.queue],
+                         [101, 102, 103])
+
+        # reads are answered with what is loaded so far
+        response = request(queue, 'ls')
+        self.assertEqual(len(response['response']), 3)
+        self.assertTrue(queue.loading)
+
+        # the scheduler waits for the whole queue
+        queue.schedule()
+        self.assertEqual(self._state(queue)[2], 1)
+
+        queue.load_some(4)
+        queue.load_some(100)
+        self.assertFalse(queue.loading)
+        self.assertEqual(self._state(queue), expected)
+        queue.close()
+
+    def test_change_while_loading(self):
+        self._fill()
+        queue = self._queue(incremental_load=True)
+        queue.load_some(2)
+
+        # a change to the queue needs it all loaded first
+        request(queue, 'notify', pid=101, notification='done')
+        self.assertFalse(queue.loading)
+        self.assertEqual(len(queue.queue), 9)
+        self.assertEqual(queue.queue.get(105)['status'], 'run')
+        queue.close()
+
+    def test_old_files(self):
+        os.makedirs(self.spool_dir)
+        for pid, status in [(201, 'run'), (202, 'wait'), (203, 'wait')]:
+            record = {
+                'pid': pid, 'user': 'ann', 'commandline': 'echo',
+                'require': {'N': 2}, 'status': status,
+            }
+            if status == 'run':
+                record['hosts'] = ['node1', 'node1']
+            fname = os.path.join(self.spool_dir, '%d.%s' % (pid, status))
+            with open(fname, 'w') as fobj:
+                yaml.dump(record, fobj)
+
+        with open(os.path.join(self.spool_dir, '204.wait'), 'w') as fobj:
+            fobj.write('pid: [unclosed\n')
+
+        queue = self._queue(backend='sqlite')
+        self.assertEqual(
+            [(job['pid'], job['status']) for job in queue.queue],
+            [(201, 'run'), (202, 'wait'), (203, 'wait')],
+        )
+        self.assertEqual(queue.cluster.nfree, 2)
+
+        queue.schedule()
+        self.assertEqual(queue.queue.get(202)['status'], 'run')
+        queue.close()
+
+        # now saved by the backend, so the files are not read again
+        os.remove(os.path.join(self.spool_dir, '203.wait'))
+        queue = self._queue(backend='sqlite')
+        self.assertEqual([job['pid'] for job in queue.queue],
+                         [201, 202, 203])
+        queue.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,243 @@
+"""
+Tests of the framed wire protocol, and of falling back to json when the
+server does not support the client's encoding
+"""
+import json
+import socket
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from wq import util
+from wq import protocol
+from wq.protocol import (
+    ProtocolError,
+    UnsupportedEncoding,
+    ENC_JSON,
+    ENC_YAML,
+    HEADER_SIZE,
+    pack_frame,
+    pack_header,
+    split_message,
+    read_message,
+    encode_message,
+    get_legacy_frame,
+    is_framed,
+)
+from wq.server import ClientSession
+
+from helpers import start_server
+
+# an encoding no installation supports
+ENC_UNKNOWN = 99
+
+
+class TestFrames(unittest.TestCase):
+    def test_round_trip(self):
+        message = {'command': 'ls', 'pid': [1, 2], 'name': u'caf\xe9'}
+        for encoding in (ENC_JSON, ENC_YAML):
+            data = pack_frame(message, encoding=encoding, tag=12)
+            self.assertTrue(is_framed(data))
+
+            got, frame, nbytes = split_message(data)
+            self.assertEqual(got, message)
+            self.assertEqual(frame['encoding'], encoding)
+            self.assertEqual(frame['tag'], 12)
+            self.assertFalse(frame['legacy'])
+            self.assertEqual(nbytes, len(data))
+
+    def test_partial(self):
+        data = pack_frame({'command': 'stat'}, encoding=ENC_JSON)
+        for size in (0, 1, HEADER_SIZE - 1, HEADER_SIZE, len(data) - 1):
+            self.assertEqual(split_message(data[:size]), (None, None, 0))
+
+    def test_several(self):
+        data = (
+            pack_frame({'n': 1}, encoding=ENC_JSON, tag=1)
+            + pack_frame({'n': 2}, encoding=ENC_JSON, tag=2)
+        )
+        buf = bytearray(data)
+        tags = []
+        while buf:
+            message, frame, nbytes = split_message(buf)
+            del buf[:nbytes]
+            tags.append((message['n'], frame['tag']))
+
+        self.assertEqual(tags, [(1, 1), (2, 2)])
+
+    def test_bad_header(self):
+        with self.assertRaises(ProtocolError):
+            split_message(b'XQ')
+
+        with self.assertRaises(ProtocolError):
+            split_message(pack_header(protocol.MAX_FRAME_SIZE + 1, ENC_JSON))
+
+        data = pack_header(3, ENC_JSON) + b'{{{'
+        with self.assertRaises(ProtocolError):
+            split_message(data)
+
+    def test_long_list(self):
+        # encoded a chunk at a time, to the same result
+        message = {
+            'response': [{'pid': i} for i in range(2500)],
+            'counts': {'njobs': 2500},
+        }
+        body = protocol.encode(message, ENC_JSON)
+        self.assertEqual(json.loads(body.decode('utf-8')), message)
+
+    def test_read_message(self):
+        sock, peer = socket.socketpair()
+        try:
+            peer.sendall(pack_frame({'n': 1}, encoding=ENC_JSON, tag=5))
+            message, frame = read_message(sock)
+            self.assertEqual(message, {'n': 1})
+            self.assertEqual(frame['tag'], 5)
+
+            # as sent by old clients and servers
+            peer.sendall(b'command: stat\n')
+            message, frame = read_message(sock)
+            self.assertEqual(message, {'command': 'stat'})
+            self.assertTrue(frame['legacy'])
+
+            peer.close()
+            self.assertEqual(read_message(sock), (None, None))
+        finally:
+            sock.close()
+            peer.close()
+
+    def test_legacy_reply(self):
+        data = encode_message({'response': 'OK'}, frame=get_legacy_frame())
+        self.assertFalse(is_framed(data))
+        self.assertEqual(util.yaml_load(data), {'response': 'OK'})
+
+    def test_reply_matches_request(self):
+        _, frame, _ = split_message(
+            pack_frame({'command': 'stat'}, encoding=ENC_YAML, tag=9)
+        )
+        message, rframe, _ = split_message(
+            encode_message({'response': 'OK'}, frame=frame)
+        )
+        self.assertEqual(message, {'response': 'OK'})
+        self.assertEqual(rframe['encoding'], ENC_YAML)
+        self.assertEqual(rframe['tag'], 9)
+
+
+class TestUnsupportedEncoding(unittest.TestCase):
+    def _unknown_frame(self, tag=1):
+        body = b'\x81\xa1n\x01'
+        return pack_header(len(body), ENC_UNKNOWN, tag=tag) + body
+
+    def test_split_message(self):
+        data = self._unknown_frame()
+
+        # not raised until the frame is complete, so it can be skipped
+        self.assertEqual(split_message(data[:-1]), (None, None, 0))
+
+        with self.assertRaises(UnsupportedEncoding) as cm:
+            split_message(data + b'more')
+        self.assertEqual(cm.exception.nbytes, len(data))
+        self.assertEqual(cm.exception.frame['encoding'], ENC_UNKNOWN)
+
+    def test_read_message(self):
+        sock, peer = socket.socketpair()
+        try:
+            peer.sendall(self._unknown_frame())
+            with self.assertRaises(UnsupportedEncoding):
+                read_message(sock)
+        finally:
+            sock.close()
+            peer.close()
+
+    def test_session(self):
+        sock, peer = socket.socketpair()
+        try:
+            session = ClientSession(sock, 'test')
+            session.inbuf += self._unknown_frame(tag=1)
+            session.inbuf += pack_frame({'n': 2}, encoding=ENC_JSON, tag=2)
+
+            messages = session.get_messages()
+            self.assertEqual(len(messages), 2)
+
+            message, frame = messages[0]
+            self.assertIsNone(message)
+            self.assertEqual(frame['encoding'], ENC_UNKNOWN)
+            self.assertEqual(frame['tag'], 1)
+
+            message, frame = messages[1]
+            self.assertEqual(message, {'n': 2})
+            self.assertEqual(frame['tag'], 2)
+            self.assertFalse(session.inbuf)
+        finally:
+            sock.close()
+            peer.close()
+
+
+class TestEncodingFallback(unittest.TestCase):
+    """
+    a server that only supports json, talking to clients that prefer yaml
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.patches = [
+            mock.patch('wq.protocol.get_encodings', return_value=[ENC_JSON]),
+            mock.patch('wq.server.get_encodings', return_value=[ENC_JSON]),
+        ]
+        for patch in cls.patches:
+            patch.start()
+
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.server = start_server(cls.tmpdir)
+        cls.port = cls.server.port
+
+    @classmethod
+    def tearDownClass(cls):
+        for patch in cls.patches:
+            patch.stop()
+        shutil.rmtree(cls.tmpdir)
+
+    def setUp(self):
+        util._port_encodings[self.port] = ENC_YAML
+
+    def tearDown(self):
+        util._port_encodings.pop(self.port, None)
+
+    def test_reply(self):
+        sock = socket.create_connection(('localhost', self.port), timeout=10)
+        try:
+            sock.sendall(
+                pack_frame({'command': 'stat'}, encoding=ENC_YAML, tag=7)
+            )
+            message, frame = read_message(sock)
+            self.assertEqual(frame['encoding'], ENC_JSON)
+            self.assertEqual(frame['tag'], 7)
+            self.assertEqual(message['encodings'], [ENC_JSON])
+
+            # the connection is still good
+            sock.sendall(
+                pack_frame({'command': 'stat'}, encoding=ENC_JSON, tag=8)
+            )
+            message, frame = read_message(sock)
+            self.assertEqual(frame['tag'], 8)
+            self.assertEqual(message['response']['ncores'], 4)
+        finally:
+            sock.close()
+
+    def test_connection(self):
+        with util.Connection(self.port, timeout=10) as conn:
+            self.assertEqual(conn.encoding, ENC_YAML)
+            rdict = conn.request({'command': 'stat'})
+            self.assertEqual(rdict['response']['ncores'], 4)
+
+            self.assertEqual(conn.encoding, ENC_JSON)
+            self.assertFalse(conn.legacy)
+            self.assertEqual(util._port_encodings[self.port], ENC_JSON)
+
+    def test_send_message(self):
+        rdict = util.send_message(self.port, {'command': 'stat'}, timeout=10)
+        self.assertEqual(rdict['response']['ncores'], 4)
+        self.assertEqual(util._port_encodings[self.port], ENC_JSON)
+
+
+if __name__ == '__main__':
+    unittest.main()
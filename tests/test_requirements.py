@@ -0,0 +1,204 @@
+"""
+Tests of job requirements and the matchers that place jobs on the nodes
+"""
+import shutil
+import tempfile
+import unittest
+
+from wq.server import Cluster, Job, Requirements
+
+from helpers import write_cluster
+
+CLUSTER = [
+    'node1 4 8 gpu,fast',
+    'node2 4 16 fast',
+    'node3 2 32',
+]
+
+
+def _job(**require):
+    return Job(pid=1, user='jdoe', commandline='echo', require=require)
+
+
+class TestRequirements(unittest.TestCase):
+    def test_defaults(self):
+        reqs = Requirements({})
+        self.assertIs(reqs.matcher, Job._match_by_core)
+        self.assertEqual((reqs.N, reqs.threads), (1, 1))
+        self.assertEqual(reqs.min_mem, 0.0)
+        self.assertEqual(reqs.group, frozenset())
+
+    def test_parsed(self):
+        reqs = Requirements({
+            'mode': 'bynode', 'N': '2', 'min_mem': '4.5',
+            'group': 'gpu', 'notgroup': ['slow', 'old'],
+        })
+        self.assertIs(reqs.matcher, Job._match_by_node)
+        self.assertEqual(reqs.N, 2)
+        self.assertEqual(reqs.min_mem, 4.5)
+        self.assertEqual(reqs.group, frozenset(['gpu']))
+        self.assertEqual(reqs.not_group, frozenset(['slow', 'old']))
+
+        # the same requirements given differently share a key
+        other = Requirements({
+            'mode': 'by_node', 'N': 2, 'min_mem': 4.5,
+            'group': ['gpu'], 'not_group': ['old', 'slow'],
+        })
+        self.assertEqual(reqs.key, other.key)
+
+    def test_bad(self):
+        for reqs in [
+                [],
+                {'mode': 'nosuch'},
+                {'mode': ['by_core']},
+                {'N': 'many'},
+                {'N': [1]},
+                {'min_mem': 'lots'},
+                {'group': [[1]]},
+                {'N': 3, 'threads': 2},
+                {'mode': 'by_host'},
+                {'mode': 'by_host', 'host': ['node1']},
+                {'mode': 'by_group'},
+                {'mode': 'by_group', 'group': ['gpu', 'fast']},
+                {'mode': 'by_group', 'group': {'gpu': 1}},
+                ]:
+            with self.assertRaises(ValueError, msg=reqs):
+                Requirements(reqs)
+
+    def test_bad_job(self):
+        job = _job(mode=['by_core'])
+        self.assertEqual(job['status'], 'nevermatch')
+        self.assertIn('submit_mode', job['reason'])
+
+
+class TestMatchers(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cluster = Cluster(write_cluster(self.tmpdir, CLUSTER))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _match(self, job, blocked=()):
+        job.match(self.cluster, self.cluster.group_mask(blocked))
+        return job
+
+    def test_by_core(self):
+        job = self._match(_job(N=6))
+        self.assertEqual(job['status'], 'ready')
+        self.assertEqual(job['hosts'], ['node1']*4 + ['node2']*2)
+
+        # filled in order of name, skipping nodes that are full
+        self.cluster.reserve(['node1']*3)
+        job = self._match(_job(N=3))
+        self.assertEqual(job['hosts'], ['node1', 'node2', 'node2'])
+
+        job = self._match(_job(N=11))
+        self.assertEqual(job['status'], 'nevermatch')
+
+        job = self._match(_job(N=8))
+        self.assertEqual(job['status'], 'wait')
+        self.assertEqual(job['reason'], 'Not enough free cores.')
+
+    def test_by_core_threads(self):
+        # only whole multiples of the threads are used on each node
+        self.cluster.reserve(['node1'])
+        job = self._match(_job(N=4, threads=2))
+        self.assertEqual(job['hosts'], ['node1']*2 + ['node2']*2)
+
+    def test_by_core_requirements(self):
+        job = self._match(_job(N=2, min_mem=10))
+        self.assertEqual(job['hosts'], ['node2']*2)
+
+        job = self._match(_job(N=2, group='gpu'))
+        self.assertEqual(job['hosts'], ['node1']*2)
+
+        job = self._match(_job(N=2, not_group=['fast']))
+        self.assertEqual(job['hosts'], ['node3']*2)
+
+        job = self._match(_job(N=5, group='gpu'))
+        self.assertEqual(job['status'], 'nevermatch')
+
+    def test_by_core1(self):
+        self.cluster.reserve(['node1'])
+        job = self._match(_job(mode='by_core1', N=4))
+        self.assertEqual(job['hosts'], ['node2']*4)
+
+        job = self._match(_job(mode='by_core1', N=5))
+        self.assertEqual(job['status'], 'nevermatch')
+
+        self.cluster.reserve(['node2'])
+        job = self._match(_job(mode='by_core1', N=4))
+        self.assertEqual(job['status'], 'wait')
+
+    def test_no_cores(self):
+        # nothing is reserved, so any eligible node matches, even a full
+        # one or one in a blocked group
+        self.cluster.reserve(['node1']*4 + ['node2']*4 + ['node3']*2)
+        for mode in ('by_core', 'by_core1'):
+            job = self._match(_job(mode=mode, N=0), blocked=['fast'])
+            self.assertEqual(job['status'], 'ready', mode)
+            self.assertEqual(job['hosts'], [], mode)
+
+        job = self._match(_job(mode='by_core1', N=0, group='nosuch'))
+        self.assertEqual(job['status'], 'nevermatch')
+
+        job = self._match(_job(mode='by_node', N=0))
+        self.assertEqual(job['status'], 'nevermatch')
+
+    def test_by_node(self):
+        self.cluster.reserve(['node1'])
+        job = self._match(_job(mode='by_node', N=2))
+        self.assertEqual(job['hosts'], ['node2']*4 + ['node3']*2)
+
+        job = self._match(_job(mode='by_node', N=1, min_cores=4))
+        self.assertEqual(job['hosts'], ['node2']*4)
+
+        job = self._match(_job(mode='by_node', N=3))
+        self.assertEqual(job['status'], 'wait')
+
+        job = self._match(_job(mode='by_node', N=4))
+        self.assertEqual(job['status'], 'nevermatch')
+
+    def test_by_host(self):
+        job = self._match(_job(mode='by_host', host='node3', N=2))
+        self.assertEqual(job['hosts'], ['node3']*2)
+
+        job = self._match(_job(mode='by_host', host='nosuch'))
+        self.assertEqual(job['status'], 'nevermatch')
+
+        job = self._match(_job(mode='by_host', host='node1'), ['gpu'])
+        self.assertEqual(job['reason'], 'host in blocked group')
+
+        self.cluster.set_online('node3', False)
+        job = self._match(_job(mode='by_host', host='node3'))
+        self.assertEqual(job['reason'], 'host is offline')
+
+    def test_by_group(self):
+        job = self._match(_job(mode='by_group', group='fast'))
+        self.assertEqual(job['hosts'], ['node1']*4 + ['node2']*4)
+
+        job = self._match(_job(mode='by_group', group='nosuch'))
+        self.assertEqual(job['status'], 'nevermatch')
+
+        self.cluster.reserve(['node2'])
+        job = self._match(_job(mode='by_group', group='fast'))
+        self.assertEqual(job['status'], 'wait')
+
+    def test_blocked(self):
+        job = self._match(_job(N=4), blocked=['fast'])
+        self.assertEqual(job['status'], 'wait')
+        self.assertIn('blocking', job['reason'])
+
+        job = self._match(_job(N=2), blocked=['fast'])
+        self.assertEqual(job['hosts'], ['node3']*2)
+
+        # block jobs are not held back by the groups they block
+        job = _job(N=4)
+        job['priority'] = 'block'
+        job = self._match(job, blocked=['fast'])
+        self.assertEqual(job['hosts'], ['node1']*4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,201 @@
+"""
+Tests of the scheduler: which waiting jobs it runs, and that it only looks
+at the jobs whose outcome could have changed
+"""
+import random
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from helpers import make_queue, submit, request, pretend_alive
+
+CLUSTER = ['node1 4 8 fast', 'node2 4 8 fast', 'node3 2 8 slow']
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        pretend_alive(self)
+        self.tmpdir = tempfile.mkdtemp()
+        self.queue = make_queue(self.tmpdir, CLUSTER)
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _status(self, pid):
+        return self.queue.queue.get(pid)['status']
+
+    def _running(self):
+        return [
+            job['pid'] for job in self.queue.queue if job['status'] == 'run'
+        ]
+
+    def _done(self, pid):
+        response = request(self.queue, 'notify', pid=pid, notification='done')
+        self.assertEqual(response['response'], 'OK')
+
+    def _count_passes(self):
+        return mock.patch.object(
+            self.queue, '_schedule_pass', wraps=self.queue._schedule_pass,
+        )
+
+    def _count_matches(self):
+        return mock.patch.object(
+            self.queue, '_match', wraps=self.queue._match,
+        )
+
+    def test_order(self):
+        # fill the cluster, then queue jobs of each priority
+        submit(self.queue, 1, N=10)
+        submit(self.queue, 2, N=4, priority='low')
+        submit(self.queue, 3, N=4, priority='med')
+        submit(self.queue, 4, N=4, priority='high')
+        submit(self.queue, 5, N=4, priority='high')
+        self.assertEqual(self._running(), [1])
+
+        # by priority, then in order of submission
+        self._done(1)
+        self.assertEqual(self._running(), [4, 5])
+        self._done(4)
+        self.assertEqual(self._running(), [3, 5])
+        self._done(5)
+        self._done(3)
+        self.assertEqual(self._running(), [2])
+
+    def test_nothing_freed(self):
+        submit(self.queue, 1, N=10)
+        submit(self.queue, 2, N=2)
+
+        # nothing can run until cores are freed, so no pass is made
+        with self._count_passes() as passes:
+            submit(self.queue, 3, N=2)
+            request(self.queue, 'ls')
+            self.queue.schedule()
+        self.assertEqual(passes.call_count, 0)
+
+        with self._count_passes() as passes:
+            self._done(1)
+        self.assertEqual(passes.call_count, 1)
+        self.assertEqual(self._running(), [2, 3])
+
+    def test_failed_matches(self):
+        submit(self.queue, 1, N=10)
+        for pid in range(2, 6):
+            submit(self.queue, pid, N=4, mode='by_core1')
+        submit(self.queue, 6, N=2)
+
+        # once job 4 fails to find a node with four free cores, job 5 is
+        # given the same outcome without being matched
+        with self._count_matches() as matches:
+            self._done(1)
+        self.assertEqual(self._running(), [2, 3, 6])
+        self.assertEqual(
+            [args[0]['pid'] for args, _ in matches.call_args_list],
+            [2, 3, 4, 6],
+        )
+
+        job4, job5 = self.queue.queue.get(4), self.queue.queue.get(5)
+        self.assertEqual(job5['status'], 'wait')
+        self.assertEqual(job5['reason'], job4['reason'])
+
+    def test_user_limits(self):
+        request(self.queue, 'limit', user='ann', limits={'Njobs': 1})
+        submit(self.queue, 1, user='ann', N=1)
+        submit(self.queue, 2, user='ann', N=1)
+        submit(self.queue, 3, user='bob', N=1)
+        self.assertEqual(self._running(), [1, 3])
+        self.assertEqual(
+            self.queue.queue.get(2)['reason'], 'user limits exceeded',
+        )
+        self.queue.schedule()
+
+        # only ann's jobs need another look, on the next pass
+        with self._count_passes() as passes:
+            request(self.queue, 'limit', user='ann', limits={'Njobs': 2})
+            self.queue.schedule()
+        self.assertEqual(passes.call_count, 1)
+        self.assertEqual([job['pid'] for job in passes.call_args[0][0]], [2])
+        self.assertEqual(self._running(), [1, 2, 3])
+
+    def test_block(self):
+        submit(self.queue, 1, N=7)
+        self.assertEqual(self._running(), [1])
+
+        # waits for the fast nodes, which then take no other jobs
+        submit(self.queue, 2, priority='block', mode='by_group',
+               group='fast')
+        self.assertEqual(self._status(2), 'wait')
+
+        submit(self.queue, 3, N=1, group='fast')
+        self.assertEqual(self._status(3), 'wait')
+        self.assertIn('blocking', self.queue.queue.get(3)['reason'])
+
+        submit(self.queue, 4, N=1, group='slow')
+        self.assertEqual(self._status(4), 'run')
+
+        self._done(1)
+        self.assertEqual(self._status(2), 'run')
+        self._done(2)
+        self.assertEqual(self._status(3), 'run')
+
+    def test_same_as_full_scan(self):
+        """
+        the incremental scheduler starts the same jobs as one that looks at
+        every waiting job on every pass
+        """
+        rng = random.Random(42)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        full_queue = make_queue(tmpdir, CLUSTER)
+        self.addCleanup(full_queue.close)
+
+        def full_schedule(queue=full_queue, schedule=full_queue.schedule):
+            queue._mark_all()
+            schedule()
+
+        full_queue.schedule = full_schedule
+
+        pid = 0
+        for step in range(300):
+            queues = (self.queue, full_queue)
+            running = [
+                job['pid'] for job in self.queue.queue
+                if job['status'] == 'run'
+            ]
+            action = rng.random()
+            if action < 0.5 or not running:
+                pid += 1
+                require = {
+                    'N': rng.randint(1, 3),
+                    'priority': rng.choice(['low', 'med', 'high']),
+                }
+                if rng.random() < 0.2:
+                    require['group'] = rng.choice(['fast', 'slow'])
+                if rng.random() < 0.1:
+                    require['mode'] = 'by_core1'
+                user = rng.choice(['ann', 'bob', 'cat'])
+                for queue in queues:
+                    submit(queue, pid, user=user, **require)
+            elif action < 0.8:
+                done = rng.choice(running)
+                for queue in queues:
+                    request(queue, 'notify', pid=done, notification='done')
+            else:
+                user = rng.choice(['ann', 'bob', 'cat'])
+                limits = {'Njobs': rng.randint(1, 3)}
+                for queue in queues:
+                    request(queue, 'limit', user=user, limits=limits)
+                    queue.schedule()
+
+            self.assertEqual(
+                [(job['pid'], job['status'], job.get('hosts'))
+                 for job in self.queue.queue],
+                [(job['pid'], job['status'], job.get('hosts'))
+                 for job in full_queue.queue],
+                step,
+            )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,13 +2,21 @@
 
 from .version import __version__
 
-from . import server
-
 from . import util
-from .util import send_message
+from .util import send_message, Connection
 
 from . import defaults
 from .defaults import HOST
 from .defaults import DEFAULT_PORT
 from .defaults import BUFFSIZE
 from .defaults import DEFAULT_SPOOL_DIR
+
+
+def __getattr__(name):
+    # the server is imported on first use, so that client commands, which
+    # never need it, start quickly
+    if name == 'server':
+        import importlib
+        return importlib.import_module('.server', __name__)
+
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,408 @@
+"""
+Backends for the persistent state of the server: the jobs in the queue, the
+user limits and which nodes are online.
+
+All backends have the same methods, which JobQueue calls as the state
+changes
+
+    load_jobs()             the saved jobs, in order of submission, or None
+                            if nothing was ever saved
+    save_jobs(jobs)         replace all saved jobs
+    add_job(job)            a job entered the queue
+    update_job(job, data)   a job changed, e.g. started running; data holds
+                            the changed entries
+    remove_job(job)         a job left the queue
+    load_users()            dict of limits keyed by user, or None
+    save_users(users)       save the limits of all users, a Users object
+    load_nodes()            dict of online state keyed by host
+    save_node(host, online) a node was set online or offline
+    load_next_id()          the next id for jobs submitted with sub_many,
+                            or None
+    save_next_id(next_id)   the next id was advanced
+    maintain(jobs)          a chance for housekeeping, with the jobs in the
+                            queue
+    commit()                make the changes since the last commit durable
+    close()
+
+Available backends are
+
+    spool   a journal and snapshot in the spool directory, with users.yaml,
+            nodes.yaml and next_id.yaml; see wq.journal
+    sqlite  a single SQLite database in the spool directory, with the jobs
+            indexed by user, status and priority
+    memory  nothing is saved; for tests and benchmarks
+"""
+import os
+import json
+import yaml
+
+from .journal import Journal
+from .persist import Committer, check_durability, DEFAULT_DURABILITY
+from .util import yaml_load
+
+BACKENDS = ('spool', 'sqlite', 'memory')
+DEFAULT_BACKEND = 'spool'
+
+USERS_NAME = 'users.yaml'
+NODES_NAME = 'nodes.yaml'
+NEXT_ID_NAME = 'next_id.yaml'
+SQLITE_NAME = 'wq.sqlite'
+
+
+def get_backend(name, spool_dir, durability=DEFAULT_DURABILITY):
+    """
+    get the named backend
+
+    Parameters
+    ----------
+    name: str
+        One of 'spool', 'sqlite' or 'memory'
+    spool_dir: str
+        Directory in which state is saved
+    durability: str, optional
+        One of 'none', 'batch' or 'always'; see wq.persist
+    """
+    if name == 'spool':
+        return SpoolBackend(spool_dir, durability=durability)
+    elif name == 'sqlite':
+        return SQLiteBackend(spool_dir, durability=durability)
+    elif name == 'memory':
+        return MemoryBackend()
+    else:
+        raise ValueError(
+            'backend should be one of %s, got %s' % (', '.join(BACKENDS), name)
+        )
+
+
+def _dumps(obj):
+    return json.dumps(obj, separators=(',', ':'), default=str)
+
+
+class MemoryBackend(object):
+    """
+    Keep the state in memory only
+    """
+    def __init__(self):
+        self.jobs = None
+        self.users = None
+        self.nodes = {}
+        self.next_id = None
+
+    def load_jobs(self):
+        if self.jobs is None:
+            return None
+        return list(self.jobs.values())
+
+    def save_jobs(self, jobs):
+        self.jobs = {}
+        for job in jobs:
+            self.add_job(job)
+
+    def add_job(self, job):
+        if self.jobs is None:
+            self.jobs = {}
+        self.jobs[job['pid']] = dict(job)
+
+    def update_job(self, job, data):
+        self.jobs[job['pid']].update(data)
+
+    def remove_job(self, job):
+        self.jobs.pop(job['pid'], None)
+
+    def load_users(self):
+        return self.users
+
+    def save_users(self, users):
+        self.users = users.get_limits()
+
+    def load_nodes(self):
+        return dict(self.nodes)
+
+    def save_node(self, host, online):
+        self.nodes[host] = online
+
+    def load_next_id(self):
+        return self.next_id
+
+    def save_next_id(self, next_id):
+        self.next_id = next_id
+
+    def maintain(self, jobs):
+        pass
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SpoolBackend(object):
+    """
+    Keep the jobs in a journal and snapshot, and the users and nodes in YAML
+    files, all in the spool directory
+    """
+    def __init__(self, spool_dir, durability=DEFAULT_DURABILITY):
+        self.spool_dir = spool_dir
+        self.committer = Committer(durability=durability)
+        self.journal = Journal(spool_dir, durability=durability)
+        self.users_fname = os.path.join(spool_dir, USERS_NAME)
+        self.nodes_fname = os.path.join(spool_dir, NODES_NAME)
+        self.next_id_fname = os.path.join(spool_dir, NEXT_ID_NAME)
+        self.nodes = self._read_yaml(self.nodes_fname) or {}
+
+    def load_jobs(self):
+        if not self.journal.exists():
+            return None
+        return list(self.journal.load().values())
+
+    def save_jobs(self, jobs):
+        self.journal.snapshot(jobs)
+
+    def add_job(self, job):
+        self._append({'op': 'submit', 'job': dict(job)})
+
+    def update_job(self, job, data):
+        record = {'op': 'update', 'pid': job['pid']}
+        record.update(data)
+        self._append(record)
+
+    def remove_job(self, job):
+        self._append({'op': 'done', 'pid': job['pid']})
+
+    def load_users(self):
+        return self._read_yaml(self.users_fname)
+
+    def save_users(self, users):
+        self.committer.write(self.users_fname, users.dumps())
+
+    def load_nodes(self):
+        return dict(self.nodes)
+
+    def save_node(self, host, online):
+        self.nodes[host] = online
+        self.committer.write(self.nodes_fname, yaml.dump(self.nodes))
+
+    def load_next_id(self):
+        data = self._read_yaml(self.next_id_fname)
+        if data is None:
+            return None
+        return data['next_id']
+
+    def save_next_id(self, next_id):
+        self.committer.write(
+            self.next_id_fname, yaml.dump({'next_id': next_id}),
+        )
+
+    def maintain(self, jobs):
+        if self.journal.needs_compaction(len(jobs)):
+            self.journal.snapshot(jobs)
+
+    def commit(self):
+        self.committer.commit()
+
+    def close(self):
+        self.commit()
+        self.journal.close()
+
+    def _append(self, record):
+        self.journal.append(record)
+        self.committer.add_sync(self.journal)
+
+    def _read_yaml(self, fname):
+        if not os.path.exists(fname):
+            return None
+
+        with open(fname) as fobj:
+            return yaml_load(fobj)
+
+
+class SQLiteBackend(object):
+    """
+    Keep the state in an SQLite database in the spool directory
+
+    Each job is a row holding its full record as JSON, along with its pid,
+    user, status and priority, which are indexed so the database can be
+    queried directly.  Changes are made in a transaction that is committed
+    at commit, or with every change if the durability is 'always'.
+    """
+    def __init__(self, spool_dir, durability=DEFAULT_DURABILITY):
+        import sqlite3
+
+        check_durability(durability)
+        self.durability = durability
+
+        self.fname = os.path.join(spool_dir, SQLITE_NAME)
+        self.conn = sqlite3.connect(self.fname)
+
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        if durability == 'none':
+            self.conn.execute('PRAGMA synchronous=OFF')
+        else:
+            self.conn.execute('PRAGMA synchronous=FULL')
+
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                pid INTEGER PRIMARY KEY,
+                seq INTEGER NOT NULL,
+                user TEXT,
+                status TEXT,
+                priority TEXT,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_seq ON jobs (seq);
+            CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user);
+            CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+            CREATE INDEX IF NOT EXISTS jobs_priority ON jobs (priority);
+
+            CREATE TABLE IF NOT EXISTS users (
+                user TEXT PRIMARY KEY,
+                limits TEXT NOT NULL
+            );
+
+            CREATE TABLE IF NOT EXISTS nodes (
+                host TEXT PRIMARY KEY,
+                online INTEGER NOT NULL
+            );
+
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+        self.conn.commit()
+
+        row = self.conn.execute('SELECT MAX(seq) FROM jobs').fetchone()
+        self.seq = (row[0] or 0) + 1
+
+        # whether anything was ever saved
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = 'initialized'"
+        ).fetchone()
+        self.initialized = row is not None
+
+    def load_jobs(self):
+        if not self.initialized:
+            return None
+
+        return [
+            json.loads(data)
+            for data, in self.conn.execute(
+                'SELECT data FROM jobs ORDER BY seq'
+            )
+        ]
+
+    def save_jobs(self, jobs):
+        self.conn.execute('DELETE FROM jobs')
+        for job in jobs:
+            self._insert(job)
+        self._changed()
+
+    def add_job(self, job):
+        self._insert(job)
+        self._changed()
+
+    def update_job(self, job, data):
+        self.conn.execute(
+            'UPDATE jobs SET status = ?, priority = ?, data = ? '
+            'WHERE pid = ?',
+            (job['status'], job['priority'], _dumps(dict(job)), job['pid']),
+        )
+        self._changed()
+
+    def remove_job(self, job):
+        self.conn.execute('DELETE FROM jobs WHERE pid = ?', (job['pid'],))
+        self._changed()
+
+    def load_users(self):
+        rows = self.conn.execute('SELECT user, limits FROM users').fetchall()
+        if not rows:
+            # no limits, unless nothing was ever saved
+            row = self.conn.execute(
+                "SELECT value FROM meta WHERE key = 'users_saved'"
+            ).fetchone()
+            if row is None:
+                return None
+
+        return {
+            user: {'user': user, 'limits': json.loads(limits)}
+            for user, limits in rows
+        }
+
+    def save_users(self, users):
+        # users whose limits were cleared must not come back
+        self.conn.execute('DELETE FROM users')
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO users (user, limits) VALUES (?, ?)',
+            [
+                (user, _dumps(udata['limits']))
+                for user, udata in users.get_limits().items()
+            ],
+        )
+        self.conn.execute(
+            'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+            ('users_saved', 1),
+        )
+        self._changed()
+
+    def load_nodes(self):
+        return {
+            host: bool(online)
+            for host, online in self.conn.execute(
+                'SELECT host, online FROM nodes'
+            )
+        }
+
+    def save_node(self, host, online):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO nodes (host, online) VALUES (?, ?)',
+            (host, int(online)),
+        )
+        self._changed()
+
+    def load_next_id(self):
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = 'next_id'"
+        ).fetchone()
+        if row is None:
+            return None
+        return int(row[0])
+
+    def save_next_id(self, next_id):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+            ('next_id', next_id),
+        )
+        self._changed()
+
+    def maintain(self, jobs):
+        pass
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+    def _insert(self, job):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO jobs '
+            '(pid, seq, user, status, priority, data) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (
+                job['pid'], self.seq, job['user'], job['status'],
+                job['priority'], _dumps(dict(job)),
+            ),
+        )
+        self.seq += 1
+
+    def _changed(self):
+        if not self.initialized:
+            self.conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('initialized', 1)"
+            )
+            self.initialized = True
+
+        if self.durability == 'always':
+            self.commit()
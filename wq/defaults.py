@@ -4,10 +4,18 @@ BUFFSIZE = 4096
 
 # only listen for this many seconds, then refresh the queue
 SOCK_TIMEOUT = 30.0
+
+# drop clients that take longer than this to send a request or read a reply
+CLIENT_TIMEOUT = 30.0
+LISTEN_BACKLOG = 128
 WAIT_SLEEP = 10.0
 DEFAULT_SPOOL_DIR = '~/wqspool/'
 
 PRIORITY_LIST = ['block', 'high', 'med', 'low']
 
+# reply to a read sent with the current generation of the queue; the
+# client already has the answer
+NOT_MODIFIED = 'not modified'
+
 # how many seconds to wait before restart
 RESTART_DELAY = 60
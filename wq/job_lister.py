@@ -1,6 +1,10 @@
-import yaml
-from .util import get_time_diff, send_message
-from .defaults import DEFAULT_PORT
+from .util import get_time_diff, send_message, subscribe, clear_screen
+from .defaults import DEFAULT_PORT, PRIORITY_LIST
+
+# fields by which job listings can be sorted
+LISTING_SORT_KEYS = (
+    'pid', 'user', 'priority', 'status', 'time_sub', 'time_run', 'job_name',
+)
 
 
 class JobLister(dict):
@@ -10,10 +14,22 @@ class JobLister(dict):
     print the job list to stdout.
 
     If -u/--user is sent, the listing is restricted to that user/users.
+    Similarly --status, --priority and --pid restrict the listing to jobs
+    with those values; each can be a comma separated list.  The selection
+    is made by the server, so listing a few jobs in a large queue is fast.
+
+    The jobs are listed in order of submission, or sorted by the field sent
+    with --sort, one of pid, user, priority, status, time_sub, time_run or
+    job_name; prefix it with - to reverse the order.  Use -n/--limit to list
+    only the first jobs in that order.
 
     If -f/--full is sent, the full job listing is given.  This is a yaml
     document that can be read and processed to provide a customised
-    listing.
+    listing.  With --fields, only the given fields are listed for each job.
+
+    With -w/--watch the listing is shown and kept up to date until
+    interrupted.  The server sends only the changes, so this is much
+    cheaper than running wq ls repeatedly.
     """
 
     def __init__(self, port, args):
@@ -26,22 +42,74 @@ class JobLister(dict):
         parser.add_option("-u", "--user", default=None,
                           help=("Only list jobs for the user.  can be "
                                 "a comma separated list"))
+        parser.add_option("--status", default=None,
+                          help=("Only list jobs with this status, run or "
+                                "wait"))
+        parser.add_option("--priority", default=None,
+                          help="Only list jobs with this priority")
+        parser.add_option("--pid", default=None,
+                          help="Only list the jobs with these pids")
+        parser.add_option("--sort", default=None,
+                          help="Sort by this field, e.g. -time_sub")
+        parser.add_option("-n", "--limit", type='int', default=None,
+                          help="List at most this many jobs")
         parser.add_option("-f", "--full", action='store_true',
                           help="Give a full job listing as a YAML stream.")
+        parser.add_option("--fields", default=None,
+                          help=("Fields to give for each job in the full "
+                                "listing"))
+        parser.add_option("-w", "--watch", action='store_true',
+                          help="Keep the listing up to date")
 
         options, args = parser.parse_args(args)
-        self.user = options.user
+        self.user = _split_option(options.user)
+        self.status = _split_option(options.status)
+        self.priority = _split_option(options.priority)
+        self.pids = _split_option(options.pid)
+        self.sort = options.sort
+        self.limit = options.limit
         self.full = options.full
+        self.fields = _split_option(options.fields)
+        self.watch = options.watch
 
-        if self.user is not None:
-            self.user = self.user.split(',')
+        if self.watch and self.full:
+            parser.error('--watch does not work with --full')
+
+        if self.pids is not None:
+            try:
+                self.pids = [int(pid) for pid in self.pids]
+            except ValueError:
+                parser.error('pids must be integers')
 
     def execute(self):
-        res = get_job_listing(port=self.port, full=self.full, user=self.user)
+        if self.watch:
+            watch_job_listing(
+                port=self.port,
+                user=self.user,
+                status=self.status,
+                priority=self.priority,
+                pids=self.pids,
+                sort=self.sort,
+                limit=self.limit,
+            )
+            return
+
+        res = get_job_listing(
+            port=self.port,
+            full=self.full,
+            user=self.user,
+            status=self.status,
+            priority=self.priority,
+            pids=self.pids,
+            sort=self.sort,
+            limit=self.limit,
+            fields=self.fields,
+        )
 
         if self.full:
             if len(res['entries']) > 0:
-                print(yaml.dump(res))
+                import yaml
+                print(yaml.dump(res['entries']))
         else:
 
             lines = get_job_lines(res, user=self.user)
@@ -55,7 +123,7 @@ def get_job_lines(job_listing, user=None):
     if len(job_listing['entries']) > 0:
         lines.append(job_listing['footer'])
 
-        for entry in sorted(job_listing['entries'], key=lambda x: x['time_sub']):  # noqa
+        for entry in job_listing['entries']:
             lines.append(job_listing['fmt'] % entry)
 
     stats = 'Jobs: %s Running: %s Waiting: %s' % (
@@ -69,34 +137,157 @@ def get_job_lines(job_listing, user=None):
     return lines
 
 
-def get_job_listing(port=DEFAULT_PORT, full=False, user=None):
+def get_job_listing(port=DEFAULT_PORT, full=False, user=None, status=None,
+                    priority=None, pids=None, sort=None, limit=None,
+                    fields=None, cursor=None):
     """
     Get the job listing and other info to print stats
 
+    The jobs are selected, sorted and paged by the server
+
     Parameters
     ----------
     port: int
         The port number
-    user: str, optional
-        If set to True, limit listing to the specified user
     full: boolean, optional
         If set to True, return the full listing
+    user: list, optional
+        Only list jobs for these users
+    status: list, optional
+        Only list jobs with these statuses, 'run' or 'wait'
+    priority: list, optional
+        Only list jobs with these priorities
+    pids: list, optional
+        Only list the jobs with these pids
+    sort: str, optional
+        The field by which to sort, with a leading - to reverse the order.
+        By default the jobs are in order of submission
+    limit: int, optional
+        List at most this many jobs
+    fields: list, optional
+        For the full listing, the fields to give for each job
+    cursor: list, optional
+        The next_cursor from the listing of the previous page
+
+    Returns
+    -------
+    listing: dict
+        With the 'entries', and 'next_cursor' if there are more to list
+        after a limit.  Unless full is set, also the format of the entries
+        and the numbers of jobs in njobs, nrun and nwait
     """
-    import time
-
     message = {}
-    message['command'] = 'ls'
+    message['command'] = 'lsfull' if full else 'ls'
+    for key, val in [('user', user), ('status', status),
+                     ('priority', priority), ('pid', pids), ('sort', sort),
+                     ('limit', limit), ('cursor', cursor)]:
+        if val is not None:
+            message[key] = val
+    if full and fields is not None:
+        message['fields'] = fields
+
     resp = send_message(port, message)
 
     if full:
-        if user is not None:
-            full_listing = [
-                r for r in resp['response'] if r['user'] in user
-            ]
-        else:
-            full_listing = resp['response']
+        listing = {'entries': resp['response']}
+        if 'next_cursor' in resp:
+            listing['next_cursor'] = resp['next_cursor']
+        return listing
+
+    listing = make_job_listing(
+        resp['response'], user=user, counts=resp.get('counts'),
+    )
+    if 'next_cursor' in resp:
+        listing['next_cursor'] = resp['next_cursor']
 
-        return full_listing
+    return listing
+
+
+def watch_job_listing(port=DEFAULT_PORT, user=None, status=None,
+                      priority=None, pids=None, sort=None, limit=None,
+                      stream=None):
+    """
+    print the job listing every WATCH_INTERVAL seconds until interrupted.
+    The listing is kept up to date from the changes sent by the server; see
+    the subscribe command
+
+    The parameters are as for get_job_listing; sorting and limiting are
+    done here, so that the listing can be updated
+    """
+    import sys
+
+    if stream is None:
+        stream = sys.stdout
+
+    message = {'topics': ['jobs']}
+    for key, val in [('user', user), ('status', status),
+                     ('priority', priority), ('pid', pids)]:
+        if val is not None:
+            message[key] = val
+
+    if sort is None:
+        sort = 'time_sub'
+    if sort.lstrip('-') not in LISTING_SORT_KEYS:
+        raise ValueError(
+            'sort must be one of %s' % ', '.join(LISTING_SORT_KEYS)
+        )
+    key = get_listing_sort_key(sort.lstrip('-'))
+    reverse = sort.startswith('-')
+
+    records = {}
+    try:
+        for updates in subscribe(port, message):
+            if isinstance(updates, dict):
+                # the current state
+                records = {r['pid']: r for r in updates['jobs']}
+                updates = []
+
+            for update in updates:
+                for pid in update.get('removed', []):
+                    records.pop(pid, None)
+                for r in update.get('jobs', []):
+                    records[r['pid']] = r
+
+            # shown even without changes, as the times in it change
+            entries = sorted(records.values(), key=key, reverse=reverse)
+            if limit is not None:
+                entries = entries[:limit]
+
+            counts = _count_jobs(records.values())
+            lines = get_job_lines(
+                make_job_listing(entries, user=user, counts=counts),
+                user=user,
+            )
+
+            clear_screen(stream)
+            stream.write('\n'.join(lines) + '\n')
+            stream.flush()
+    except EOFError:
+        print('lost connection to the server', file=sys.stderr)
+        sys.exit(1)
+
+
+def make_job_listing(records, user=None, counts=None):
+    """
+    make the job listing from the entries sent by the server
+
+    Parameters
+    ----------
+    records: list
+        The entries for the jobs, as sent by the server for ls
+    user: list, optional
+        Only list jobs for these users
+    counts: dict, optional
+        The numbers of jobs selected, running and waiting, as sent by the
+        server; by default they are counted from the records
+
+    Returns
+    -------
+    listing: dict
+        With the 'entries', the format 'fmt' for the entries and its
+        'footer', and the numbers of jobs in njobs, nrun and nwait
+    """
+    import time
 
     names = ['pid', 'user', 'st', 'pri', 'nc',
              'nh', 'host0', 'Tq', 'Trun', 'cmd']
@@ -110,12 +301,17 @@ def get_job_listing(port=DEFAULT_PORT, full=False, user=None):
     entries = []
 
     timenow = time.time()
-    for r in resp['response']:
+    for r in records:
         if 'user' not in r:
             continue
 
+        # older servers send every job
         if user is None or r['user'] in user:
-            if r['status'] == 'run':
+            if 'array' in r:
+                # the elements of arrays are counted as jobs
+                nrun += r['array']['run']
+                nwait += r['array']['wait']
+            elif r['status'] == 'run':
                 nrun += 1
             else:
                 nwait += 1
@@ -136,15 +332,17 @@ def get_job_listing(port=DEFAULT_PORT, full=False, user=None):
             # this is the first host on the list
             this['host0'] = _extract_host0(r)
 
-            # for sorting
-            this['time_sub'] = r['time_sub']
-
             for k in this:
                 if k in lens:
                     lens[k] = max(lens[k], len(('%s' % this[k])))
 
             entries.append(this)
 
+    if counts is not None:
+        # counts of all the jobs selected, not just those listed
+        nrun = counts['nrun']
+        nwait = counts['nwait']
+
     fmt = []
     for k in names:
         if k in ['Tq', 'Trun']:
@@ -174,6 +372,50 @@ def get_job_listing(port=DEFAULT_PORT, full=False, user=None):
     }
 
 
+def _count_jobs(records):
+    """
+    count the running and waiting jobs in the listing entries, including
+    the elements of arrays
+    """
+    nrun = 0
+    nwait = 0
+    for r in records:
+        if 'array' in r:
+            nrun += r['array']['run']
+            nwait += r['array']['wait']
+        elif r['status'] == 'run':
+            nrun += 1
+        else:
+            nwait += 1
+
+    return {'njobs': nrun + nwait, 'nrun': nrun, 'nwait': nwait}
+
+
+def get_listing_sort_key(field):
+    """
+    get a function giving the key by which to sort listing entries on the
+    field.  Entries without a value, such as the time_run of a waiting job,
+    come last, priorities are in order of PRIORITY_LIST, and ties are broken
+    by pid.  The keys are also the cursors for paging through listings
+    """
+    def key(r):
+        val = r.get(field)
+        if field == 'priority' and val in PRIORITY_LIST:
+            val = PRIORITY_LIST.index(val)
+        return (val is None, 0 if val is None else val, r['pid'])
+
+    return key
+
+
+def _split_option(val):
+    """
+    split a comma separated option value into a list; None stays None
+    """
+    if val is None:
+        return None
+    return val.split(',')
+
+
 def _extract_status(r):
     if r['status'] == 'run':
         return 'R'
@@ -194,6 +436,10 @@ def _extract_command(r):
     # remove spaces from name so we can use awk on
     # the output of wq ls
     c = '-'.join(str(c).split())
+
+    if 'array' in r:
+        # the elements still to finish, e.g. name[4r,9990w]
+        c += '[%(run)dr,%(wait)dw]' % r['array']
     return c
 
 
@@ -0,0 +1,242 @@
+"""
+Append-only journal of the job queue.
+
+Rather than writing a file for each job on every change of state, the server
+appends a short record to a single journal file
+
+    {"op": "submit", "job": {...}}               a job entered the queue
+    {"op": "update", "pid": ..., "status": ...}  a job changed, e.g. started
+                                                 running
+    {"op": "done", "pid": ...}                   a job left the queue
+
+one JSON document per line.  From time to time the jobs in the queue are
+written to a snapshot and the journal is started afresh, so the journal
+only holds the changes since the last snapshot.  The state is recovered by
+loading the snapshot and replaying the journal.
+
+The snapshot is a line naming the format and its version, followed by the
+list of jobs as a single JSON document, so it can be read by any version of
+Python.  Snapshots written by older versions of wq, marshal dumps of the
+list, are still read.  A snapshot that cannot be read is an error, rather
+than starting with an empty queue that the next snapshot would make
+permanent.
+
+A journal cut short by a crash can end in a partial line.  It is ignored,
+and cut off the file so that the next record appended starts on a line of
+its own.
+
+Appended records are buffered until sync is called, normally once for all
+the changes made in one pass of the server loop; see wq.persist.
+"""
+import os
+import json
+import marshal
+import logging
+from .persist import write_atomic, check_durability, DEFAULT_DURABILITY
+
+JOURNAL_NAME = 'queue.journal'
+SNAPSHOT_NAME = 'queue.snapshot'
+
+# the first line of a snapshot
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = b'wq-snapshot %d\n' % SNAPSHOT_VERSION
+
+# compact once the journal has this many records, or twice the number of
+# jobs in the queue if that is larger
+COMPACT_MIN_RECORDS = 10000
+
+logger = logging.getLogger('Server')
+
+
+class SnapshotError(Exception):
+    """
+    The snapshot could not be read
+    """
+
+
+class Journal(object):
+    """
+    The journal and snapshot in the spool directory
+
+    Parameters
+    ----------
+    spool_dir: str
+        The directory for the journal and snapshot
+    durability: str, optional
+        One of 'none', 'batch' or 'always'.  With 'always' each record is
+        synced to disk as it is appended, otherwise when sync is called.
+    """
+    def __init__(self, spool_dir, durability=DEFAULT_DURABILITY):
+        check_durability(durability)
+        self.durability = durability
+        self.spool_dir = spool_dir
+        self.journal_fname = os.path.join(spool_dir, JOURNAL_NAME)
+        self.snapshot_fname = os.path.join(spool_dir, SNAPSHOT_NAME)
+
+        self._fobj = None
+        self.nrecords = 0
+
+    def exists(self):
+        """
+        True if there is a snapshot or journal to load
+        """
+        return (
+            os.path.exists(self.snapshot_fname)
+            or os.path.exists(self.journal_fname)
+        )
+
+    def load(self):
+        """
+        load the snapshot and replay the journal
+
+        Returns
+        -------
+        jobs: dict
+            The job records keyed by pid, in order of submission
+        """
+        jobs = {}
+
+        if os.path.exists(self.snapshot_fname):
+            for job in self._read_snapshot():
+                jobs[job['pid']] = job
+
+        self.nrecords = 0
+        if os.path.exists(self.journal_fname):
+            with open(self.journal_fname, 'rb') as fobj:
+                data = fobj.read()
+
+            end = data.rfind(b'\n') + 1
+            if end < len(data):
+                # the last record was only partly written; cut it off, so
+                # the next one appended is not written onto the end of it
+                logger.info(
+                    'ignoring partial journal record: %r' % data[end:]
+                )
+                with open(self.journal_fname, 'r+b') as fobj:
+                    fobj.truncate(end)
+
+            for line in data[:end].splitlines():
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.info(
+                        'ignoring bad journal record: %r' % line.strip()
+                    )
+                    continue
+
+                replay(jobs, record)
+                self.nrecords += 1
+
+        return jobs
+
+    def _read_snapshot(self):
+        """
+        read the list of jobs from the snapshot.  Raises SnapshotError if it
+        cannot be read
+        """
+        with open(self.snapshot_fname, 'rb') as fobj:
+            data = fobj.read()
+
+        try:
+            if data.startswith(SNAPSHOT_HEADER):
+                snapshot = json.loads(data[len(SNAPSHOT_HEADER):])
+            elif data.startswith(b'wq-snapshot '):
+                raise ValueError(
+                    'unsupported version %r' % data.split(b'\n', 1)[0]
+                )
+            else:
+                # written by an older version of wq
+                snapshot = marshal.loads(data)
+
+            if not isinstance(snapshot, list):
+                raise ValueError('expected a list of jobs')
+        except (EOFError, ValueError, TypeError) as err:
+            # the snapshot is replaced atomically, so this should not
+            # happen; the jobs are not in the journal, so we cannot go on
+            raise SnapshotError(
+                "could not load snapshot %s: '%s'" % (
+                    self.snapshot_fname, str(err),
+                )
+            )
+
+        return snapshot
+
+    def append(self, record):
+        """
+        append a record to the journal
+        """
+        if self._fobj is None:
+            self._fobj = open(self.journal_fname, 'a')
+
+        self._fobj.write(
+            json.dumps(record, separators=(',', ':'), default=str) + '\n'
+        )
+        self.nrecords += 1
+
+        if self.durability == 'always':
+            self.sync(fsync=True)
+
+    def sync(self, fsync=True):
+        """
+        write out the appended records, and make sure they are on disk if
+        fsync is True
+        """
+        if self._fobj is not None:
+            self._fobj.flush()
+            if fsync:
+                os.fsync(self._fobj.fileno())
+
+    def needs_compaction(self, njobs):
+        """
+        True if the journal has grown large compared to the queue
+        """
+        return self.nrecords > max(COMPACT_MIN_RECORDS, 2*njobs)
+
+    def snapshot(self, jobs):
+        """
+        write the jobs to the snapshot and start a new, empty journal
+
+        Parameters
+        ----------
+        jobs: sequence
+            The jobs in the queue, as dicts, in order of submission
+        """
+        snapshot = [dict(job) for job in jobs]
+        data = SNAPSHOT_HEADER + json.dumps(
+            snapshot, separators=(',', ':'), default=str,
+        ).encode('utf-8')
+
+        # the snapshot must be safe before the journal is emptied.  Should
+        # we crash in between, replaying the old journal on the new snapshot
+        # gives the same state
+        write_atomic(
+            self.snapshot_fname, data, sync=self.durability != 'none',
+        )
+
+        self.close()
+        with open(self.journal_fname, 'w'):
+            pass
+        self.nrecords = 0
+
+    def close(self):
+        if self._fobj is not None:
+            self._fobj.close()
+            self._fobj = None
+
+
+def replay(jobs, record):
+    """
+    apply a journal record to the job records, keyed by pid
+    """
+    op = record.get('op')
+    if op == 'submit':
+        job = record['job']
+        jobs[job['pid']] = job
+    elif op == 'done':
+        jobs.pop(record['pid'], None)
+    elif op is not None:
+        job = jobs.get(record['pid'])
+        if job is not None:
+            job.update(
+                (key, val) for key, val in record.items() if key != 'op'
+            )
@@ -0,0 +1,1011 @@
+"""
+Run many jobs from a single client process.
+
+Rather than starting one client per job, each submitting its own job and
+waiting for it, a Launcher submits jobs with sub_many requests and runs them
+as their owner: the server tells it over the same connection when each
+waiting job can run, it starts the job over ssh, and it tells the server
+when jobs are done, a batch at a time with notify_many.  The jobs are
+removed from the queue if the launcher exits.
+
+The launcher uses asyncio, so one process can supervise thousands of ssh
+sessions, rather than there being a blocked client process for each job.
+
+There are two ways to run a launcher
+
+    - In the background for a single submission, exiting once its jobs are
+      done.  This is what wq sub -b does when there is no launcher daemon.
+
+    - As a daemon for the user, started with wq launcher start.  While it
+      is running, wq sub -b hands the jobs to the daemon over a unix socket,
+      so all of the user's batch jobs share the one process.
+
+If the connection to the server is lost, for example because the server was
+restarted, the launcher reconnects and attaches to its jobs again; jobs
+that were removed meanwhile are killed.
+
+The log of each job is only opened to write to it, and is handed to the job
+when it starts, so the launcher does not hold a descriptor open for each
+job.
+
+A job can be an array, with elements for each index from array_start to
+array_stop.  The server tells the launcher as each element can run; %index%
+in the command is replaced by the index, and the output goes to a log for
+each element, e.g. job.yaml.5.wqlog for index 5.
+"""
+import os
+import sys
+import json
+import stat
+import struct
+import signal
+import socket
+import asyncio
+import tempfile
+import warnings
+import uuid
+import subprocess
+
+from .defaults import HOST, WAIT_SLEEP
+from .protocol import (
+    ProtocolError,
+    ENC_JSON,
+    HEADER_SIZE,
+    pack_frame,
+    unpack_header,
+    decode,
+    read_message,
+)
+from .util import socket_connect, raise_file_limit
+
+# collect finished jobs for this long before telling the server, so they
+# are reported together
+NOTIFY_DELAY = 0.05
+
+# wait this long between attempts to reconnect to the server
+RECONNECT_DELAY = WAIT_SLEEP
+
+
+def make_command_list(target_machine, command, require, rcdata,
+                      hostfile=None, cwd=None):
+    """
+    get the command to run the job on the target machine, as a list
+
+    The job is run in the working directory, after the 'precmd' from the wq
+    configuration if any.
+
+    Parameters
+    ----------
+    target_machine: str
+        The host to run on
+    command: str
+        The command line of the job
+    require: dict
+        The job requirements
+    rcdata: dict
+        The wq configuration, from ~/.wqrc
+    hostfile: str, optional
+        Name of the host file, which replaces %hostfile% in the command
+    cwd: str, optional
+        The working directory, by default the current one
+    """
+    # full command, we first change directory to CWD
+    pwd = cwd if cwd is not None else os.getcwd()
+    if 'precmd' in rcdata:
+        full_command = rcdata['precmd']+" ; "
+    else:
+        full_command = ""
+    full_command += 'cd '+pwd+'; '+command
+
+    # replace %hostfile% with actual hostfile
+    if hostfile:
+        full_command = full_command.replace('%hostfile%', hostfile)
+
+    if 'threads' in require:
+        full_command = full_command.replace(
+            '%threads%',
+            str(require['threads']),
+        )
+
+    if target_machine == 'localhost':
+        shell = os.environ['SHELL']
+        cmdlist = [shell, '-c', command]
+    else:
+        # first, force pseudo tty; this is key to make sure command
+        # dies if this client dies
+        # also -A forwards ssh agent
+        cmdlist = ['ssh', '-t', '-t', '-A']
+
+        # should we forward X? default is no no.  This is in the
+        # requirements as
+        #   X: true or X: 1 for yes (anything evaluates as True in python)
+        #   X: false or X: 0 for no
+
+        xforward = require.get('X', False)
+        if xforward:
+            cmdlist.append('-X')
+        else:
+            cmdlist.append('-x')
+
+        cmdlist.append(target_machine)
+        cmdlist.append(full_command)
+
+    return cmdlist
+
+
+def prepare_hostlist(hostlist, require, stream=None):
+    """
+    get the list of hosts for the host file; with threads > 1, each host
+    appears once for each group of that many cores
+    """
+    if stream is None:
+        stream = sys.stdout
+
+    if 'threads' in require:
+        th = require['threads']
+        if th <= 0:
+            print('Bad value for threads %s. Ignoring.' % th, file=stream)
+
+        elif th > 1:
+            dct = {}
+            for h in hostlist:
+                if h in dct:
+                    dct[h] += 1
+                else:
+                    dct[h] = 1
+
+            nhostlist = []
+            for h in dct:
+                n = dct[h]
+                if n % th != 0:
+                    print('Host', h, 'has',
+                          n % th, 'dangling cores. Ignoring.', file=stream)
+
+                for i in range(n//th):
+                    nhostlist.append(h)
+
+            hostlist = nhostlist
+
+    return hostlist
+
+
+def get_hostfile_name(require):
+    """
+    get the name of the host file requested in the requirements, or None
+    """
+    if 'host_file' in require:
+        hostfile = require['host_file']
+    elif 'hostfile' in require:
+        hostfile = require['hostfile']
+    else:
+        return None
+
+    if hostfile == 'auto':
+        hostfile = str(uuid.uuid4())[:8]+'.hostfile'
+
+    return hostfile
+
+
+def write_hostfile(hostfile, hosts, require, stream=None):
+    with open(hostfile, 'w') as fobj:
+        for h in prepare_hostlist(hosts, require, stream=stream):
+            fobj.write(h+'\n')
+
+
+def remove_hostfile(hostfile):
+    if hostfile is not None:
+        try:
+            os.remove(hostfile)
+        except FileNotFoundError:
+            pass
+
+
+def get_socket_path(port):
+    """
+    get the path of the unix socket of the user's launcher daemon for the
+    server on the given port
+    """
+    dirname = os.path.join(tempfile.gettempdir(), 'wq-%d' % os.getuid())
+    return os.path.join(dirname, 'launcher-%d.sock' % port)
+
+
+def check_socket_dir(dirname):
+    """
+    make sure the directory of the daemon's socket is ours alone, so that
+    no one else can put a socket there to take our jobs.  Raises
+    RuntimeError if it is not
+    """
+    st = os.lstat(dirname)
+    if (not stat.S_ISDIR(st.st_mode)
+            or st.st_uid != os.getuid()
+            or stat.S_IMODE(st.st_mode) != 0o700):
+        raise RuntimeError(
+            '%s is not a directory owned by you with mode 0700; '
+            'remove it and try again' % dirname
+        )
+
+
+def send_to_daemon(port, message):
+    """
+    send a message to the user's launcher daemon and return the reply, or
+    None if no daemon is running.  Raises RuntimeError if the daemon
+    replied with an error
+    """
+    path = get_socket_path(port)
+    try:
+        check_socket_dir(os.path.dirname(path))
+    except FileNotFoundError:
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+        except OSError:
+            return None
+
+        sock.sendall(pack_frame(message, encoding=ENC_JSON))
+        reply, frame = read_message(sock)
+    finally:
+        sock.close()
+
+    if reply is None:
+        raise RuntimeError('launcher daemon closed the connection')
+    if 'error' in reply:
+        raise RuntimeError(reply['error'])
+
+    return reply
+
+
+def submit_jobs(port, jobs, rcdata=None):
+    """
+    submit jobs to run in the background: by the user's launcher daemon if
+    it is running, otherwise by a new launcher just for these jobs
+
+    Parameters
+    ----------
+    port: int
+        The port of the server
+    jobs: list
+        The jobs; see Launcher.submit
+    rcdata: dict, optional
+        The wq configuration, from ~/.wqrc
+
+    Returns
+    -------
+    response: dict
+        The server response, with an entry in 'jobs' for each job
+
+    Raises RuntimeError if the submission failed
+    """
+    cwd = os.getcwd()
+    for job in jobs:
+        job['log'] = os.path.abspath(job['log'])
+
+    response = send_to_daemon(port, {
+        'command': 'sub_many',
+        'jobs': jobs,
+        'cwd': cwd,
+        'rcdata': rcdata,
+    })
+    if response is None:
+        response = Launcher(port).launch(jobs, cwd=cwd, rcdata=rcdata)
+
+    return response
+
+
+def start_daemon(port):
+    """
+    start the user's launcher daemon in the background.  Returns its pid.
+    Raises RuntimeError if the directory for its socket is not safe to use
+    """
+    dirname = os.path.dirname(get_socket_path(port))
+    os.makedirs(dirname, mode=0o700, exist_ok=True)
+    check_socket_dir(dirname)
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            _detach()
+            Launcher(port, daemon=True).serve()
+        finally:
+            os._exit(0)
+
+    return pid
+
+
+class ServerLink(object):
+    """
+    A connection to the server for use with asyncio
+
+    Requests are tagged, so many can be outstanding at once.  Messages
+    pushed by the server are passed to on_push
+
+    Parameters
+    ----------
+    port: int
+        The port of the server
+    on_push: callable
+        Called with each message pushed by the server
+    """
+    def __init__(self, port, on_push):
+        self.port = port
+        self.on_push = on_push
+
+        self.writer = None
+
+        # done when the connection is lost
+        self.lost = None
+
+        self._tag = 0
+        self._replies = {}
+
+    @property
+    def connected(self):
+        return self.writer is not None
+
+    async def connect(self):
+        """
+        connect to the server.  Raises OSError if that fails
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            socket_connect(sock, (HOST, self.port), crash_on_timeout=True)
+        except OSError:
+            sock.close()
+            raise
+
+        reader, self.writer = await asyncio.open_connection(sock=sock)
+        self.lost = asyncio.get_running_loop().create_future()
+        asyncio.ensure_future(self._read(reader))
+
+    async def request(self, message):
+        """
+        send the message and wait for the reply.  Raises EOFError if the
+        connection is lost
+        """
+        if self.writer is None:
+            raise EOFError('not connected to the server')
+
+        self._tag = self._tag % 0xffffffff + 1
+        tag = self._tag
+
+        reply = asyncio.get_running_loop().create_future()
+        self._replies[tag] = reply
+
+        self.writer.write(pack_frame(message, encoding=ENC_JSON, tag=tag))
+        try:
+            await self.writer.drain()
+        except OSError as err:
+            self._closed()
+            raise EOFError(str(err))
+
+        return await reply
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self._closed()
+
+    async def _read(self, reader):
+        try:
+            while True:
+                try:
+                    message, frame = await _read_frame(reader)
+                except (OSError, ProtocolError):
+                    break
+
+                if frame is None:
+                    break
+
+                if frame['tag'] == 0:
+                    self.on_push(message)
+                else:
+                    reply = self._replies.pop(frame['tag'], None)
+                    if reply is not None and not reply.done():
+                        reply.set_result(message)
+        finally:
+            self._closed()
+
+    def _closed(self):
+        self.writer = None
+
+        replies = self._replies
+        self._replies = {}
+        for reply in replies.values():
+            if not reply.done():
+                reply.set_exception(EOFError('connection to server lost'))
+
+        if self.lost is not None and not self.lost.done():
+            self.lost.set_result(True)
+
+
+class Launcher(object):
+    """
+    Submit jobs and run them as the server allows
+
+    Parameters
+    ----------
+    port: int
+        The port of the server
+    daemon: bool, optional
+        If True, keep running when there are no jobs, taking submissions on
+        a unix socket; see get_socket_path
+    """
+    def __init__(self, port, daemon=False):
+        self.port = port
+        self.daemon = daemon
+
+        self.link = ServerLink(port, self.process_pushed)
+
+        # keyed by the id given by the server.  An array stays in waiting
+        # until its last element has started
+        self.waiting = {}
+        self.running = {}
+
+        # ids of finished jobs to tell the server about
+        self.done = []
+
+        # tasks running the jobs, including killed jobs yet to exit
+        self.tasks = set()
+
+        self._have_done = None
+        self._stopped = None
+
+    def launch(self, jobs, cwd=None, rcdata=None):
+        """
+        start a launcher in the background for these jobs.  It submits the
+        jobs, runs them, and exits once they are done.  Returns the response
+        to the submission once it is made
+
+        Returns
+        -------
+        response: dict
+            The server response, with an entry in 'jobs' for each job
+
+        Raises RuntimeError if the submission failed
+        """
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(rfd)
+                _detach()
+                asyncio.run(self._run_once(jobs, cwd, rcdata, wfd))
+            finally:
+                os._exit(0)
+
+        os.close(wfd)
+        with os.fdopen(rfd) as fobj:
+            data = fobj.read()
+
+        if not data:
+            raise RuntimeError('launcher exited without submitting')
+
+        response = json.loads(data)
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+
+        return response
+
+    def serve(self):
+        """
+        run as the user's daemon until told to stop
+        """
+        asyncio.run(self._serve())
+
+    async def submit(self, jobs, cwd=None, rcdata=None):
+        """
+        submit the jobs in one request, and start those that can run
+
+        Parameters
+        ----------
+        jobs: list
+            The jobs, each a dict with the 'commandline', the 'require'ments,
+            and the 'log' file to which the output of the job is written.
+            For an array, 'array' holds the first and last index
+        cwd: str, optional
+            The working directory for the jobs, by default the current one
+        rcdata: dict, optional
+            The wq configuration, from ~/.wqrc
+
+        Returns
+        -------
+        response: dict
+            The server response, with an entry in 'jobs' for each job
+        """
+        for job in jobs:
+            try:
+                # start the log afresh
+                open(job['log'], 'w').close()
+            except OSError as err:
+                return {'error': 'could not write log: %s' % err}
+
+        if not self.link.connected:
+            await self.link.connect()
+
+        sjobs = []
+        for job in jobs:
+            jobdata = {
+                'commandline': job['commandline'],
+                'require': job['require'],
+            }
+            if 'array' in job:
+                jobdata['array_start'], jobdata['array_stop'] = job['array']
+            sjobs.append(jobdata)
+
+        response = await self.link.request({
+            'command': 'sub_many',
+            'owner': os.getpid(),
+            'user': os.environ['USER'],
+            'push': True,
+            'jobs': sjobs,
+        })
+        if 'error' in response:
+            return response
+
+        for job, jres in zip(jobs, response['jobs']):
+            job['pid'] = jres['pid']
+            job['cwd'] = cwd if cwd is not None else os.getcwd()
+            job['rcdata'] = rcdata if rcdata is not None else {}
+            if jres['status'] == 'nevermatch':
+                self._log(job, 'Error reported by server: %s' % jres['reason'])
+                continue
+
+            if 'array' in job:
+                self.waiting[job['pid']] = job
+                self.start_elements(job, jres['elements'])
+                if jres['status'] == 'wait':
+                    self._log(job, 'waiting: %s' % jres['reason'])
+            elif jres['status'] == 'run':
+                self.start(job, jres['hosts'])
+            else:
+                self._log(job, 'waiting: %s' % jres['reason'])
+                self.waiting[job['pid']] = job
+
+        self._check_finished()
+        return response
+
+    def process_pushed(self, message):
+        """
+        the server told us a job can run, or that it was removed
+        """
+        pid = message.get('pid')
+        if message.get('command') == 'kill':
+            self.kill(pid)
+        elif message.get('response') != 'run':
+            return
+        elif 'array' in message:
+            array = self.waiting.get(message['array'])
+            if array is not None:
+                self.start_elements(array, [message])
+        elif pid in self.waiting:
+            self.start(self.waiting.pop(pid), message['hosts'])
+
+    def start_elements(self, array, elements):
+        """
+        start the elements of the array that can run, as sent by the server
+        with their 'pid', 'index' and 'hosts'.  Once the last has started,
+        the array is no longer waiting
+        """
+        stop = array['array'][1]
+        for eres in elements:
+            if eres['pid'] in self.running:
+                continue
+
+            index = eres['index']
+            root, ext = os.path.splitext(array['log'])
+            element = {
+                'pid': eres['pid'],
+                'commandline': array['commandline'].replace(
+                    '%index%', str(index),
+                ),
+                'require': array['require'],
+                'log': '%s.%d%s' % (root, index, ext),
+                'cwd': array['cwd'],
+                'rcdata': array['rcdata'],
+                'new_log': True,
+            }
+            self.start(element, eres['hosts'])
+
+            if index == stop:
+                self.waiting.pop(array['pid'], None)
+
+    def start(self, job, hosts):
+        """
+        start running the job on the hosts
+        """
+        self.running[job['pid']] = job
+
+        task = asyncio.ensure_future(self._run_job(job, hosts))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def kill(self, pid):
+        """
+        the job was removed from the queue; kill it if it is running
+        """
+        job = self.waiting.pop(pid, None)
+        if job is not None:
+            self._log(job, 'job removed from the queue')
+        else:
+            job = self.running.pop(pid, None)
+            if job is None:
+                return
+
+            self._log(job, 'job removed from the queue')
+            job['killed'] = True
+            if 'process' in job:
+                _terminate(job['process'])
+
+        self._check_finished()
+
+    def stop(self):
+        """
+        kill all the jobs and stop
+        """
+        for pid in list(self.running) + list(self.waiting):
+            self.kill(pid)
+
+        if self._stopped is not None and not self._stopped.done():
+            self._stopped.set_result(True)
+
+    async def _run_once(self, jobs, cwd, rcdata, wfd):
+        """
+        submit the jobs, report the response to the parent over the pipe,
+        and run the jobs until they are done
+        """
+        self._setup()
+
+        try:
+            response = await self.submit(jobs, cwd=cwd, rcdata=rcdata)
+        except Exception as err:
+            response = {'error': str(err)}
+
+        with os.fdopen(wfd, 'w') as fobj:
+            fobj.write(json.dumps(response))
+
+        if 'error' not in response:
+            self._check_finished()
+            await self._stopped
+
+        await self._finish()
+
+    async def _serve(self):
+        """
+        take submissions on the unix socket until told to stop
+        """
+        self._setup()
+
+        path = get_socket_path(self.port)
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        check_socket_dir(os.path.dirname(path))
+        if os.path.exists(path):
+            os.remove(path)
+
+        server = await asyncio.start_unix_server(self._serve_client, path)
+        try:
+            await self._stopped
+        finally:
+            server.close()
+            os.remove(path)
+            await self._finish()
+
+    async def _serve_client(self, reader, writer):
+        """
+        deal with the requests of a client of the daemon
+        """
+        if not _is_own_peer(writer.get_extra_info('socket')):
+            writer.close()
+            return
+
+        try:
+            while True:
+                message, frame = await _read_frame(reader)
+                if frame is None:
+                    break
+
+                command = message.get('command')
+                if command == 'sub_many':
+                    try:
+                        reply = await self.submit(
+                            message['jobs'],
+                            cwd=message.get('cwd'),
+                            rcdata=message.get('rcdata'),
+                        )
+                    except (OSError, EOFError) as err:
+                        reply = {'error': 'could not reach server: %s' % err}
+                elif command == 'status':
+                    reply = {
+                        'response': 'OK',
+                        'pid': os.getpid(),
+                        'connected': self.link.connected,
+                        'waiting': len(self.waiting),
+                        'running': len(self.running),
+                    }
+                elif command == 'stop':
+                    reply = {'response': 'OK'}
+                    self.stop()
+                else:
+                    reply = {'error': "unknown command '%s'" % command}
+
+                writer.write(pack_frame(reply, encoding=ENC_JSON))
+                await writer.drain()
+        except (OSError, ProtocolError):
+            pass
+        finally:
+            writer.close()
+
+    def _setup(self):
+        loop = asyncio.get_running_loop()
+        _use_pidfd_watcher(loop)
+        raise_file_limit()
+
+        self._have_done = asyncio.Event()
+        self._stopped = loop.create_future()
+
+        loop.add_signal_handler(signal.SIGTERM, self.stop)
+        loop.add_signal_handler(signal.SIGINT, self.stop)
+
+        asyncio.ensure_future(self._notify())
+        asyncio.ensure_future(self._keep_connected())
+
+    async def _finish(self):
+        """
+        wait for killed jobs to exit, tell the server about any that are
+        done, and disconnect
+        """
+        if self.tasks:
+            await asyncio.wait(list(self.tasks))
+
+        if self.done and self.link.connected:
+            try:
+                await self._send_done()
+            except EOFError:
+                pass
+
+        self.link.close()
+
+    async def _run_job(self, job, hosts):
+        """
+        run the job, then add it to those to report as done.  A job that
+        could not be started is reported as done too, so the server frees
+        its cores
+        """
+        require = job['require']
+        hostfile = get_hostfile_name(require)
+        if hostfile is not None:
+            hostfile = os.path.join(job['cwd'], hostfile)
+
+        target = hosts[0]
+        cmdlist = make_command_list(
+            target, job['commandline'], require, job['rcdata'],
+            hostfile=hostfile, cwd=job['cwd'],
+        )
+        try:
+            if job.pop('new_log', False):
+                # an element of an array, with a log of its own
+                open(job['log'], 'w').close()
+
+            if hostfile is not None:
+                with open(job['log'], 'a') as fobj:
+                    write_hostfile(hostfile, hosts, require, stream=fobj)
+
+            self._log(job, job['commandline'])
+            self._log(
+                job,
+                'executing on host: %s with pid: %s' % (target, job['pid']),
+            )
+
+            if not job.get('killed', False):
+                # the job has the log as its output; we don't keep it open
+                with open(job['log'], 'a') as fobj:
+                    job['process'] = await asyncio.create_subprocess_exec(
+                        *cmdlist,
+                        stdin=subprocess.DEVNULL,
+                        stdout=fobj,
+                        stderr=subprocess.STDOUT,
+                        cwd=job['cwd'],
+                    )
+                if job.get('killed', False):
+                    _terminate(job['process'])
+                await job['process'].wait()
+        except OSError as err:
+            self._log(job, 'could not start job: %s' % err)
+        finally:
+            remove_hostfile(hostfile)
+
+        if not job.get('killed', False):
+            del self.running[job['pid']]
+            self.done.append(job['pid'])
+            self._have_done.set()
+
+    async def _notify(self):
+        """
+        tell the server which jobs are done, in batches
+        """
+        while True:
+            await self._have_done.wait()
+            await asyncio.sleep(NOTIFY_DELAY)
+            self._have_done.clear()
+
+            try:
+                await self._send_done()
+            except EOFError:
+                # they are sent once we reconnect
+                continue
+
+            self._check_finished()
+
+    async def _send_done(self):
+        done = self.done
+        self.done = []
+        try:
+            await self.link.request({
+                'command': 'notify_many',
+                'notification': 'done',
+                'pids': done,
+            })
+        except EOFError:
+            self.done = done + self.done
+            raise
+
+    async def _keep_connected(self):
+        """
+        reconnect when the connection to the server is lost, and attach to
+        our jobs again
+        """
+        while True:
+            if self.link.lost is None:
+                # not yet connected
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+
+            await self.link.lost
+            while True:
+                await asyncio.sleep(RECONNECT_DELAY)
+                try:
+                    await self.link.connect()
+                    await self._attach()
+                    break
+                except (OSError, EOFError):
+                    self.link.close()
+
+    async def _attach(self):
+        """
+        tell the server we are again the owner of our jobs, start those that
+        can now run and kill those that were removed
+        """
+        response = await self.link.request({
+            'command': 'attach',
+            'owner': os.getpid(),
+            'push': True,
+        })
+        if 'error' in response:
+            return
+
+        jobs = {jres['pid']: jres for jres in response['jobs']}
+
+        for pid in list(self.running):
+            if pid not in jobs:
+                self.kill(pid)
+
+        for pid in list(self.waiting):
+            if pid not in jobs:
+                self.kill(pid)
+
+        for pid, jres in jobs.items():
+            if jres['status'] != 'run' or pid in self.running:
+                continue
+
+            if 'array' in jres:
+                array = self.waiting.get(jres['array'])
+                if array is not None:
+                    self.start_elements(array, [jres])
+            elif pid in self.waiting and 'array' not in self.waiting[pid]:
+                self.start(self.waiting.pop(pid), jres['hosts'])
+
+        if self.done:
+            self._have_done.set()
+
+    def _check_finished(self):
+        """
+        a launcher for a single submission stops once it has nothing to do
+        """
+        if (not self.daemon
+                and not self.waiting
+                and not self.running
+                and not self.done
+                and self._stopped is not None
+                and not self._stopped.done()):
+            self._stopped.set_result(True)
+
+    def _log(self, job, text):
+        try:
+            with open(job['log'], 'a') as fobj:
+                fobj.write(text+'\n')
+        except OSError:
+            # there is nowhere else to say so
+            pass
+
+
+async def _read_frame(reader):
+    """
+    read a framed message from the stream, returning (None, None) at the end
+    """
+    try:
+        header = await reader.readexactly(HEADER_SIZE)
+    except asyncio.IncompleteReadError as err:
+        if err.partial:
+            raise ProtocolError('connection closed within a frame header')
+        return None, None
+
+    frame = unpack_header(header)
+    try:
+        body = await reader.readexactly(frame['length'])
+    except asyncio.IncompleteReadError:
+        raise ProtocolError('connection closed within a frame')
+
+    return decode(body, frame['encoding']), frame
+
+
+def _use_pidfd_watcher(loop):
+    """
+    where the system supports it, wait for children with pidfds in the event
+    loop, rather than with a thread for each child.  From python 3.12 this
+    is the default
+    """
+    if sys.version_info >= (3, 12) or not hasattr(os, 'pidfd_open'):
+        return
+
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+    except OSError:
+        return
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', DeprecationWarning)
+        watcher = asyncio.PidfdChildWatcher()
+        watcher.attach_loop(loop)
+        asyncio.set_child_watcher(watcher)
+
+
+def _is_own_peer(sock):
+    """
+    True if the process at the other end of the unix socket is run by us.
+    Where the credentials cannot be checked, we rely on the permissions of
+    the directory of the socket
+    """
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return True
+
+    creds = sock.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'),
+    )
+    pid, uid, gid = struct.unpack('3i', creds)
+    return uid == os.getuid()
+
+
+def _detach():
+    """
+    detach from the terminal
+    """
+    os.setsid()
+
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    os.close(devnull)
+
+
+def _terminate(process):
+    try:
+        process.terminate()
+    except OSError:
+        pass
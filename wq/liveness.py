@@ -0,0 +1,101 @@
+"""
+Tell whether the processes that submitted jobs are still alive.
+
+Two mechanisms are provided
+
+    - get_live_pids takes a single snapshot of the process table, so that
+      checking every job in the queue costs one directory listing rather
+      than one stat per job.
+
+    - watch_pid opens a pidfd for the process (Linux 5.3 and later).  The
+      descriptor becomes readable when the process exits, so it can be
+      registered with the server's selector and the exit handled right away
+      rather than on the next refresh.
+"""
+import os
+
+PROC_DIR = '/proc'
+
+
+def get_live_pids(proc_dir=PROC_DIR):
+    """
+    get the set of pids of all processes, or None if the process table
+    is not available as a directory
+    """
+    try:
+        names = os.listdir(proc_dir)
+    except OSError:
+        return None
+
+    return set(int(name) for name in names if name.isdigit())
+
+
+def pid_exists(pid):
+    """
+    check for the existence of a unix pid, for systems without a /proc
+    """
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # exists but is owned by someone else
+        return True
+    except (OSError, ValueError, TypeError, OverflowError):
+        return False
+
+    return True
+
+
+class PidWatch(object):
+    """
+    A pidfd for a process; the descriptor becomes readable when the
+    process exits
+
+    Parameters
+    ----------
+    pid: int
+        The process id
+    fd: int
+        The pidfd
+    """
+    __slots__ = ('pid', 'fd')
+
+    def __init__(self, pid, fd):
+        self.pid = pid
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def watch_pid(pid):
+    """
+    open a pidfd for the process
+
+    Returns
+    -------
+    watch: PidWatch or None
+        None if pidfds are not supported here or could not be opened, in
+        which case the process must be checked by other means
+
+    Raises
+    ------
+    ProcessLookupError if there is no such process
+    """
+    if not hasattr(os, 'pidfd_open'):
+        return None
+
+    try:
+        fd = os.pidfd_open(int(pid))
+    except ProcessLookupError:
+        raise
+    except (OSError, ValueError, TypeError, OverflowError):
+        return None
+
+    return PidWatch(pid, fd)
@@ -0,0 +1,302 @@
+"""
+Metrics kept by the server, written in the Prometheus text format
+
+    https://prometheus.io/docs/instrumenting/exposition_formats/
+
+They are sent in reply to the metrics command, as shown by wq metrics, and
+can also be served over HTTP for Prometheus to scrape; see the
+--metrics-port option of wq serve.
+
+The metrics are only updated by the thread running the server loop, so
+there is no locking.
+"""
+
+# buckets for the time taken by the server, in seconds
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+# buckets for the time jobs wait before they run, in seconds
+WAIT_BUCKETS = (
+    1, 10, 60, 300, 900, 1800, 3600, 3*3600, 6*3600, 12*3600, 24*3600,
+    3*24*3600, 7*24*3600,
+)
+
+# buckets for the number of jobs looked at or started in a pass of the
+# scheduler
+JOB_COUNT_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+
+class Metric(object):
+    """
+    A metric, with a value for each combination of the values of its labels
+
+    Parameters
+    ----------
+    name: string
+        The name of the metric
+    help: string
+        The description of the metric
+    labels: sequence, optional
+        The names of the labels
+    """
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def clear(self):
+        """
+        forget the values for all labels
+        """
+        self.values.clear()
+
+    def render(self):
+        """
+        get the lines for this metric in the text format
+        """
+        lines = [
+            '# HELP %s %s' % (self.name, _escape_help(self.help)),
+            '# TYPE %s %s' % (self.name, self.type),
+        ]
+        for labels in sorted(self.values):
+            lines += self._render_value(labels, self.values[labels])
+
+        return lines
+
+    def _render_value(self, labels, value):
+        return [
+            '%s%s %s' % (
+                self.name,
+                _format_labels(self.labels, labels),
+                _format_value(value),
+            )
+        ]
+
+    def _get_labels(self, labels):
+        labels = tuple(str(label) for label in labels)
+        if len(labels) != len(self.labels):
+            raise ValueError(
+                '%s needs labels %s' % (self.name, ', '.join(self.labels))
+            )
+        return labels
+
+
+class Counter(Metric):
+    """
+    A count that only goes up, e.g. the number of requests
+    """
+    type = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        """
+        add the amount to the count for the label values
+        """
+        labels = self._get_labels(labels)
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that can go up and down, e.g. the number of jobs waiting
+    """
+    type = 'gauge'
+
+    def set(self, value, labels=()):
+        """
+        set the value for the label values
+        """
+        self.values[self._get_labels(labels)] = value
+
+
+class Histogram(Metric):
+    """
+    Counts of the values seen, e.g. the time taken by requests, in buckets
+    by the upper bound of the value, along with their number and sum
+
+    Parameters
+    ----------
+    name: string
+        The name of the metric
+    help: string
+        The description of the metric
+    labels: sequence, optional
+        The names of the labels
+    buckets: sequence
+        The upper bounds of the buckets, in increasing order
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels=labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        """
+        count the value for the label values
+        """
+        labels = self._get_labels(labels)
+        counts = self.values.get(labels)
+        if counts is None:
+            # one per bucket, then the count and the sum
+            counts = [0] * (len(self.buckets) + 2)
+            self.values[labels] = counts
+
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+
+        counts[-2] += 1
+        counts[-1] += value
+
+    def _render_value(self, labels, counts):
+        lines = []
+        names = self.labels + ('le',)
+        total = 0
+        for bound, count in zip(self.buckets, counts):
+            total += count
+            lines.append('%s_bucket%s %d' % (
+                self.name,
+                _format_labels(names, labels + (_format_value(bound),)),
+                total,
+            ))
+
+        label_text = _format_labels(self.labels, labels)
+        lines += [
+            '%s_bucket%s %d' % (
+                self.name, _format_labels(names, labels + ('+Inf',)),
+                counts[-2],
+            ),
+            '%s_sum%s %s' % (self.name, label_text, _format_value(counts[-1])),
+            '%s_count%s %d' % (self.name, label_text, counts[-2]),
+        ]
+        return lines
+
+
+class Metrics(object):
+    """
+    The metrics of the server
+
+    The counters and histograms are updated as things happen.  The gauges,
+    jobs and cores, are set from the state of the queue when the metrics
+    are rendered.
+    """
+    def __init__(self):
+        self.requests = Counter(
+            'wq_requests_total',
+            'Requests processed, by command.',
+            labels=['command'],
+        )
+        self.request_seconds = Histogram(
+            'wq_request_seconds',
+            'Time taken to process requests, by command.  For read only '
+            'commands this includes waiting for a reader thread and '
+            'encoding the reply.',
+            labels=['command'],
+        )
+        self.encode_seconds = Histogram(
+            'wq_encode_seconds',
+            'Time taken to encode replies, by command.',
+            labels=['command'],
+        )
+        self.commit_seconds = Histogram(
+            'wq_commit_seconds',
+            'Time taken to commit the changes made in a pass of the server '
+            'loop, before replies are sent.',
+        )
+        self.refresh_seconds = Histogram(
+            'wq_refresh_seconds',
+            'Time taken to refresh the queue, looking for jobs whose '
+            'process is gone and running the scheduler.',
+        )
+        self.schedule_seconds = Histogram(
+            'wq_schedule_seconds',
+            'Time taken by passes of the scheduler.',
+        )
+        self.schedule_examined = Histogram(
+            'wq_schedule_examined_jobs',
+            'Number of waiting jobs looked at in a pass of the scheduler.',
+            buckets=JOB_COUNT_BUCKETS,
+        )
+        self.schedule_started = Histogram(
+            'wq_schedule_started_jobs',
+            'Number of jobs started in a pass of the scheduler.',
+            buckets=JOB_COUNT_BUCKETS,
+        )
+        self.job_wait_seconds = Histogram(
+            'wq_job_wait_seconds',
+            'Time from submission until jobs started running, by priority.',
+            labels=['priority'],
+            buckets=WAIT_BUCKETS,
+        )
+        self.jobs = Gauge(
+            'wq_jobs',
+            'Jobs in the queue, by status and priority.',
+            labels=['status', 'priority'],
+        )
+        self.cores = Gauge(
+            'wq_cores',
+            'Cores in each group of nodes, used, free, or offline.  Nodes '
+            'in several groups are counted in each; group "" is the '
+            'whole cluster.',
+            labels=['group', 'state'],
+        )
+
+    def get_metrics(self):
+        """
+        get the list of all metrics
+        """
+        return [
+            self.requests,
+            self.request_seconds,
+            self.encode_seconds,
+            self.commit_seconds,
+            self.refresh_seconds,
+            self.schedule_seconds,
+            self.schedule_examined,
+            self.schedule_started,
+            self.job_wait_seconds,
+            self.jobs,
+            self.cores,
+        ]
+
+    def render(self):
+        """
+        get all the metrics in the text format
+        """
+        lines = []
+        for metric in self.get_metrics():
+            lines += metric.render()
+
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, _escape_label(value))
+        for name, value in zip(names, values)
+    )
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _escape_help(text):
+    return text.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def _escape_label(value):
+    return (
+        value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    )
@@ -0,0 +1,179 @@
+"""
+Crash safe writes of the server state.
+
+Files are written atomically: the data go to a temporary file in the same
+directory which is then renamed over the original, so a crash leaves either
+the old or the new version, never a truncated file.
+
+The Committer collects the writes made while handling requests and makes
+them durable together, so a burst of changes costs a few fsyncs rather than
+several per change.  How hard it tries is set by the durability
+
+    none    files are written at commit, but never synced to disk; a crash
+            of the machine can lose recent changes
+    batch   at commit, everything written since the last commit is synced to
+            disk together
+    always  every write is synced to disk as soon as it is made
+"""
+import os
+
+DURABILITY_LEVELS = ('none', 'batch', 'always')
+DEFAULT_DURABILITY = 'batch'
+
+
+def check_durability(durability):
+    if durability not in DURABILITY_LEVELS:
+        raise ValueError(
+            'durability should be one of %s, got '
+            '%s' % (', '.join(DURABILITY_LEVELS), durability)
+        )
+
+
+def write_atomic(fname, data, sync=True):
+    """
+    write the data to the file atomically
+
+    Parameters
+    ----------
+    fname: str
+        The file name
+    data: str or bytes
+        The data to write
+    sync: bool, optional
+        If True, make sure the data and the rename are on disk before
+        returning
+    """
+    _write_tmp(fname, data, sync)
+    os.replace(fname + '.tmp', fname)
+    if sync:
+        sync_dir(os.path.dirname(fname))
+
+
+def sync_dir(dirname):
+    """
+    sync the directory, so that files created, renamed or removed there are
+    on disk
+    """
+    try:
+        fd = os.open(dirname or '.', os.O_RDONLY)
+    except OSError:
+        return
+
+    try:
+        os.fsync(fd)
+    except OSError:
+        # not all file systems support this
+        pass
+    finally:
+        os.close(fd)
+
+
+class Committer(object):
+    """
+    Collect file writes and removals and carry them out together at commit
+
+    Parameters
+    ----------
+    durability: str, optional
+        One of 'none', 'batch' or 'always'; see the module documentation
+    """
+    def __init__(self, durability=DEFAULT_DURABILITY):
+        check_durability(durability)
+        self.durability = durability
+
+        # file name to data, for files to be written; a later write of the
+        # same file replaces an earlier one
+        self._writes = {}
+        self._removes = set()
+
+        # objects with a sync(fsync) method, such as the journal, that have
+        # data waiting to be written
+        self._syncs = []
+
+    def write(self, fname, data):
+        """
+        write the data to the file, at the next commit unless the
+        durability is 'always'
+        """
+        self._removes.discard(fname)
+        if self.durability == 'always':
+            write_atomic(fname, data, sync=True)
+        else:
+            self._writes[fname] = data
+
+    def remove(self, fname):
+        """
+        remove the file, at the next commit unless the durability is 'always'
+        """
+        if fname in self._writes:
+            del self._writes[fname]
+
+        if self.durability == 'always':
+            _remove(fname)
+            sync_dir(os.path.dirname(fname))
+        else:
+            self._removes.add(fname)
+
+    def add_sync(self, obj):
+        """
+        sync the object at the next commit
+        """
+        if obj not in self._syncs:
+            self._syncs.append(obj)
+
+    @property
+    def pending(self):
+        return bool(self._writes or self._removes or self._syncs)
+
+    def commit(self):
+        """
+        carry out the pending writes and removals and, unless the durability
+        is 'none', make sure they are on disk
+        """
+        if not self.pending:
+            return
+
+        fsync = self.durability != 'none'
+
+        dirs = set()
+        for obj in self._syncs:
+            obj.sync(fsync=fsync)
+
+        # the directories are synced once for all renames
+        for fname, data in self._writes.items():
+            _write_tmp(fname, data, fsync)
+            os.replace(fname + '.tmp', fname)
+            dirs.add(os.path.dirname(fname))
+
+        for fname in self._removes:
+            _remove(fname)
+            dirs.add(os.path.dirname(fname))
+
+        if fsync:
+            for dirname in dirs:
+                sync_dir(dirname)
+
+        self._writes = {}
+        self._removes = set()
+        self._syncs = []
+
+
+def _write_tmp(fname, data, sync):
+    """
+    write the data to fname.tmp, syncing to disk if requested
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+
+    with open(fname + '.tmp', 'wb') as fobj:
+        fobj.write(data)
+        if sync:
+            fobj.flush()
+            os.fsync(fobj.fileno())
+
+
+def _remove(fname):
+    try:
+        os.remove(fname)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,178 @@
+"""
+Profiling of the server while it runs, without a restart; see the profile
+command of wq
+
+A Profiler runs cProfile over the server's handling of requests and its
+refreshes of the queue, but only between profile start and profile stop,
+so it costs nothing otherwise.  profile dump writes the statistics to a
+file in the spool directory, which can be read with pstats
+
+    python -m pstats spool_dir/profile-20240101-120000.pstats
+
+cProfile only sees the thread it was enabled in, so read only commands
+answered by the reader threads are not included; serve with
+--read-threads 0 to profile those too.
+
+The Timers are always on.  They add up the time spent on the parts of the
+work that usually make the server slow: matching jobs to nodes, spooling
+and committing changes, making snapshots of the queue and encoding
+replies.  They are written out along with the statistics.
+"""
+import os
+import time
+import threading
+import cProfile
+
+# the parts of the work that are timed, in the order they are shown
+TIMER_NAMES = ('match', 'spool', 'commit', 'snapshot', 'encode')
+
+
+class Timers(object):
+    """
+    Totals of the time spent on named parts of the work
+
+    Timings can be added from any thread.
+    """
+    def __init__(self):
+        self.since = time.time()
+        self.timers = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds, count=1):
+        """
+        add the time taken by count pieces of the named work
+        """
+        with self._lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                # count, total and the longest single timing added
+                timer = [0, 0.0, 0.0]
+                self.timers[name] = timer
+
+            timer[0] += count
+            timer[1] += seconds
+            if seconds > timer[2]:
+                timer[2] = seconds
+
+    def reset(self):
+        """
+        start counting again from now
+        """
+        with self._lock:
+            self.timers = {}
+            self.since = time.time()
+
+    def asdict(self):
+        """
+        get the timers as a dict keyed by name, each with the count, total
+        and max in seconds
+        """
+        with self._lock:
+            return {
+                name: {'count': count, 'total': total, 'max': tmax}
+                for name, (count, total, tmax) in self.timers.items()
+            }
+
+    def render(self):
+        """
+        get the timers as a table
+        """
+        timers = self.asdict()
+        names = [name for name in TIMER_NAMES if name in timers]
+        names += sorted(name for name in timers if name not in TIMER_NAMES)
+
+        lines = [
+            'timers for the last %.1f seconds' % (time.time() - self.since),
+            '%-10s %10s %12s %12s %12s' % (
+                'name', 'count', 'total (s)', 'mean (ms)', 'max (ms)',
+            ),
+        ]
+        for name in names:
+            timer = timers[name]
+            count = timer['count']
+            mean = 1000.0 * timer['total'] / count if count > 0 else 0.0
+            lines.append('%-10s %10d %12.3f %12.3f %12.3f' % (
+                name, count, timer['total'], mean, 1000.0 * timer['max'],
+            ))
+
+        return '\n'.join(lines) + '\n'
+
+
+class Profiler(object):
+    """
+    Runs cProfile over calls made through call, while started
+
+    Parameters
+    ----------
+    spool_dir: string
+        Where dump writes the statistics
+    """
+    def __init__(self, spool_dir):
+        self.spool_dir = spool_dir
+        self.profile = None
+        self.started = None
+        self._depth = 0
+
+    @property
+    def running(self):
+        """
+        True between start and stop
+        """
+        return self.started is not None
+
+    def call(self, func, *args):
+        """
+        call the function with the arguments, under the profiler if it was
+        started
+        """
+        profile = self.profile
+        if not self.running or self._depth > 0:
+            # not profiling, or we are already inside a profiled call
+            return func(*args)
+
+        self._depth += 1
+        profile.enable()
+        try:
+            return func(*args)
+        finally:
+            profile.disable()
+            self._depth -= 1
+
+    def start(self):
+        """
+        start profiling, dropping the statistics of any earlier run
+        """
+        self.profile = cProfile.Profile()
+        self.started = time.time()
+
+    def stop(self):
+        """
+        stop profiling.  The statistics are kept until the next start, so
+        they can still be dumped
+        """
+        self.started = None
+
+    def dump(self, timers=None):
+        """
+        write the statistics of the current or last run, and the timers if
+        sent, to files in the spool directory
+
+        Returns
+        -------
+        The list of files written
+        """
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        fnames = []
+
+        if self.profile is not None:
+            fname = os.path.join(self.spool_dir, 'profile-%s.pstats' % stamp)
+            self.profile.dump_stats(fname)
+            fnames.append(fname)
+
+        if timers is not None:
+            fname = os.path.join(self.spool_dir, 'timers-%s.txt' % stamp)
+            with open(fname, 'w') as fobj:
+                fobj.write(timers.render())
+            fnames.append(fname)
+
+        return fnames
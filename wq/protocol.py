@@ -0,0 +1,400 @@
+"""
+Framed wire protocol used between clients and the server.
+
+Each message is sent as a fixed size header followed by the encoded body
+
+    magic     2 bytes   b'WQ'
+    version   1 byte    protocol version
+    encoding  1 byte    encoding of the body, one of the ENC_* constants
+    tag       4 bytes   request tag, echoed back in the reply (0 if unused)
+    length    4 bytes   length of the body in bytes
+
+all in network byte order.  Because the length is known up front the reader
+never has to guess where a message ends.
+
+Data that do not start with the magic bytes are treated as a legacy YAML
+document, as sent by older clients.  The reply to a legacy request is also
+plain YAML, so old clients keep working against a new server.
+"""
+import json
+import struct
+from .defaults import BUFFSIZE
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MAGIC = b'WQ'
+PROTOCOL_VERSION = 1
+
+ENC_JSON = 1
+ENC_YAML = 2
+ENC_MSGPACK = 3
+
+ENCODING_NAMES = {
+    ENC_JSON: 'json',
+    ENC_YAML: 'yaml',
+    ENC_MSGPACK: 'msgpack',
+}
+
+_HEADER = struct.Struct('!2sBBII')
+HEADER_SIZE = _HEADER.size
+
+# refuse to allocate absurd amounts of memory for a corrupt header
+MAX_FRAME_SIZE = 1 << 30
+
+# long lists in a message, such as job listings, are encoded this many items
+# at a time; see encode
+ENCODE_CHUNK = 1000
+
+
+class ProtocolError(Exception):
+    """
+    Raised when a message cannot be framed, encoded or decoded
+    """
+    pass
+
+
+class UnsupportedEncoding(ProtocolError):
+    """
+    Raised for a complete frame whose body is in an encoding not supported
+    by this installation.  The frame is well formed, so the reader can skip
+    its nbytes and go on to the next one
+
+    Parameters
+    ----------
+    frame: dict
+        The description of the frame
+    nbytes: int
+        The size of the frame, including the header
+    """
+    def __init__(self, frame, nbytes):
+        super(UnsupportedEncoding, self).__init__(
+            'unsupported encoding %s' % frame['encoding']
+        )
+        self.frame = frame
+        self.nbytes = nbytes
+
+
+def get_encodings():
+    """
+    get the list of encodings supported by this installation
+    """
+    encodings = [ENC_JSON, ENC_YAML]
+    if msgpack is not None:
+        encodings.append(ENC_MSGPACK)
+    return encodings
+
+
+def get_default_encoding():
+    """
+    msgpack if it is installed, otherwise json
+    """
+    if msgpack is not None:
+        return ENC_MSGPACK
+    else:
+        return ENC_JSON
+
+
+def encode(obj, encoding):
+    """
+    encode the object as bytes using the specified encoding
+
+    The json and msgpack encoders don't let other threads run until they are
+    done, so lists longer than ENCODE_CHUNK at the top level of a message
+    are encoded a chunk at a time, letting other threads run in between.
+    """
+    try:
+        if encoding == ENC_JSON:
+            return _dumps_json(obj).encode('utf-8')
+        elif encoding == ENC_MSGPACK and msgpack is not None:
+            return _packb(obj)
+        elif encoding == ENC_YAML:
+            import yaml
+            return yaml.dump(obj).encode('utf-8')
+    except (TypeError, ValueError, OverflowError) as err:
+        raise ProtocolError("could not encode message: '%s'" % str(err))
+
+    raise ProtocolError('unsupported encoding %s' % encoding)
+
+
+def _dumps_json(obj):
+    if not _has_long_list(obj):
+        return json.dumps(obj, separators=(',', ':'), default=str)
+
+    parts = []
+    for key, val in obj.items():
+        if _is_long_list(val):
+            chunks = [
+                _dumps_json(val[i:i+ENCODE_CHUNK])[1:-1]
+                for i in range(0, len(val), ENCODE_CHUNK)
+            ]
+            parts.append('%s:[%s]' % (json.dumps(str(key)), ','.join(chunks)))
+        else:
+            parts.append(_dumps_json({key: val})[1:-1])
+
+    return '{%s}' % ','.join(parts)
+
+
+def _packb(obj):
+    if not _has_long_list(obj):
+        return msgpack.packb(obj, use_bin_type=True, default=str)
+
+    packer = msgpack.Packer(use_bin_type=True, default=str)
+    parts = [packer.pack_map_header(len(obj))]
+    for key, val in obj.items():
+        parts.append(packer.pack(key))
+        if _is_long_list(val):
+            parts.append(packer.pack_array_header(len(val)))
+            for i in range(0, len(val), ENCODE_CHUNK):
+                parts.append(b''.join(
+                    packer.pack(item) for item in val[i:i+ENCODE_CHUNK]
+                ))
+        else:
+            parts.append(packer.pack(val))
+
+    return b''.join(parts)
+
+
+def _has_long_list(obj):
+    return (
+        isinstance(obj, dict)
+        and any(_is_long_list(val) for val in obj.values())
+    )
+
+
+def _is_long_list(val):
+    return isinstance(val, list) and len(val) > ENCODE_CHUNK
+
+
+def decode(data, encoding):
+    """
+    decode the bytes using the specified encoding
+    """
+    try:
+        if encoding == ENC_JSON:
+            return json.loads(data.decode('utf-8'))
+        elif encoding == ENC_MSGPACK and msgpack is not None:
+            return msgpack.unpackb(data, raw=False, strict_map_key=False)
+        elif encoding == ENC_YAML:
+            from yaml import YAMLError
+            from .util import yaml_load
+            try:
+                return yaml_load(data)
+            except YAMLError as err:
+                raise ValueError(str(err))
+    except ValueError as err:
+        # json and unicode errors are both ValueErrors
+        raise ProtocolError("could not decode message: '%s'" % str(err))
+
+    raise ProtocolError('unsupported encoding %s' % encoding)
+
+
+def pack_frame(obj, encoding=None, tag=0, version=PROTOCOL_VERSION):
+    """
+    encode the object and prepend the frame header
+    """
+    if encoding is None:
+        encoding = get_default_encoding()
+
+    body = encode(obj, encoding)
+    return pack_header(len(body), encoding, tag=tag, version=version) + body
+
+
+def pack_header(length, encoding, tag=0, version=PROTOCOL_VERSION):
+    """
+    get the frame header for a body of the given length
+    """
+    return _HEADER.pack(MAGIC, version, encoding, tag, length)
+
+
+def unpack_header(data):
+    """
+    unpack a frame header
+
+    Returns
+    -------
+    frame: dict
+        With entries version, encoding, tag and length
+    """
+    magic, version, encoding, tag, length = _HEADER.unpack(
+        data[:HEADER_SIZE]
+    )
+    if magic != MAGIC:
+        raise ProtocolError('bad magic in frame header')
+
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError('frame length %d too large' % length)
+
+    return {
+        'legacy': False,
+        'version': version,
+        'encoding': encoding,
+        'tag': tag,
+        'length': length,
+    }
+
+
+def is_framed(data):
+    """
+    True if the data start with the frame magic bytes
+    """
+    return data[:len(MAGIC)] == MAGIC
+
+
+def get_legacy_frame():
+    """
+    frame description used for legacy YAML messages
+    """
+    return {
+        'legacy': True,
+        'version': 0,
+        'encoding': ENC_YAML,
+        'tag': 0,
+        'length': None,
+    }
+
+
+def recv_exact(conn, nbytes):
+    """
+    Receive exactly nbytes from the socket.  Returns fewer bytes only if the
+    connection was closed by the peer.
+    """
+    chunks = []
+    nleft = nbytes
+    while nleft > 0:
+        chunk = conn.recv(min(nleft, 1 << 20))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        nleft -= len(chunk)
+
+    return b''.join(chunks)
+
+
+def read_message(conn, buffsize=BUFFSIZE):
+    """
+    Read a single message from the socket, either framed or legacy YAML
+
+    Returns
+    -------
+    message, frame: object, dict
+        The decoded message and a description of the frame.  The message is
+        None if the connection was closed before anything was received.
+    """
+    data = conn.recv(buffsize)
+    if not data:
+        return None, None
+
+    if not is_framed(data):
+        # old style message, rely on the sender to stop after one document
+        tdata = data
+        while len(tdata) == buffsize:
+            tdata = conn.recv(buffsize)
+            data += tdata
+
+        frame = get_legacy_frame()
+        return decode(data, ENC_YAML), frame
+
+    if len(data) < HEADER_SIZE:
+        data += recv_exact(conn, HEADER_SIZE - len(data))
+        if len(data) < HEADER_SIZE:
+            raise ProtocolError('connection closed inside frame header')
+
+    frame = unpack_header(data)
+    body = data[HEADER_SIZE:]
+    if len(body) < frame['length']:
+        body += recv_exact(conn, frame['length'] - len(body))
+
+    if len(body) != frame['length']:
+        raise ProtocolError('connection closed inside frame body')
+
+    if frame['encoding'] not in get_encodings():
+        raise UnsupportedEncoding(frame, HEADER_SIZE + frame['length'])
+
+    return decode(body, frame['encoding']), frame
+
+
+def split_message(buf):
+    """
+    Extract the first complete framed message from the buffer
+
+    Parameters
+    ----------
+    buf: bytes or bytearray
+        Data received so far; must start with a frame header
+
+    Returns
+    -------
+    message, frame, nbytes: object, dict, int
+        The decoded message, a description of the frame, and the number of
+        bytes used from the buffer.  If the buffer does not yet hold a
+        complete frame, (None, None, 0) is returned.
+
+    Raises UnsupportedEncoding, without decoding, for a complete frame in an
+    encoding we don't support
+    """
+    if len(buf) < HEADER_SIZE:
+        if not MAGIC.startswith(bytes(buf[:len(MAGIC)])):
+            raise ProtocolError('bad magic in frame header')
+        return None, None, 0
+
+    frame = unpack_header(buf)
+    nbytes = HEADER_SIZE + frame['length']
+    if len(buf) < nbytes:
+        return None, None, 0
+
+    if frame['encoding'] not in get_encodings():
+        raise UnsupportedEncoding(frame, nbytes)
+
+    message = decode(bytes(buf[HEADER_SIZE:nbytes]), frame['encoding'])
+    return message, frame, nbytes
+
+
+def write_message(conn, message, frame=None):
+    """
+    Send the message.  If frame is sent, the reply is encoded to match
+    that frame, so legacy requests get legacy replies.
+    """
+    conn.sendall(encode_message(message, frame=frame))
+
+
+def encode_message(message, frame=None):
+    """
+    encode a message, matching the input frame description
+    """
+    body = encode(message, get_reply_encoding(frame))
+    return frame_body(body, frame=frame)
+
+
+def get_reply_encoding(frame=None):
+    """
+    get the encoding for the reply to a message with the input frame
+    description
+    """
+    if frame is None:
+        return get_default_encoding()
+    elif frame['legacy']:
+        return ENC_YAML
+    else:
+        return frame['encoding']
+
+
+def frame_body(body, frame=None):
+    """
+    prepend the header to a body encoded with get_reply_encoding, matching
+    the input frame description.  Legacy replies have no header
+    """
+    if frame is None:
+        encoding = get_default_encoding()
+        tag = 0
+        version = PROTOCOL_VERSION
+    elif frame['legacy']:
+        return body
+    else:
+        encoding = frame['encoding']
+        tag = frame['tag']
+        version = min(frame['version'], PROTOCOL_VERSION)
+
+    return pack_header(len(body), encoding, tag=tag, version=version) + body
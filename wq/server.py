@@ -12,28 +12,122 @@ import yaml
 from yaml import YAMLError
 import time
 import copy
+import json
+import heapq
 import sys
 import os
 import glob
 import datetime
-import select
+import selectors
 import logging
-from .util import socket_send, socket_receive, yaml_load
+import threading
+import functools
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from .util import yaml_load, raise_file_limit
+from .protocol import (
+    ProtocolError,
+    UnsupportedEncoding,
+    MAGIC,
+    ENC_JSON,
+    ENC_YAML,
+    get_encodings,
+    get_legacy_frame,
+    is_framed,
+    decode,
+    encode,
+    split_message,
+    encode_message,
+    frame_body,
+    get_reply_encoding,
+)
 from .status import print_status
 from .user_lister import print_users
+from .job_lister import LISTING_SORT_KEYS, get_listing_sort_key
+from . import liveness
+from .persist import Committer, write_atomic, DEFAULT_DURABILITY
+from .metrics import Metrics
+from .profiling import Profiler, Timers
+from .backends import get_backend, DEFAULT_BACKEND
 
 from .defaults import (
     HOST,
-    BUFFSIZE,
     SOCK_TIMEOUT,
+    CLIENT_TIMEOUT,
+    LISTEN_BACKLOG,
     WAIT_SLEEP,
     PRIORITY_LIST,
     RESTART_DELAY,
+    NOT_MODIFIED,
+)
+
+# read this much at a time from client sockets
+RECV_SIZE = 65536
+
+# maximum number of distinct requirements for which we remember the
+# eligible nodes
+MAX_ELIGIBLE_CACHE = 10000
+
+# number of saved jobs loaded at a time on startup, between which the
+# server deals with clients
+LOAD_CHUNK = 2000
+
+# commands that only read the queue, which can be answered while the saved
+# jobs are still being loaded
+READ_ONLY_COMMANDS = (
+    'ls', 'lsfull', 'stat', 'users', 'user', 'subscribe', 'metrics',
+    'profile',
+)
+
+# all the commands, for labelling the metrics
+COMMANDS = READ_ONLY_COMMANDS + (
+    'sub', 'sub_many', 'get_hosts', 'gethosts', 'limit', 'rm', 'notify',
+    'notify_many', 'attach', 'refresh', 'node',
 )
 
+# seconds to stop accepting connections after accept fails, usually for
+# lack of file descriptors; the clients wait in the listen backlog
+ACCEPT_PAUSE = 1.0
+
+# ignore HTTP requests for the metrics with headers larger than this
+MAX_HTTP_REQUEST = 65536
+
+# read only commands whose encoded replies are kept until the queue
+# changes; see JobQueue.get_encoded_response
+CACHED_COMMANDS = ('ls', 'lsfull', 'stat', 'users', 'user')
+
+# the most replies kept for one generation of the queue
+MAX_RESPONSE_CACHE = 1000
+
+# number of threads answering read only commands from a snapshot of the
+# queue, so that a large listing doesn't hold up submissions.  With 0 they
+# are answered by the server loop
+READ_THREADS = 2
+
+# what clients can subscribe to
+SUBSCRIBE_TOPICS = ('jobs', 'status')
+
+# jobs submitted with sub_many are given ids starting here.  This is above
+# the largest possible pid on Linux, so they can't clash with jobs that are
+# identified by the pid of their client
+FIRST_JOB_ID = 1 << 22
+
+
+def get_job_proc(job):
+    """
+    get the pid of the process that runs the job; the job is over when it
+    exits.  For jobs submitted with sub_many this is the owner, which runs
+    all of the jobs, otherwise it is the client whose pid identifies the
+    job
+    """
+    return job.get('owner', job['pid'])
+
 
 class Server(object):
-    def __init__(self, cluster_file, port, spool_dir, loglevel='info'):
+    def __init__(self, cluster_file, port, spool_dir, loglevel='info',
+                 compat_spool=False, durability=DEFAULT_DURABILITY,
+                 backend=DEFAULT_BACKEND, read_threads=READ_THREADS,
+                 metrics_port=None):
 
         self.loglevel = loglevel.upper()
         logging.basicConfig(stream=sys.stdout)
@@ -44,23 +138,109 @@ class Server(object):
         self.port = port
         self.cluster_file = cluster_file
 
+        # if set, the metrics are also served over HTTP on this port
+        self.metrics_port = metrics_port
+        self.metrics_sock = None
+
         # note passing on state of the system.
         self.queue = JobQueue(
             cluster_file=cluster_file,
             spool_dir=spool_dir,
             loglevel=loglevel,
+            compat_spool=compat_spool,
+            incremental_load=True,
+            durability=durability,
+            group_commit=True,
+            backend=backend,
         )
         self.verbosity = 1
 
+        # clients waiting for their job to run, keyed by pid.  The values
+        # are the client session and the frame of the submit request
+        self.waiters = {}
+
+        # clients that submitted jobs with sub_many, keyed by their pid.  The
+        # values are the client session and the frame of the request; they
+        # are told when one of their jobs is removed
+        self.owners = {}
+
+        # clients subscribed to changes, keyed by session.  The values hold
+        # the frame of the subscribe request, the topics, and the selection
+        # of jobs
+        self.subscribers = {}
+
+        # jobs and hosts changed since subscribers were last told
+        self.changed_pids = set()
+        self.changed_hosts = set()
+
+        # sessions with a partial request or unsent reply, and the time
+        # by which that must be dealt with
+        self.deadlines = {}
+
+        # pidfds of the processes running jobs in the queue, keyed by pid
+        self.watches = {}
+
+        # requests that change the queue, received while the saved jobs
+        # are being loaded
+        self.deferred = []
+
+        # sessions with replies waiting for the changes to be committed
+        self.unflushed = set()
+
+        # listening sockets we stopped accepting on, and the time to start
+        # again
+        self.paused = {}
+
+        # threads answering read only commands.  When a reply is ready it
+        # is put in reads_done, and the loop is woken by writing to wakeup
+        if read_threads > 0:
+            self.readers = ThreadPoolExecutor(
+                max_workers=read_threads, thread_name_prefix='wq-read',
+            )
+        else:
+            self.readers = None
+        self.reads_done = collections.deque()
+        self.wakeup, self.wakeup_sender = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.wakeup_sender.setblocking(False)
+
     def open_socket(self):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+        # don't wait for connections from the previous instance to time out
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.bind((HOST, self.port))
         self.sock.setblocking(0)
-        self.sock.listen()
+        self.sock.listen(LISTEN_BACKLOG)
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ, None)
+        self.paused = {}
+        self.selector.register(self.wakeup, selectors.EVENT_READ, self.wakeup)
+
+        if self.metrics_port is not None:
+            # only for scraping from this machine
+            self.metrics_sock = socket.socket(
+                socket.AF_INET, socket.SOCK_STREAM,
+            )
+            self.metrics_sock.setsockopt(
+                socket.SOL_SOCKET, socket.SO_REUSEADDR, 1,
+            )
+            self.metrics_sock.bind(('127.0.0.1', self.metrics_port))
+            self.metrics_sock.setblocking(0)
+            self.metrics_sock.listen(LISTEN_BACKLOG)
+            self.selector.register(
+                self.metrics_sock, selectors.EVENT_READ, self.metrics_sock,
+            )
+
+        for job in list(self.queue.queue):
+            self.watch_pid(get_job_proc(job))
+        self.push_events()
 
     def run(self):
 
         do_restart = True
+        raise_file_limit()
 
         while True:
             self.open_socket()
@@ -71,13 +251,22 @@ class Server(object):
 
             finally:
                 self.queue.save_users()
+                self.queue.commit()
+                self.close_sessions()
+                self.unwatch_pids()
+                self.selector.close()
                 self.logger.debug('shutdown')
                 self.sock.shutdown(socket.SHUT_RDWR)
                 self.logger.debug('close')
                 self.sock.close()
+                if self.metrics_sock is not None:
+                    self.metrics_sock.close()
 
             if not do_restart:
                 self.logger.debug('keyboard interrupt: exiting')
+                if self.readers is not None:
+                    self.readers.shutdown(wait=False)
+                self.queue.close()
                 break
             else:
                 self.logger.debug('restarting after 1 minute wait')
@@ -85,1060 +274,3530 @@ class Server(object):
 
     def _run(self):
         """
-        Use select to tell us when either the server socket got a request or if
-        clients are ready to be read.
-
-        Multiple clients are handled at once, they just go in a queue and are
-        dealt with later (this queue is not the job queue, just a simple list).
-        The server is in the same queue so if it gets another request before a
-        client is ready to be read, then another client will be queued for
-        later processing. Note we are also listening with a backlog of 4 on
-        the server socket.
-
-        Currently the clients are *not* dealt with in parallel.  This would be
-        tricky since each client request can result in a change in the queue
-        state.
-
+        Use a selector (epoll where available) to tell us when either the
+        server socket got a request, clients are ready to be read, or
+        replies can be written.
+
+        All sockets are non-blocking.  Each client connection has its own
+        session with input and output buffers, so a partial request from a
+        slow client does not hold up anyone else; the request is processed
+        once the complete frame has arrived.  A session that does not finish
+        sending a request, or reading its reply, within CLIENT_TIMEOUT
+        seconds is dropped.
+
+        Clients using the framed protocol keep their session open after a
+        request is processed, so a session can send many requests over the
+        same connection; the connection is dropped when the client closes
+        it.
+
+        The requests themselves are *not* dealt with in parallel; they are
+        processed one at a time as they complete, since each client request
+        can result in a change in the queue state.
+
+        The exception is the read only commands in CACHED_COMMANDS, which are
+        answered from a snapshot of the queue by the reader threads, so a
+        large listing does not hold up the requests behind it.  The reply is
+        sent once it is ready.
+
+        On startup the saved jobs are loaded a chunk at a time between
+        dealing with clients.  Requests that only read the queue are
+        answered right away; others wait until all jobs are loaded.
+
+        All changes made in one pass of the loop are committed together
+        at the end of the pass, before the replies are sent, so clients
+        are only told about changes that are safely recorded.
+
+        The process of each job is watched using a pidfd where supported,
+        so when it exits the job is removed and its cores are given to
+        waiting jobs right away.  Otherwise, and as a backup, the queue is
+        refreshed every SOCK_TIMEOUT seconds, which removes jobs whose
+        process is gone.
         """
-        server = self.sock
-        input = [server]
+        next_refresh = time.time() + SOCK_TIMEOUT
         while True:
-            try:
+            if self.queue.loading:
+                timeout = 0
+            else:
+                timeout = next_refresh - time.time()
 
-                inputready, [], [] = select.select(
-                    input, [], [], SOCK_TIMEOUT,
+            if self.deadlines:
+                timeout = min(
+                    timeout,
+                    min(self.deadlines.values()) - time.time(),
                 )
-                if len(inputready) == 0:
-                    self.refresh_queue()
+
+            if self.paused:
+                timeout = min(
+                    timeout,
+                    min(self.paused.values()) - time.time(),
+                )
+
+            events = self.selector.select(max(timeout, 0))
+
+            for key, mask in events:
+                if key.data is None:
+                    self._accept_clients(self.sock)
                     continue
 
-                for sock in inputready:
-                    if sock == server:
-                        # the server socket got a client request
-                        client, addr = server.accept()
+                if key.data is self.wakeup:
+                    self._send_read_replies()
+                    continue
 
-                        self.logger.debug(
-                            "%s Connected by %s" % (
-                                str(datetime.datetime.now()),
-                                addr,
-                            )
-                        )
+                if key.data is self.metrics_sock:
+                    self._accept_clients(self.metrics_sock, http=True)
+                    continue
 
-                        # it goes in the queue
-                        input.append(client)
-                    else:
-                        # handle clients.
-                        try:
-                            client = sock
-                            self.process_client_request(client)
-                            client.shutdown(socket.SHUT_RDWR)
-                            client.close()
-                        except socket.error:
-                            es = str(sys.exc_info())
-                            if ('Broken pipe' in es
-                                    or 'Transport endpoint' in es):
-                                self.logger.info("caught exception '%s'" % es)
-                                self.logger.info('ignoring')
-                        finally:
-                            # whatever happens we can't talk to this client any
-                            # more
-                            input.remove(client)
-
-            except socket.error as e:
-                es = str(sys.exc_info())
-                if 'Broken pipe' in es:
-                    # this happens sometimes when someone ctrl-c in the middle
-                    # of talking with the server
-                    self.logger.info("caught exception '%s'" % es)
-                    self.logger.info('ignoring Broken pipe exception')
-                else:
-                    raise e
+                if isinstance(key.data, liveness.PidWatch):
+                    self._process_exited(key.data)
+                    continue
+
+                session = key.data
+                if mask & selectors.EVENT_READ:
+                    self._read_session(session)
+                if (mask & selectors.EVENT_WRITE and not session.closed
+                        and session not in self.unflushed):
+                    # what was sent in this pass is flushed by _commit,
+                    # once the changes are recorded
+                    self._flush_session(session)
+
+            self._check_deadlines()
+            self._resume_accepting()
+
+            if self.queue.loading:
+                self._load_queue()
+            elif time.time() >= next_refresh:
+                self.refresh_queue()
+                next_refresh = time.time() + SOCK_TIMEOUT
 
-    def process_client_request(self, client):
+            self._commit()
+
+    def _commit(self):
+        """
+        commit the changes from this pass, then send the replies, along
+        with the changes to subscribers
         """
-        client is a socket
+        start = time.time()
+        self.queue.commit()
+        self.queue.metrics.commit_seconds.observe(time.time() - start)
+        self._push_updates()
 
-        We should be ready to recieve since we used select()
+        unflushed = self.unflushed
+        self.unflushed = set()
+        for session in unflushed:
+            self._flush_session(session)
+
+    def _load_queue(self):
         """
-        data = socket_receive(client, BUFFSIZE)
-        if not data:
-            return
+        load the next chunk of saved jobs.  Once all are loaded, deal with
+        the requests that had to wait
+        """
+        self.queue.load_some(LOAD_CHUNK)
+        self.push_events()
 
-        self.logger.debug(
-            '%s %s' % (
-                str(datetime.datetime.now()),
-                'processing client request'
+        if not self.queue.loading:
+            self.logger.info('finished loading jobs')
+            deferred = self.deferred
+            self.deferred = []
+            for session, message, frame in deferred:
+                if not session.closed:
+                    self.process_client_request(session, message, frame)
+
+            self.refresh_queue()
+
+    def _accept_clients(self, sock, http=False):
+        while True:
+            try:
+                client, addr = sock.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as err:
+                # usually we are out of file descriptors.  Stop for a while
+                # rather than spin, leaving the clients in the backlog
+                self.logger.warning(
+                    "could not accept connection: '%s'; pausing for %s "
+                    "seconds" % (err, ACCEPT_PAUSE)
+                )
+                self.selector.unregister(sock)
+                self.paused[sock] = time.time() + ACCEPT_PAUSE
+                break
+
+            self.logger.debug(
+                "%s Connected by %s" % (
+                    str(datetime.datetime.now()),
+                    addr,
+                )
             )
-        )
 
-        if self.loglevel == 'DEBUG':
-            self.logger.debug(str(data))
+            session = ClientSession(client, addr, http=http)
+            self.selector.register(client, selectors.EVENT_READ, session)
 
+    def _resume_accepting(self):
+        """
+        start accepting connections again on the sockets that were paused
+        for long enough
+        """
+        now = time.time()
+        for sock, until in list(self.paused.items()):
+            if until <= now:
+                del self.paused[sock]
+                data = None if sock is self.sock else sock
+                self.selector.register(sock, selectors.EVENT_READ, data)
+
+    def _read_session(self, session):
+        """
+        read what is available from the client and process any complete
+        requests
+        """
+        eof = False
         try:
-            message = yaml_load(data)
-        except YAMLError as err:
-            # too many types of errors can occur
-            ret = {
-                "error": (
-                    "Got error '%s' processing "
-                    "YAML request: '%s'" % (str(err), data)
-                )
-            }
-            ret = yaml.dump(ret)
-            socket_send(client, ret)
+            while True:
+                data = session.sock.recv(RECV_SIZE)
+                if not data:
+                    eof = True
+                    break
+                session.inbuf += data
+                session.nread = len(data)
+                if len(data) < RECV_SIZE:
+                    break
+        except (BlockingIOError, InterruptedError):
+            pass
+        except socket.error:
+            self._log_socket_error()
+            self.close_session(session)
             return
 
-        self.queue.process_message(message)
-        response = self.queue.get_response()
+        if session.http:
+            self._process_http_request(session, eof)
+            self._update_session(session)
+            return
 
         try:
-            yaml_response = yaml.dump(response)
-        except YAMLError as err:
-            errmess = (
-                "Server error processing YAML response: '%s'; "
-                "keyboard interrupt?" % str(err)
-            )
-            err = {"error": errmess}
-            yaml_response = yaml.dump(err)
-
-        if self.loglevel == 'DEBUG':
-            self.logger.debug("response: '%s'" % str(yaml_response))
+            for message, frame in session.get_messages(eof=eof):
+                self.process_client_request(session, message, frame)
+        except ProtocolError as err:
+            # too many types of errors can occur.  We can't find the next
+            # message boundary, so reply and hang up
+            ret = {
+                "error": (
+                    "Got error '%s' processing request" % str(err)
+                )
+            }
+            frame = session.frame
+            if frame is None:
+                frame = get_legacy_frame()
+            session.inbuf.clear()
+            self.send_to_session(session, encode_message(ret, frame=frame))
+            session.closing = True
 
-        socket_send(client, yaml_response)
+        if eof:
+            session.closing = True
 
-    def refresh_queue(self):
-        self.logger.debug(
-            '%s refreshing queue' % str(datetime.datetime.now())
-        )
-        self.queue.refresh()
-        if self.loglevel == 'DEBUG':
-            print_status(self.queue.cluster.status())
+        self._update_session(session)
 
+    def _process_http_request(self, session, eof):
+        """
+        answer an HTTP request for the metrics, once its headers are in
+        """
+        end = session.inbuf.find(b'\r\n\r\n')
+        if end < 0:
+            if eof or len(session.inbuf) > MAX_HTTP_REQUEST:
+                session.closing = True
+            return
 
-class Node(object):
-    def __init__(self, line):
-        ls = line.split()
-        host, ncores, mem = ls[0:3]
+        start = time.time()
+        request = bytes(session.inbuf[:end]).decode('latin-1').split()
+        session.inbuf.clear()
 
-        if len(ls) > 3:
-            self.grps = ls[3].split(',')
+        if (len(request) >= 2 and request[0] == 'GET'
+                and request[1].split('?')[0] in ('/', '/metrics')):
+            status = '200 OK'
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+            body = self.queue.render_metrics().encode('utf-8')
         else:
-            self.grps = []
+            status = '404 Not Found'
+            content_type = 'text/plain; charset=utf-8'
+            body = b'not found\n'
+
+        header = (
+            'HTTP/1.0 %s\r\n'
+            'Content-Type: %s\r\n'
+            'Content-Length: %d\r\n'
+            'Connection: close\r\n'
+            '\r\n' % (status, content_type, len(body))
+        )
+        self.send_to_session(session, header.encode('ascii') + body)
+        session.closing = True
 
-        self.host = host
-        self.ncores = int(ncores)
-        self.mem = float(mem)
-        self.used = 0
-        self.online = True
+        self.queue.count_request('metrics', time.time() - start)
 
-    def get_groups(self):
-        return self.grps
+    def _flush_session(self, session):
+        """
+        send as much of the output buffer as the socket will take
+        """
+        if session.outbuf:
+            try:
+                nsent = session.sock.send(session.outbuf)
+                del session.outbuf[:nsent]
+            except (BlockingIOError, InterruptedError):
+                pass
+            except socket.error:
+                self._log_socket_error()
+                self.close_session(session)
+                return
 
-    def set_online(self, truth_value):
-        self.online = truth_value
+        self._update_session(session)
 
-    def reserve(self):
-        self.used += 1
-        assert self.used <= self.ncores, (
-            "git used cores %d > available "
-            "cores %d" % (self.used, self.ncores)
-        )
+    def _update_session(self, session):
+        """
+        update the selector and deadlines for the new session state
+        """
+        if session.closed:
+            return
 
-    def unreserve(self):
-        self.used -= 1
-        assert self.used >= 0, "got used cores %d < 0" % self.used
+        if session.closing and not session.outbuf and not session.nreading:
+            self.close_session(session)
+            return
 
+        if session.outbuf:
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE
+        else:
+            events = selectors.EVENT_READ
 
-class Cluster(object):
-    def __init__(self, filename):
-        self.filename = filename
-        self.nodes = {}
+        if events != session.events:
+            self.selector.modify(session.sock, events, session)
+            session.events = events
 
-        with open(filename) as fobj:
-            for line in fobj:
-                nd = Node(line)
-                self.nodes[nd.host] = nd
+        if session.outbuf or session.inbuf:
+            if session not in self.deadlines:
+                self.deadlines[session] = time.time() + CLIENT_TIMEOUT
+        else:
+            self.deadlines.pop(session, None)
+
+    def _check_deadlines(self):
+        now = time.time()
+        expired = [
+            session for session, deadline in self.deadlines.items()
+            if deadline <= now
+        ]
+        for session in expired:
+            if session.legacy and session.inbuf and not session.outbuf:
+                # legacy requests have no length; this is the best we can do
+                try:
+                    message = session.get_legacy_message()
+                    self.process_client_request(
+                        session, message, get_legacy_frame(),
+                    )
+                    session.closing = True
+                    self.deadlines.pop(session, None)
+                    self._update_session(session)
+                    continue
+                except ProtocolError:
+                    pass
 
-    def reserve(self, hosts):
-        for h in hosts:
-            self.nodes[h].reserve()
+            self.logger.info(
+                'dropping client %s after timeout' % str(session.addr)
+            )
+            self.close_session(session)
 
-    def unreserve(self, hosts):
-        for h in hosts:
-            self.nodes[h].unreserve()
+    def send_to_session(self, session, data):
+        """
+        queue data to be sent to the client.  It is sent once the changes
+        made in this pass of the loop are committed
+        """
+        if session.closed:
+            return
 
-    def status(self):
-        res = {}
-        tot = 0
-        used = 0
-        use = []
-        nds = []
-        nodes = list(self.nodes.keys())
-        nodes.sort()
-        for h in nodes:
-            nds.append(
-                {
-                    'hostname': h,
-                    'used': self.nodes[h].used,
-                    'ncores': self.nodes[h].ncores,
-                    'mem': self.nodes[h].mem,
-                    'grps': self.nodes[h].grps,
-                    'online': self.nodes[h].online,
-                },
-            )
+        session.outbuf += data
+        self.unflushed.add(session)
 
-            tot += self.nodes[h].ncores
-            used += self.nodes[h].used
-            if self.nodes[h].used > 0:
-                use.append((h, self.nodes[h].used))
+    def close_session(self, session):
+        if session.closed:
+            return
 
-        res['used'] = used
-        res['ncores'] = tot
-        res['nnodes'] = len(self.nodes)
-        res['nodes'] = nds
-        return res
+        session.closed = True
+        self.deadlines.pop(session, None)
+        self.unflushed.discard(session)
+        for pid in session.waiting_pids:
+            waiter = self.waiters.get(pid)
+            if waiter is not None and waiter[0] is session:
+                del self.waiters[pid]
+        for pid in session.owner_pids:
+            owner = self.owners.get(pid)
+            if owner is not None and owner[0] is session:
+                del self.owners[pid]
+        self.subscribers.pop(session, None)
 
+        try:
+            self.selector.unregister(session.sock)
+        except (KeyError, ValueError):
+            pass
 
-def _get_dict_int(d, key, default):
-    reason = ''
-    try:
-        num = int(d.get(key, default))
-    except (ValueError, TypeError) as err:
-        num = None
-        reason = "failed to extract int requirement '%s'"
-        reason = reason % str(err)
+        try:
+            session.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        session.sock.close()
 
-    return num, reason
+    def close_sessions(self):
+        for key in list(self.selector.get_map().values()):
+            if isinstance(key.data, ClientSession):
+                self.close_session(key.data)
 
+    def watch_pid(self, pid):
+        """
+        watch the process running jobs so we hear when it exits.  If the
+        process is already gone its jobs are removed
+        """
+        if pid in self.watches:
+            return
 
-def _get_dict_float(d, key, default):
-    reason = ''
-    try:
-        f = float(d.get(key, default))
-    except (ValueError, TypeError) as err:
-        f = None
-        reason = "failed to extract float requirement '%s'"
-        reason = reason % str(err)
-    return f, reason
+        try:
+            watch = liveness.watch_pid(pid)
+        except ProcessLookupError:
+            self.queue.remove_exited(pid)
+            return
 
+        if watch is not None:
+            self.watches[pid] = watch
+            self.selector.register(watch, selectors.EVENT_READ, watch)
 
-class Users(object):
-    """
-    Simple encapsulation so we can easily serialize
-    the users dictionary
-    """
-    def __init__(self):
-        self.users = {}
+    def unwatch_pid(self, pid):
+        watch = self.watches.pop(pid, None)
+        if watch is not None:
+            try:
+                self.selector.unregister(watch)
+            except (KeyError, ValueError):
+                pass
+            watch.close()
 
-    def __contains__(self, user):
-        return user in self.users
+    def unwatch_pids(self):
+        for pid in list(self.watches):
+            self.unwatch_pid(pid)
 
-    def fromfile(self, fname):
+    def _process_exited(self, watch):
         """
-        Only user and limits are loaded.
+        the process running jobs exited
         """
-        if os.path.exists(fname):
-
-            with open(fname) as fobj:
-                data = yaml_load(fobj)
+        self.unwatch_pid(watch.pid)
+        self.queue.remove_exited(watch.pid)
+        self.push_events()
 
-            self.users = {}
-            if data is not None:
-                for user, udata in data.items():
-                    u = self._new_user(user)
-                    u['limits'] = udata['limits']
-                    self.users[user] = u
+    def _log_socket_error(self):
+        es = str(sys.exc_info())
+        self.logger.info("caught exception '%s'" % es)
+        self.logger.info('ignoring')
 
-    def tofile(self, fname):
+    def process_client_request(self, session, message, frame):
         """
-        Write to file.  Only the username and limits are saved.
+        process a complete request from the client session, queueing
+        the reply to be sent.  This is profiled after profile start
         """
-        data = {}
-        for user, udata in self.users.items():
-            data[user] = {}
-            data[user]['user'] = user
-            data[user]['limits'] = udata['limits']
+        try:
+            self.queue.profiler.call(
+                self._process_client_request, session, message, frame,
+            )
+        except Exception as err:
+            # a bad request must not take the server down
+            self.logger.exception('error processing request')
+            self.send_to_session(
+                session, self._get_exception_reply(err, frame),
+            )
+            if frame['legacy']:
+                session.closing = True
+            self.push_events()
 
-        with open(fname, 'w') as fobj:
-            yaml.dump(data, fobj)
+    def _process_client_request(self, session, message, frame):
 
-    def get(self, user):
-        udata = self.users.get(user, None)
-        if udata is None:
-            udata = self.add_new(user)
-        return udata
+        self.logger.debug(
+            '%s %s' % (
+                str(datetime.datetime.now()),
+                'processing client request'
+            )
+        )
 
-    def add_new(self, user):
-        udata = self.users.get(user, None)
-        if udata is None:
-            udata = self._new_user(user)
-            self.users[user] = udata
-        return udata
+        if self.loglevel == 'DEBUG':
+            self.logger.debug(str(message))
 
-    def increment_user_running(self, job):
-        user = job['user']
-        hosts = job['hosts']
+        if not frame['legacy'] and frame['encoding'] not in get_encodings():
+            ret = {
+                "error": "unsupported encoding %s" % frame['encoding'],
+                "encodings": get_encodings(),
+            }
+            frame = dict(frame, encoding=ENC_JSON)
+            self.send_to_session(session, encode_message(ret, frame=frame))
+            return
 
-        udata = self.users.get(user, None)
-        if udata is None:
-            udata = self.add_new(user)
+        if (self.queue.loading
+                and not (isinstance(message, dict)
+                         and message.get('command') in READ_ONLY_COMMANDS)):
+            # this could change the queue, so wait until it is loaded
+            self.deferred.append((session, message, frame))
+            return
 
-        ncores = len(hosts)
-        if ncores > 0:
-            udata['run'] += 1
-            udata['cores'] += ncores
+        if (isinstance(message, dict)
+                and message.get('command') in CACHED_COMMANDS):
+            self._process_read(session, message, frame)
+            return
 
-    def increment_user_jobcount(self, job):
-        user = job['user']
-        udata = self.users.get(user, None)
-        if udata is None:
-            udata = self.add_new(user)
+        data = self._get_reply(session, message, frame)
+        self.send_to_session(session, data)
 
-        udata['total'] += 1
+        if frame['legacy']:
+            # old clients send one request per connection
+            session.closing = True
 
-    def decrement_user_running(self, job):
-        user = job['user']
-        hosts = job['hosts']
+        self.push_events()
+
+    def _process_read(self, session, message, frame):
+        """
+        answer a read only command from a snapshot of the queue.  Unless the
+        reply is already known, it is worked out by a reader thread while
+        the loop goes on, and sent by _send_read_replies
+        """
+        start = time.time()
+        snapshot = self.queue.get_snapshot()
+        encoding = get_reply_encoding(frame)
+
+        try:
+            if self.readers is None:
+                body = snapshot.get_encoded_response(message, encoding)
+            else:
+                body = snapshot.get_cached_response(message, encoding)
+        except ProtocolError as err:
+            self._send_read_reply(session, frame, err=err)
+            return
+        except Exception as err:
+            self.logger.exception(
+                "error answering '%s' request" % message['command']
+            )
+            self._send_read_reply(session, frame, err=err)
+            return
+
+        if body is not None:
+            self._send_read_reply(session, frame, body=body)
+            self.queue.count_request(message['command'], time.time() - start)
+            return
+
+        session.nreading += 1
+        future = self.readers.submit(
+            snapshot.get_encoded_response, message, encoding,
+        )
+        future.add_done_callback(
+            functools.partial(
+                self._read_done, session, frame, message['command'], start,
+            )
+        )
+
+    def _read_done(self, session, frame, command, start, future):
+        """
+        called in the reader thread when a reply is ready; the loop is woken
+        to send it
+        """
+        self.reads_done.append((session, frame, command, start, future))
+        try:
+            self.wakeup_sender.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            # the loop has plenty of wake ups waiting already
+            pass
+
+    def _send_read_replies(self):
+        """
+        send the replies worked out by the reader threads
+        """
+        try:
+            while self.wakeup.recv(RECV_SIZE):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+        while self.reads_done:
+            session, frame, command, start, future = self.reads_done.popleft()
+            session.nreading -= 1
+
+            try:
+                body = future.result()
+            except ProtocolError as err:
+                self._send_read_reply(session, frame, err=err)
+            except Exception as err:
+                # a bad request must not take the server down
+                self.logger.exception(
+                    "error answering '%s' request" % command
+                )
+                self._send_read_reply(session, frame, err=err)
+            else:
+                self._send_read_reply(session, frame, body=body)
+                self.queue.count_request(command, time.time() - start)
+
+            self._update_session(session)
+
+    def _send_read_reply(self, session, frame, body=None, err=None):
+        if err is None:
+            data = frame_body(body, frame=frame)
+        else:
+            data = self._get_exception_reply(err, frame)
+
+        self.send_to_session(session, data)
+
+        if frame['legacy']:
+            # old clients send one request per connection
+            session.closing = True
+
+    def _get_reply(self, session, message, frame):
+        """
+        process the request, noting clients that are to be told about
+        changes, and get the encoded reply
+        """
+        self.queue.process_message(message)
+        response = self.queue.get_response()
+
+        if (not frame['legacy']
+                and isinstance(message, dict)
+                and message.get('push', False)
+                and message.get('command') == 'sub'
+                and response.get('response') == 'wait'):
+            # the client will wait on this connection rather than polling
+            # for the spool file
+            self.waiters[message['pid']] = (session, frame)
+            session.waiting_pids.add(message['pid'])
+            response['push'] = True
+        elif (not frame['legacy']
+                and isinstance(message, dict)
+                and message.get('push', False)
+                and message.get('command') in ('sub_many', 'attach')
+                and 'jobs' in response):
+            self._add_owner(session, frame, message['owner'], response)
+        elif (not frame['legacy']
+                and isinstance(message, dict)
+                and message.get('command') == 'subscribe'
+                and 'error' not in response):
+            self.subscribers[session] = {
+                'frame': frame,
+                'topics': message.get('topics', ['jobs']),
+                'select': get_listing_selection(message),
+            }
+
+        if self.loglevel == 'DEBUG':
+            self.logger.debug("response: '%s'" % str(response))
+
+        start = time.time()
+        try:
+            data = encode_message(response, frame=frame)
+        except ProtocolError as err:
+            return self._get_error_reply(err, frame)
+
+        dt = time.time() - start
+        self.queue.metrics.encode_seconds.observe(
+            dt, [get_command_label(message)],
+        )
+        self.queue.timers.add('encode', dt)
+        return data
+
+    def _get_error_reply(self, err, frame):
+        errmess = (
+            "Server error processing response: '%s'; "
+            "keyboard interrupt?" % str(err)
+        )
+        return encode_message({"error": errmess}, frame=frame)
+
+    def _get_exception_reply(self, err, frame):
+        """
+        get the encoded reply for an error raised while processing a request
+        """
+        if isinstance(err, ProtocolError):
+            return self._get_error_reply(err, frame)
+
+        return encode_message(
+            {"error": "Server error processing request: '%s'" % str(err)},
+            frame=frame,
+        )
+
+    def refresh_queue(self):
+        self.logger.debug(
+            '%s refreshing queue' % str(datetime.datetime.now())
+        )
+        self.queue.refresh()
+        self.push_events()
+        if self.loglevel == 'DEBUG':
+            print_status(self.queue.cluster.status())
+
+    def push_events(self):
+        """
+        tell waiting clients that their jobs can run, sending the hosts, and
+        keep the process watches up to date with the jobs in the queue.
+        Changes for subscribers are noted, to be sent at the end of the pass
+        """
+        events = self.queue.pop_events()
+        while events:
+            for event in events:
+                if event['event'] == 'add':
+                    self.watch_pid(event['proc'])
+                elif event['event'] == 'remove':
+                    self._drop_waiter(event['pid'])
+                    if not self.queue.queue.has_proc(event['proc']):
+                        self.unwatch_pid(event['proc'])
+                elif event['event'] == 'run':
+                    self._push_run(event)
+                elif event['event'] == 'kill':
+                    self._push_kill(event)
+
+                if self.subscribers:
+                    self._note_change(event)
+
+            # watching can find exited processes, which makes more events
+            events = self.queue.pop_events()
+
+    def _push_run(self, event):
+        """
+        tell the waiting client, if any, that its job can run.  For an
+        element of an array, the client waiting for the array is told
+        """
+        if 'array' in event:
+            # more elements may follow
+            waiter = self.waiters.get(event['array'])
+        else:
+            waiter = self.waiters.pop(event['pid'], None)
+        if waiter is None:
+            return
+
+        session, frame = waiter
+        session.waiting_pids.discard(event['pid'])
+
+        push = {
+            'command': 'sub',
+            'pid': event['pid'],
+            'response': 'run',
+            'hosts': event['hosts'],
+        }
+        if 'array' in event:
+            push['array'] = event['array']
+            push['index'] = event['index']
+
+        # tag 0 marks messages the client did not ask for
+        frame = dict(frame, tag=0)
+        self.send_to_session(session, encode_message(push, frame=frame))
+
+    def _note_change(self, event):
+        """
+        note the jobs and hosts changed by the event
+        """
+        if event['event'] == 'node':
+            self.changed_hosts.add(event['host'])
+            return
+
+        if event['event'] == 'kill':
+            # the job was removed, for which there is a remove event
+            return
+
+        # elements are listed as part of their array
+        self.changed_pids.add(event.get('array', event['pid']))
+        self.changed_hosts.update(event.get('hosts', []))
+
+    def _push_updates(self):
+        """
+        send the changes to the jobs and the cluster since the last time to
+        the subscribers, as a single message each
+
+            'jobs'      the listing entries of the jobs that were added or
+                        changed, as sent by ls
+            'removed'   the pids of jobs that left the queue, or are no
+                        longer selected
+            'status'    the 'used' cores, and the 'nodes' that changed, as
+                        sent by stat
+
+        These are only sent for the topics subscribed to, and only if there
+        were changes
+        """
+        pids = self.changed_pids
+        hosts = self.changed_hosts
+        self.changed_pids = set()
+        self.changed_hosts = set()
+
+        if not self.subscribers or not (pids or hosts):
+            return
+
+        entries = self.queue.get_listing_entries(pids) if pids else {}
+        if hosts:
+            cluster = self.queue.cluster
+            status = {
+                'used': sum(node.used for node in cluster.nodes.values()),
+                'nodes': [cluster.node_status(host) for host in hosts],
+            }
+
+        for session, sub in list(self.subscribers.items()):
+            push = {}
+            if 'jobs' in sub['topics'] and entries:
+                select = sub['select']
+                push['jobs'] = []
+                push['removed'] = []
+                for pid, entry in entries.items():
+                    if entry is not None and is_selected(entry, select):
+                        push['jobs'].append(entry)
+                    else:
+                        push['removed'].append(pid)
+
+            if 'status' in sub['topics'] and hosts:
+                push['status'] = status
+
+            if push:
+                push['command'] = 'subscribe'
+                frame = dict(sub['frame'], tag=0)
+                self.send_to_session(
+                    session, encode_message(push, frame=frame),
+                )
+
+    def _drop_waiter(self, pid):
+        """
+        the job left the queue; no need to tell anyone it can run
+        """
+        waiter = self.waiters.pop(pid, None)
+        if waiter is not None:
+            waiter[0].waiting_pids.discard(pid)
+
+    def _add_owner(self, session, frame, owner, response):
+        """
+        the client will wait on this connection to be told when each of its
+        waiting jobs can run, and when any of its jobs is removed
+        """
+        self.owners[owner] = (session, frame)
+        session.owner_pids.add(owner)
+
+        for jres in response['jobs']:
+            if jres['status'] == 'wait':
+                self.waiters[jres['pid']] = (session, frame)
+                session.waiting_pids.add(jres['pid'])
+
+        response['push'] = True
+
+    def _push_kill(self, event):
+        """
+        tell the owner of a removed job, if connected, to kill it
+        """
+        owner = self.owners.get(event['owner'])
+        if owner is None:
+            return
+
+        session, frame = owner
+        push = {
+            'command': 'kill',
+            'pid': event['pid'],
+        }
+
+        frame = dict(frame, tag=0)
+        self.send_to_session(session, encode_message(push, frame=frame))
+
+
+class ClientSession(object):
+    """
+    The state of a single client connection
+
+    Parameters
+    ----------
+    sock: socket
+        The client socket; it is set to non-blocking
+    addr: tuple
+        The client address
+    http: bool, optional
+        If True the client is asking for the metrics over HTTP
+    """
+    def __init__(self, sock, addr, http=False):
+        sock.setblocking(False)
+        self.sock = sock
+        self.addr = addr
+        self.http = http
+
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.events = selectors.EVENT_READ
+
+        # None until we see the first bytes
+        self.legacy = None
+        # frame of the last request
+        self.frame = None
+        # size of the last chunk read
+        self.nread = 0
+
+        self.closing = False
+        self.closed = False
+
+        # number of replies being worked out by the reader threads
+        self.nreading = 0
+
+        # pids for which this client is waiting to be told to run
+        self.waiting_pids = set()
+
+        # pids of the owners of jobs submitted over this connection
+        self.owner_pids = set()
+
+    def get_messages(self, eof=False):
+        """
+        get all complete messages from the input buffer
+
+        Parameters
+        ----------
+        eof: bool, optional
+            If True, the client has closed its end of the connection
+        """
+        messages = []
+        while self.inbuf:
+            if self.legacy is None:
+                if len(self.inbuf) < len(MAGIC) and not eof:
+                    break
+                self.legacy = not is_framed(self.inbuf)
+
+            if self.legacy:
+                # old clients send a single YAML document with no length.  As
+                # in older versions, take a short read as the end of the
+                # document, but keep reading if it did not parse
+                final = eof
+                if not final and self.nread == RECV_SIZE:
+                    break
+                try:
+                    message = self.get_legacy_message()
+                except ProtocolError:
+                    if final:
+                        raise
+                    break
+                messages.append((message, get_legacy_frame()))
+                break
+
+            try:
+                message, frame, nbytes = split_message(self.inbuf)
+            except UnsupportedEncoding as err:
+                # skip it; the client is sent the encodings we support, in
+                # json, so it can send the request again
+                del self.inbuf[:err.nbytes]
+                self.frame = dict(err.frame, encoding=ENC_JSON)
+                messages.append((None, err.frame))
+                continue
+
+            if frame is None:
+                break
+
+            del self.inbuf[:nbytes]
+            self.frame = frame
+            messages.append((message, frame))
+
+        return messages
+
+    def get_legacy_message(self):
+        """
+        decode the input buffer as a legacy YAML document, clearing the
+        buffer if it succeeds
+        """
+        message = decode(bytes(self.inbuf), ENC_YAML)
+        self.inbuf.clear()
+        return message
+
+
+class Node(object):
+    def __init__(self, line):
+        ls = line.split()
+        host, ncores, mem = ls[0:3]
+
+        if len(ls) > 3:
+            self.grps = ls[3].split(',')
+        else:
+            self.grps = []
+
+        # bit mask of the groups, set by the Cluster
+        self.gmask = 0
+
+        self.host = host
+        self.ncores = int(ncores)
+        self.mem = float(mem)
+        self.used = 0
+        self.online = True
+
+    def get_groups(self):
+        return self.grps
+
+    def set_online(self, truth_value):
+        self.online = truth_value
+
+    def reserve(self):
+        self.used += 1
+        assert self.used <= self.ncores, (
+            "git used cores %d > available "
+            "cores %d" % (self.used, self.ncores)
+        )
+
+    def unreserve(self):
+        self.used -= 1
+        assert self.used >= 0, "got used cores %d < 0" % self.used
+
+
+class Cluster(object):
+    """
+    The nodes of the cluster
+
+    An index of free cores is kept up to date by reserve, unreserve and
+    set_online, so we can quickly find the online nodes with at least k free
+    cores, the idle nodes, and the total number of free cores.  Offline
+    nodes are not in the index.
+
+    Each group is given a bit, and each node a mask of the bits for its
+    groups, so group requirements are checked with a single and.  The
+    online nodes satisfying a set of requirements don't depend on usage, so
+    they are cached until a node goes offline or online.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.nodes = {}
+
+        with open(filename) as fobj:
+            for line in fobj:
+                nd = Node(line)
+                self.nodes[nd.host] = nd
+
+        self.hostnames = sorted(self.nodes)
+        self._position = {h: i for i, h in enumerate(self.hostnames)}
+
+        self.group_bits = {}
+        self.group_hosts = {}
+        for h in self.hostnames:
+            nd = self.nodes[h]
+            for g in nd.grps:
+                if g not in self.group_bits:
+                    self.group_bits[g] = 1 << len(self.group_bits)
+                    self.group_hosts[g] = []
+                self.group_hosts[g].append(h)
+            nd.gmask = self.group_mask(nd.grps)
+
+        # mask with the bits for all groups set
+        self.all_groups_mask = (1 << len(self.group_bits)) - 1
+
+        self._eligible_cache = {}
+
+        # incremented when nodes go offline or online, which changes which
+        # nodes could ever satisfy a job
+        self.online_gen = 0
+
+        self._build_free_index()
+
+    def reserve(self, hosts):
+        for h, n in _count_hosts(hosts).items():
+            nd = self.nodes[h]
+            self._unindex(nd)
+            for i in range(n):
+                nd.reserve()
+            self._index(nd)
+
+    def unreserve(self, hosts):
+        for h, n in _count_hosts(hosts).items():
+            nd = self.nodes[h]
+            self._unindex(nd)
+            for i in range(n):
+                nd.unreserve()
+            self._index(nd)
+
+    def set_online(self, host, truth_value):
+        nd = self.nodes[host]
+        self._unindex(nd)
+        nd.set_online(truth_value)
+        self._index(nd)
+        self.online_gen += 1
+        self._eligible_cache.clear()
+
+    def group_mask(self, groups):
+        """
+        get the bit mask for the groups; groups not in the cluster
+        are ignored
+        """
+        mask = 0
+        for g in groups:
+            mask |= self.group_bits.get(g, 0)
+        return mask
+
+    def get_eligible(self, reqs, min_cores=0):
+        """
+        get the online hosts that satisfy the memory and group requirements,
+        and have at least min_cores, regardless of how many of their cores
+        are in use
+
+        Parameters
+        ----------
+        reqs: Requirements
+            The compiled job requirements
+        min_cores: int, optional
+            Only nodes with at least this many cores are eligible
+
+        Returns
+        -------
+        hosts, hostset: list, set
+            The hosts sorted by name, and the same as a set
+        """
+        key = (reqs.min_mem, min_cores, reqs.group, reqs.not_group)
+        eligible = self._eligible_cache.get(key)
+        if eligible is None:
+            if len(self._eligible_cache) > MAX_ELIGIBLE_CACHE:
+                self._eligible_cache.clear()
+
+            gmask = self.group_mask(reqs.group)
+            notmask = self.group_mask(reqs.not_group)
+            hosts = []
+            for h in self.hostnames:
+                nd = self.nodes[h]
+                if (nd.online
+                        and nd.mem >= reqs.min_mem
+                        and nd.ncores >= min_cores
+                        and (not reqs.group or nd.gmask & gmask)
+                        and not nd.gmask & notmask):
+                    hosts.append(h)
+
+            eligible = (hosts, set(hosts))
+            self._eligible_cache[key] = eligible
+
+        return eligible
+
+    def get_free_eligible(self, eligible, ncores):
+        """
+        get the eligible hosts, as returned by get_eligible, that have at
+        least ncores free, sorted by name.  We go through whichever of the
+        two sets of hosts is smaller
+        """
+        hosts, hostset = eligible
+        ncores = max(ncores, 1)
+
+        nfree_hosts = 0
+        for free in range(ncores, len(self._by_free)):
+            nfree_hosts += len(self._by_free[free])
+
+        if nfree_hosts < len(hosts):
+            return [h for h in self.hosts_with_free(ncores) if h in hostset]
+        else:
+            nodes = self.nodes
+            return [
+                h for h in hosts
+                if nodes[h].ncores - nodes[h].used >= ncores
+            ]
+
+    def get_idle_eligible(self, eligible):
+        """
+        get the eligible hosts, as returned by get_eligible, that have no
+        cores in use, sorted by name
+        """
+        hosts, hostset = eligible
+        if len(self._idle) < len(hosts):
+            return [h for h in self.idle_hosts() if h in hostset]
+        else:
+            nodes = self.nodes
+            return [h for h in hosts if nodes[h].used == 0]
+
+    def is_full(self):
+        """
+        True if there are no free cores on any online node
+        """
+        return self.nfree == 0
+
+    def hosts_with_free(self, ncores):
+        """
+        get the online hosts with at least ncores free, sorted by name
+        """
+        ncores = max(ncores, 1)
+        hosts = []
+        for free in range(ncores, len(self._by_free)):
+            hosts += self._by_free[free]
+
+        hosts.sort(key=self._position.get)
+        return hosts
+
+    def idle_hosts(self):
+        """
+        get the online hosts with no cores in use, sorted by name
+        """
+        return sorted(self._idle, key=self._position.get)
+
+    def _build_free_index(self):
+        maxcores = max([nd.ncores for nd in self.nodes.values()], default=0)
+
+        # sets of online hosts with each number of free cores
+        self._by_free = [set() for i in range(maxcores+1)]
+        self._idle = set()
+        self.nfree = 0
+
+        for nd in self.nodes.values():
+            self._index(nd)
+
+    def _index(self, nd):
+        if nd.online:
+            free = nd.ncores - nd.used
+            self._by_free[free].add(nd.host)
+            self.nfree += free
+            if nd.used == 0:
+                self._idle.add(nd.host)
+
+    def _unindex(self, nd):
+        if nd.online:
+            free = nd.ncores - nd.used
+            self._by_free[free].discard(nd.host)
+            self.nfree -= free
+            self._idle.discard(nd.host)
+
+    def status(self):
+        res = {}
+        tot = 0
+        used = 0
+        use = []
+        nds = []
+        for h in self.hostnames:
+            nds.append(self.node_status(h))
+
+            tot += self.nodes[h].ncores
+            used += self.nodes[h].used
+            if self.nodes[h].used > 0:
+                use.append((h, self.nodes[h].used))
+
+        res['used'] = used
+        res['ncores'] = tot
+        res['nnodes'] = len(self.nodes)
+        res['nodes'] = nds
+        return res
+
+    def count_cores(self):
+        """
+        count the cores used, free and offline in each group of nodes, and
+        in the whole cluster under group ''
+
+        Returns
+        -------
+        counts: dict
+            Keyed by group, each a dict keyed by 'used', 'free' and 'offline'
+        """
+        counts = {}
+        for node in self.nodes.values():
+            if node.online:
+                free = node.ncores - node.used
+                offline = 0
+            else:
+                free = 0
+                offline = node.ncores - node.used
+
+            for group in [''] + node.get_groups():
+                gcounts = counts.setdefault(
+                    group, {'used': 0, 'free': 0, 'offline': 0},
+                )
+                gcounts['used'] += node.used
+                gcounts['free'] += free
+                gcounts['offline'] += offline
+
+        return counts
+
+    def node_status(self, host):
+        """
+        the status of a single node, as listed by status
+        """
+        node = self.nodes[host]
+        return {
+            'hostname': host,
+            'used': node.used,
+            'ncores': node.ncores,
+            'mem': node.mem,
+            'grps': node.grps,
+            'online': node.online,
+        }
+
+
+def _count_hosts(hosts):
+    """
+    count the number of times each host appears in the list
+    """
+    counts = {}
+    for h in hosts:
+        counts[h] = counts.get(h, 0) + 1
+    return counts
+
+
+class Users(object):
+    """
+    Simple encapsulation so we can easily serialize
+    the users dictionary
+    """
+    def __init__(self):
+        self.users = {}
+
+    def __contains__(self, user):
+        return user in self.users
+
+    def fromfile(self, fname):
+        """
+        Only user and limits are loaded.
+        """
+        if os.path.exists(fname):
+
+            with open(fname) as fobj:
+                data = yaml_load(fobj)
+
+            self.fromdict(data)
+
+    def fromdict(self, data):
+        """
+        load the limits, as returned by get_limits
+        """
+        self.users = {}
+        if data is not None:
+            for user, udata in data.items():
+                u = self._new_user(user)
+                u['limits'] = udata['limits']
+                self.users[user] = u
+
+    def get_limits(self):
+        """
+        get a dict keyed by user with the user name and limits, which
+        is what is saved
+        """
+        data = {}
+        for user, udata in self.users.items():
+            data[user] = {}
+            data[user]['user'] = user
+            data[user]['limits'] = udata['limits']
+        return data
+
+    def tofile(self, fname):
+        """
+        Write to file.  Only the username and limits are saved.
+        """
+        write_atomic(fname, self.dumps())
+
+    def dumps(self):
+        """
+        get the YAML written by tofile
+        """
+        return yaml.dump(self.get_limits())
+
+    def get(self, user):
+        udata = self.users.get(user, None)
+        if udata is None:
+            udata = self.add_new(user)
+        return udata
+
+    def add_new(self, user):
+        udata = self.users.get(user, None)
+        if udata is None:
+            udata = self._new_user(user)
+            self.users[user] = udata
+        return udata
+
+    def increment_user_running(self, job):
+        user = job['user']
+        hosts = job['hosts']
+
+        udata = self.users.get(user, None)
+        if udata is None:
+            udata = self.add_new(user)
+
+        ncores = len(hosts)
+        if ncores > 0:
+            udata['run'] += 1
+            udata['cores'] += ncores
+
+    def increment_user_jobcount(self, job):
+        user = job['user']
+        udata = self.users.get(user, None)
+        if udata is None:
+            udata = self.add_new(user)
+
+        udata['total'] += job.njobs
+
+    def count_jobs(self, jobs):
+        """
+        add the jobs to the counts of total and running jobs and cores, as
+        increment_user_jobcount and increment_user_running would
+        """
+        users = self.users
+        for job in jobs:
+            udata = users.get(job['user'], None)
+            if udata is None:
+                udata = self.add_new(job['user'])
+
+            udata['total'] += job.njobs
+            if job['status'] == 'run':
+                ncores = len(job['hosts'])
+                if ncores > 0:
+                    udata['run'] += 1
+                    udata['cores'] += ncores
+
+    def decrement_user_running(self, job):
+        user = job['user']
+        hosts = job['hosts']
 
         udata = self.users.get(user, None)
         if not udata:
             return
 
-        ncores = len(hosts)
-        if ncores > 0:
-            udata['run'] -= 1
-            udata['cores'] -= ncores
+        ncores = len(hosts)
+        if ncores > 0:
+            udata['run'] -= 1
+            udata['cores'] -= ncores
+
+        if udata['run'] < 0:
+            udata['run'] = 0
+        if udata['cores'] < 0:
+            udata['cores'] = 0
+
+    def decrement_user_jobcount(self, job):
+        user = job['user']
+        udata = self.users.get(user, None)
+        if udata is None:
+            udata = self.add_new(user)
+
+        udata['total'] -= job.njobs
+        if udata['total'] < 0:
+            udata['total'] = 0
+
+    def _new_user(self, user):
+        return {
+            'user': user,
+            'run': 0,  # running jobs
+            'total': 0,  # total jobs including not running
+            'cores': 0,
+            'limits': {},
+        }
+
+    def asdict(self):
+        return copy.deepcopy(self.users)
+
+    def copy(self):
+        """
+        get a copy of the users and their limits
+        """
+        users = Users()
+        users.users = self.asdict()
+        return users
+
+
+_MATCHERS = {
+    'by_core': '_match_by_core',
+    'bycore': '_match_by_core',
+    'by_core1': '_match_by_core1',
+    'bycore1': '_match_by_core1',
+    'by_node': '_match_by_node',
+    'bynode': '_match_by_node',
+    'by_host': '_match_by_host',
+    'byhost': '_match_by_host',
+    'by_group': '_match_by_group',
+    'bygroup': '_match_by_group',
+}
+
+
+class Requirements(object):
+    """
+    The requirements of a job, validated and parsed once when the job is
+    created so the matchers don't have to do it on every pass
+
+    Parameters
+    ----------
+    reqs: dict
+        The 'require' entry of the job
+
+    Raises ValueError, with the reason in the message, if the requirements
+    are not valid
+    """
+    __slots__ = (
+        'mode', 'matcher', 'N', 'threads', 'min_mem', 'min_cores',
+        'group', 'not_group', 'group_name', 'host', 'key',
+    )
+
+    def __init__(self, reqs):
+        if not isinstance(reqs, dict):
+            raise ValueError("requirements should be a dictionary")
+
+        # default to bycore
+        self.mode = reqs.get('mode', 'by_core')
+        if not isinstance(self.mode, str) or self.mode not in _MATCHERS:
+            # unknown request never mathces
+            raise ValueError("bad submit_mode '%s'" % self.mode)
+
+        self.matcher = getattr(Job, _MATCHERS[self.mode])
+
+        self.N = _get_req_int(reqs, 'N', 1)
+        self.threads = max(_get_req_int(reqs, 'threads', 1), 1)
+        self.min_mem = _get_req_float(reqs, 'min_mem', 0.0)
+        self.min_cores = _get_req_int(reqs, 'min_cores', 0)
+
+        # deal with old names
+        not_group = reqs.get('not_group', reqs.get('notgroup', []))
+
+        self.group = _get_req_set(reqs.get('group', []))
+        self.not_group = _get_req_set(not_group)
+
+        self.group_name = reqs.get('group', None)
+        self.host = reqs.get('host', None)
+
+        if self.matcher is Job._match_by_core:
+            if self.N % self.threads > 0:
+                raise ValueError(
+                    'Number of requested cores not divisible by threads'
+                )
+        elif self.matcher is Job._match_by_host:
+            if self.host is None:
+                raise ValueError("'host' field not in requirements")
+            if not isinstance(self.host, str):
+                raise ValueError("'host' should be a host name")
+        elif self.matcher is Job._match_by_group:
+            if not self.group_name:
+                raise ValueError('Need to specify group')
+            if isinstance(self.group_name, list):
+                raise ValueError('Specify a single group for by_group')
+            if not isinstance(self.group_name, str):
+                raise ValueError("'group' should be a group name")
+
+        # jobs with the same key match the same nodes
+        self.key = (
+            _MATCHERS[self.mode], self.N, self.threads, self.min_mem,
+            self.min_cores, self.group, self.not_group, self.host,
+        )
+
+
+def _get_req_int(reqs, key, default):
+    try:
+        return int(reqs.get(key, default))
+    except (ValueError, TypeError) as err:
+        raise ValueError(
+            "failed to extract int requirement '%s'" % str(err)
+        )
+
+
+def _get_req_float(reqs, key, default):
+    try:
+        return float(reqs.get(key, default))
+    except (ValueError, TypeError) as err:
+        raise ValueError(
+            "failed to extract float requirement '%s'" % str(err)
+        )
+
+
+def _get_req_set(val):
+    """
+    If a scalar is found, it is converted to a set using {val}
+    """
+    if not isinstance(val, list):
+        val = [val]
+    try:
+        return frozenset(val)
+    except TypeError:
+        raise ValueError("bad group specification '%s'" % val)
+
+
+class Job(dict):
+    def __init__(self, spool_dir=None, **config):
+        self.spool_dir = spool_dir
+        self.reqs = None
+        self.pmatch_cache = None
+        self._job_name = None
+        self.update(config)
+
+        if 'require' not in self:
+            self['status'] = 'nevermatch'
+            self['reason'] = "'require' field not in message"
+        elif 'pid' not in self:
+            self['status'] = 'nevermatch'
+            self['reason'] = "'pid' field not in message"
+        elif 'user' not in self:
+            self['status'] = 'nevermatch'
+            self['reason'] = "'user' field not in message"
+        elif 'commandline' not in self:
+            self['status'] = 'nevermatch'
+            self['reason'] = "'commandline' field not in message"
+        elif not _is_pid(self['pid']):
+            # these are keys in the queue and the saved state
+            self['status'] = 'nevermatch'
+            self['reason'] = "'pid' must be an integer"
+        elif not isinstance(self['user'], str):
+            self['status'] = 'nevermatch'
+            self['reason'] = "'user' must be a string"
+        else:
+            self['status'] = 'wait'
+            self['reason'] = ''
+
+        reqs = self.get('require', {})
+        if not isinstance(reqs, dict):
+            reqs = {}
+
+        self['priority'] = reqs.get('priority', 'med')
+        if self['priority'] not in PRIORITY_LIST:
+            self['status'] = 'nevermatch'
+            self['reason'] = (
+                "priority must be on of: " + ",".join(PRIORITY_LIST)
+            )
+
+        if self['status'] != 'nevermatch':
+            try:
+                self.reqs = Requirements(self['require'])
+            except ValueError as err:
+                self['status'] = 'nevermatch'
+                self['reason'] = str(err)
+
+        self['time_sub'] = time.time()
+        self['spool_fname'] = None
+
+    @classmethod
+    def from_record(cls, spool_dir, record):
+        """
+        recreate a job saved by the server, keeping its status and times
+        """
+        job = cls(spool_dir=spool_dir, **record)
+        if job['status'] != 'nevermatch':
+            for key in ('status', 'time_sub', 'spool_fname'):
+                if key in record:
+                    job[key] = record[key]
+
+        return job
+
+    def spool(self, write=True):
+        """
+        set up the job for its current status, which becomes 'run' if it
+        was 'ready'
+
+        If write is True spool_fname is set to the pid.wait or pid.run file
+        the job should be written to, for clients that wait for the file to
+        appear, otherwise to None.  These files are only a view; the queue
+        itself is kept by the backend.
+        """
+        if self['status'] == 'ready':
+            self['status'] = 'run'
+
+        self['spool_wait'] = WAIT_SLEEP
+        if self['status'] in ['ready', 'run']:
+            self['time_run'] = time.time()
+        else:
+            self['time_run'] = None
+
+        if write:
+            self['spool_fname'] = self.get_spool_fname()
+        else:
+            self['spool_fname'] = None
+
+    def get_spool_fname(self, status=None):
+        if status is None:
+            status = self['status']
+
+        return os.path.join(
+            self.spool_dir,
+            str(self['pid'])+'.'+status,
+        )
+
+    def match(self, cluster, blocked_mask=0):
+        """
+        see if the job can run on the cluster, setting the status, reason
+        and hosts.  Nodes in any group of blocked_mask, as returned by
+        cluster.group_mask, are not used
+        """
+        if self['status'] == 'nevermatch':
+            return
+        if self['status'] != 'wait':
+            return
+
+        # We don't block ourserlves
+        if self['priority'] == 'block':
+            bmask = 0
+        else:
+            bmask = blocked_mask
+
+        pmatch, match, hosts, reason = (
+            self.reqs.matcher(self, cluster, bmask)
+        )
+
+        if pmatch:
+            if match:
+                self['hosts'] = hosts
+                self['status'] = 'ready'
+                self['reason'] = ''
+            else:
+                self['status'] = 'wait'
+                self['reason'] = reason
+
+        else:
+            self['status'] = 'nevermatch'
+            self['reason'] = reason
+
+    def match_users(self, users):
+        """
+        ret False if user specifications are not met
+
+        users is just a dictionary
+        """
+
+        # if user is not even known, then we are good
+        if self['user'] in users:
+            udata = users.get(self['user'])
+            # if no limits are specified, we are good
+            ulimits = udata['limits']
+            if ulimits:
+
+                if 'run' in ulimits:
+                    nrun_max = ulimits['run']
+                elif 'Njobs' in ulimits:
+                    nrun_max = ulimits['Njobs']
+                else:
+                    nrun_max = -1
+
+                if nrun_max is not None and nrun_max >= 0:
+                    # this is the actual number of jobs the user has running
+                    nrun = udata.get('run', 0)
+                    if nrun >= nrun_max:
+                        return False
+
+                if 'cores' in ulimits:
+                    ncores_max = ulimits['cores']
+                elif 'Ncores' in ulimits:
+                    ncores_max = ulimits['Ncores']
+                else:
+                    ncores_max = -1
+
+                if ncores_max is not None and ncores_max >= 0:
+                    # this is the actual number of cores the user has
+                    ncores = udata.get('cores', 0)
+                    if ncores >= ncores_max:
+                        return False
+
+        return True
+
+    def get_match_key(self):
+        """
+        get a key identifying the requirements relevant for matching; jobs
+        with the same key match the same nodes
+        """
+        return self.reqs.key
+
+    def _match_by_core(self, cluster, bmask):
+        pmatch = False
+        match = False
+        hosts = []  # actually matched hosts
+        reason = ''
+
+        num = self.reqs.N
+        threads = self.reqs.threads
+
+        eligible = cluster.get_eligible(self.reqs)
+
+        pmatch = self._get_cached_pmatch(cluster)
+        if pmatch is None:
+            nump = num
+            for h in eligible[0]:
+                nd = cluster.nodes[h]
+
+                # usable cores must be multiple of
+                # number of threads requested
+                pucores = (nd.ncores//threads)*threads
+
+                if pucores >= nump:
+                    pmatch = True
+                    break
+                else:
+                    nump -= pucores
+
+            pmatch = self._set_cached_pmatch(cluster, pmatch)
+
+        if not pmatch:
+            reason = 'Not enough cores or mem satistifying condition.'
+            return pmatch, match, hosts, reason
+
+        if num <= 0:
+            # nothing to reserve, so the first eligible node will do, even
+            # one that is full or in a blocked group
+            return pmatch, True, hosts, reason
+
+        # only nodes with free cores can contribute
+        block_flag = False
+        for h in cluster.get_free_eligible(eligible, threads):
+            nd = cluster.nodes[h]
+            if nd.gmask & bmask:
+                block_flag = True
+                continue
+
+            nfree = nd.ncores-nd.used
+            nfree = (nfree//threads)*threads
+
+            if nfree >= num:
+                hosts += [h]*num
+                num = 0
+                match = True
+                break
+            else:
+                num -= nfree
+                hosts += [h]*nfree
+
+        if not match:
+            if block_flag:
+                reason = ('Not enough free cores or cores waiting '
+                          'for a blocking job.')
+            else:
+                reason = 'Not enough free cores.'
+
+        return pmatch, match, hosts, reason
+
+    def _match_by_core1(self, cluster, bmask):
+        """
+        Get cores all from one node.
+        """
+        pmatch = False
+        match = False
+        hosts = []  # actually matched hosts
+        reason = ''
+
+        num = self.reqs.N
+
+        eligible = cluster.get_eligible(self.reqs)
+
+        pmatch = self._get_cached_pmatch(cluster)
+        if pmatch is None:
+            for h in eligible[0]:
+                if cluster.nodes[h].ncores >= num:
+                    pmatch = True
+                    break
+
+            pmatch = self._set_cached_pmatch(cluster, pmatch)
+
+        if not pmatch:
+            reason = 'Not a node with that many cores.'
+            return pmatch, match, hosts, reason
+
+        if num <= 0:
+            # as for by_core
+            return pmatch, True, hosts, reason
+
+        block_flag = False
+        for h in cluster.get_free_eligible(eligible, num):
+            if cluster.nodes[h].gmask & bmask:
+                block_flag = True
+                continue
+
+            hosts += [h]*num
+            match = True
+            break
+
+        if not match:
+            if block_flag:
+                reason = ('Not enough free cores or cores waiting '
+                          'for a blocking job.')
+            else:
+                reason = 'Not enough free cores on any one node.'
+
+        return pmatch, match, hosts, reason
+
+    def _match_by_node(self, cluster, bmask):
+        pmatch = False
+        match = False
+        hosts = []  # actually matched hosts
+        reason = ''
+
+        num = self.reqs.N
+
+        eligible = cluster.get_eligible(
+            self.reqs, min_cores=self.reqs.min_cores,
+        )
+
+        # asking for no nodes never matches
+        pmatch = 0 < num <= len(eligible[0])
+        if not pmatch:
+            reason = 'Not enough total cores satistifying condition.'
+            return pmatch, match, hosts, reason
+
+        # only idle nodes can be used
+        block_flag = False
+        for h in cluster.get_idle_eligible(eligible):
+            nd = cluster.nodes[h]
+            if nd.gmask & bmask:
+                block_flag = True
+                continue
+
+            num -= 1
+            hosts += [h]*nd.ncores
+            if num == 0:
+                match = True
+                break
+
+        if not match:
+            if block_flag:
+                reason = ('Not enough free cores or cores '
+                          'waiting for a blocking job.')
+            else:
+                reason = 'Not enough free cores.'
+
+        return pmatch, match, hosts, reason
+
+    def _get_cached_pmatch(self, cluster):
+        """
+        Whether the job could ever match only depends on the requirements
+        and which nodes are online, so we can remember it.  Returns None if
+        not known
+        """
+        cached = self.pmatch_cache
+        if cached is not None and cached[0] == cluster.online_gen:
+            return cached[1]
+        return None
+
+    def _set_cached_pmatch(self, cluster, pmatch):
+        self.pmatch_cache = (cluster.online_gen, pmatch)
+        return pmatch
+
+    def _match_by_host(self, cluster, bmask):
+
+        pmatch = False
+        match = False
+        hosts = []  # actually matched hosts
+        reason = ''
+
+        h = self.reqs.host
+
+        # make sure the node name exists
+        if h not in cluster.nodes:
+            reason = "host '%s' does not exist" % h
+            return pmatch, match, hosts, reason
+
+        nd = cluster.nodes[h]
+
+        if not nd.online:
+            reason = "host is offline"
+            return pmatch, match, hosts, reason
+
+        if nd.gmask & bmask:
+            reason = "host in blocked group"
+            return pmatch, match, hosts, reason
+
+        num = self.reqs.N
+
+        if nd.ncores >= num:
+            pmatch = True
+
+        nfree = nd.ncores-nd.used
+        if nfree >= num:
+            hosts += [h]*num
+            num = 0
+            match = True
+        else:
+            reason = "Not enough free cores on "+h
+
+        return pmatch, match, hosts, reason
+
+    def _match_by_group(self, cluster, bmask):
+
+        pmatch = False
+        match = False
+        hosts = []  # actually matched hosts
+        reason = ''
+
+        g = self.reqs.group_name
+        for h in cluster.group_hosts.get(g, []):
+            nd = cluster.nodes[h]
+            if not nd.online:
+                continue
+
+            pmatch = True
+            match = True
+            if nd.used > 0:
+                match = False  # we actually demand the entire group
+                reason = 'Host '+h+' not entirely free.'
+                break
+
+            if nd.gmask & bmask:
+                match = False
+                reason = 'Host '+h+' in a blocked group.'
+                break
+            else:
+                hosts += [h]*nd.ncores
+
+        if not pmatch:
+            reason = 'Not a single node in that group'
+        return pmatch, match, hosts, reason
+
+    @property
+    def job_name(self):
+        """
+        the name of the job in listings: the job_name requirement, or the
+        first word of the command
+        """
+        if self._job_name is None:
+            if 'job_name' in self['require']:
+                self._job_name = self['require']['job_name']
+            else:
+                self._job_name = self['commandline'].split()[0]
+
+        return self._job_name
+
+    @property
+    def njobs(self):
+        """
+        number of jobs this entry counts as in the user's total
+        """
+        return 1
+
+    def asdict(self):
+        d = {}
+        for k in self:
+            d[k] = self[k]
+        return d
+
+    def copy(self):
+        """
+        get a shallow copy of the job, of the same class
+        """
+        job = self.__class__.__new__(self.__class__)
+        job.__dict__.update(self.__dict__)
+        dict.update(job, self)
+        return job
+
+
+class ArrayJob(Job):
+    """
+    An array of jobs that differ only by their index, from array_start to
+    array_stop inclusive, such as a parameter sweep
+
+    The array is kept as a single entry in the queue, the template for its
+    elements.  It waits in the queue like any other job, and each time it
+    matches an element is made and run, with its own id, until every
+    element has been started.  Elements are started in order of index, so
+    the state of the elements that are not running is just the index of the
+    next one to start, array_next; those below it are done.  The elements
+    are run by the owner, which replaces %index% in the command with the
+    index.
+
+    The array has id pid, and element i has id pid + 1 + i - array_start.
+    Once all elements have started the array has status 'run' with no hosts
+    of its own, and it leaves the queue with its last element.
+    """
+    def __init__(self, spool_dir=None, **config):
+        super(ArrayJob, self).__init__(spool_dir=spool_dir, **config)
+
+        try:
+            self['array_start'] = int(self['array_start'])
+            self['array_stop'] = int(self['array_stop'])
+        except (KeyError, ValueError, TypeError):
+            self['status'] = 'nevermatch'
+            self['reason'] = 'array_start and array_stop must be integers'
+            return
+
+        if self['array_stop'] < self['array_start']:
+            self['status'] = 'nevermatch'
+            self['reason'] = 'array_stop is less than array_start'
+            return
+
+        self.setdefault('array_next', self['array_start'])
+
+    @property
+    def size(self):
+        """
+        number of elements in the array
+        """
+        return self['array_stop'] - self['array_start'] + 1
+
+    @property
+    def nwaiting(self):
+        """
+        number of elements yet to start
+        """
+        return self['array_stop'] - self['array_next'] + 1
+
+    @property
+    def njobs(self):
+        """
+        the array counts as its elements yet to start; those started are
+        counted as jobs of their own
+        """
+        return self.nwaiting
+
+    def get_element_id(self, index):
+        return self['pid'] + 1 + index - self['array_start']
+
+    def make_element(self):
+        """
+        make the next element, to run on the hosts the array matched
+        """
+        index = self['array_next']
+        self['array_next'] += 1
+
+        config = {
+            key: self[key]
+            for key in ('user', 'owner', 'commandline', 'require', 'push')
+            if key in self
+        }
+        element = Job(
+            spool_dir=self.spool_dir,
+            pid=self.get_element_id(index),
+            array=self['pid'],
+            index=index,
+            **config
+        )
+        element['time_sub'] = self['time_sub']
+        element['hosts'] = self['hosts']
+        element['status'] = 'ready'
+        return element
+
+
+def get_listing_selection(message):
+    """
+    get the arguments to JobIndex.select for a listing request, from its
+    'pid', 'user', 'status' and 'priority' entries, each a single value or
+    a list.  Raises ValueError if they are not valid
+    """
+    select = {}
+    for key, name in [('pid', 'pids'), ('user', 'users'),
+                      ('status', 'statuses'), ('priority', 'priorities')]:
+        vals = message.get(key)
+        if vals is None:
+            continue
+        if not isinstance(vals, list):
+            vals = [vals]
+        if not all(_is_str_or_int(val) for val in vals):
+            raise ValueError(
+                '%s must be a string or integer, or a list of them' % key
+            )
+        select[name] = vals
+
+    if 'pids' in select:
+        try:
+            select['pids'] = [int(pid) for pid in select['pids']]
+        except (ValueError, TypeError):
+            raise ValueError('pids must be integers')
+
+    return select
+
+
+def _is_str_or_int(val):
+    return isinstance(val, str) or _is_pid(val)
+
+
+def _is_pid(val):
+    """
+    True if the value sent by a client can be a pid; an integer, but not a
+    bool
+    """
+    return isinstance(val, int) and not isinstance(val, bool)
+
+
+def get_command_label(message):
+    """
+    get the command of the message for labelling the metrics; commands that
+    don't exist are all 'unknown', so that clients can't make up labels
+    """
+    if isinstance(message, dict) and message.get('command') in COMMANDS:
+        return message['command']
+    return 'unknown'
+
+
+def get_cache_key(message):
+    """
+    get a key identifying the request, for keeping its response.  The
+    generation sent by the client is not part of it
+    """
+    return json.dumps(
+        {key: val for key, val in message.items() if key != 'generation'},
+        sort_keys=True,
+        default=str,
+    )
+
+
+def get_not_modified_response(message, generation):
+    """
+    get the response telling a client that sent the current generation that
+    the queue was not modified
+    """
+    return dict(message, response=NOT_MODIFIED, generation=generation)
+
+
+def is_selected(entry, select):
+    """
+    True if the listing entry is one selected by a listing request, given
+    the arguments to JobIndex.select from _get_listing_selection
+    """
+    for name, key in [('pids', 'pid'), ('users', 'user'),
+                      ('statuses', 'status'), ('priorities', 'priority')]:
+        if name in select and entry[key] not in select[name]:
+            return False
+
+    return True
+
+
+def get_job_class(record):
+    """
+    get the class for a job saved by the server
+    """
+    if 'array_start' in record:
+        return ArrayJob
+    return Job
+
+
+class JobIndex(object):
+    """
+    The jobs in the queue, keyed by pid and indexed by priority and status,
+    by user, by the process running them, and by array for the elements of
+    arrays, so that lookups don't need to scan the whole queue.
+
+    Iteration is in order of submission, as are the lists returned by
+    get_user_jobs, select, and get_jobs for waiting jobs.
+
+    If a job's status changes, call reindex(job) to update the indexes.  If
+    anything else about a job changes, call touch(job), so the change is
+    seen by pop_changed.
+
+    The groups requested by waiting block jobs are also counted here, so
+    the blocked groups are always known without a scan; see get_blocked.
+    """
+    def __init__(self):
+        self.jobs = {}
+
+        # order of submission
+        self._seq = {}
+        self._nseq = 0
+
+        # the (priority, status) under which each job is indexed
+        self._keys = {}
+        self._by_key = {}
+        self._by_status = {}
+        self._by_user = {}
+        self._by_proc = {}
+        self._by_array = {}
+
+        # number of waiting block jobs requesting each group, and the number
+        # that requested no group, which block all groups
+        self._block_counts = {}
+        self._nblock_all = 0
+
+        # incremented each time the set of blocked groups changes
+        self.block_gen = 0
+
+        # pids of the jobs added, removed or changed since pop_changed was
+        # last called, or None before it is first called
+        self._changed = None
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def __iter__(self):
+        return iter(self.jobs.values())
+
+    def __contains__(self, pid):
+        return pid in self.jobs
+
+    def get(self, pid, default=None):
+        return self.jobs.get(pid, default)
+
+    def add(self, job):
+        """
+        add a job; a job with the same pid is replaced
+        """
+        pid = job['pid']
+        if pid in self.jobs:
+            self.remove(pid)
+
+        self.jobs[pid] = job
+        self._seq[pid] = self._nseq
+        self._nseq += 1
+        self._note_changed(pid)
+
+        self._by_user.setdefault(job['user'], {})[pid] = job
+        self._by_proc.setdefault(get_job_proc(job), {})[pid] = job
+        if 'array' in job:
+            self._by_array.setdefault(job['array'], {})[pid] = job
+        self._index(job)
+
+    def remove(self, pid):
+        """
+        remove the job with the given pid, returning it, or None if
+        it is not in the queue
+        """
+        job = self.jobs.pop(pid, None)
+        if job is None:
+            return None
+
+        del self._seq[pid]
+        self._note_changed(pid)
+        self._unindex(job)
+
+        ujobs = self._by_user[job['user']]
+        del ujobs[pid]
+        if not ujobs:
+            del self._by_user[job['user']]
+
+        proc = get_job_proc(job)
+        pjobs = self._by_proc[proc]
+        del pjobs[pid]
+        if not pjobs:
+            del self._by_proc[proc]
+
+        if 'array' in job:
+            ejobs = self._by_array[job['array']]
+            del ejobs[pid]
+            if not ejobs:
+                del self._by_array[job['array']]
+
+        return job
+
+    def reindex(self, job):
+        """
+        update the indexes after a change in status of the job
+        """
+        if job['pid'] not in self.jobs:
+            return
+
+        self._note_changed(job['pid'])
+        if self._keys[job['pid']] != (job['priority'], job['status']):
+            self._unindex(job)
+            self._index(job)
 
-        if udata['run'] < 0:
-            udata['run'] = 0
-        if udata['cores'] < 0:
-            udata['cores'] = 0
+    def touch(self, job):
+        """
+        note a change to the job other than to its status, such as its
+        reason for waiting
+        """
+        if job['pid'] in self.jobs:
+            self._note_changed(job['pid'])
 
-    def decrement_user_jobcount(self, job):
-        user = job['user']
-        udata = self.users.get(user, None)
-        if udata is None:
-            udata = self.add_new(user)
+    def pop_changed(self):
+        """
+        get the set of pids of the jobs added, removed or changed since the
+        last call.  None is returned if the changes are not known, the first
+        time this is called, or if more jobs changed than are in the queue
+        """
+        changed = self._changed
+        self._changed = set()
+        return changed
+
+    def _note_changed(self, pid):
+        if self._changed is not None:
+            self._changed.add(pid)
+            if len(self._changed) > len(self.jobs):
+                # the caller is better off looking at the whole queue, and
+                # this way the set can't grow without limit
+                self._changed = None
+
+    def get_jobs(self, priority=None, status=None):
+        """
+        get a list of jobs with the given priority and/or status
+        """
+        if priority is not None and status is not None:
+            jobs = self._by_key.get((priority, status), {})
+        elif status is not None:
+            jobs = self._by_status.get(status, {})
+        elif priority is not None:
+            jobs = [
+                job for job in self.jobs.values()
+                if job['priority'] == priority
+            ]
+            return jobs
+        else:
+            jobs = self.jobs
 
-        udata['total'] -= 1
-        if udata['total'] < 0:
-            udata['total'] = 0
+        return list(jobs.values())
 
-    def _new_user(self, user):
-        return {
-            'user': user,
-            'run': 0,  # running jobs
-            'total': 0,  # total jobs including not running
-            'cores': 0,
-            'limits': {},
-        }
+    def get_user_jobs(self, users, status=None):
+        """
+        get a list of jobs for the given users, optionally limited to those
+        with the given status
+        """
+        jobs = []
+        for user in users:
+            ujobs = self._by_user.get(user, {})
+            if status is None:
+                jobs += ujobs.values()
+            else:
+                jobs += [
+                    job for job in ujobs.values() if job['status'] == status
+                ]
 
-    def asdict(self):
-        return copy.deepcopy(self.users)
+        if len(users) > 1:
+            seq = self._seq
+            jobs.sort(key=lambda job: seq[job['pid']])
 
+        return jobs
 
-class Job(dict):
-    def __init__(self, spool_dir=None, **config):
-        self.spool_dir = spool_dir
-        self.update(config)
+    def select(self, pids=None, users=None, statuses=None,
+               priorities=None):
+        """
+        get a list of the jobs matching all of the criteria given, each a
+        list of the values allowed, or None to allow any
 
-        if 'require' not in self:
-            self['status'] = 'nevermatch'
-            self['reason'] = "'require' field not in message"
-        elif 'pid' not in self:
-            self['status'] = 'nevermatch'
-            self['reason'] = "'pid' field not in message"
-        elif 'user' not in self:
-            self['status'] = 'nevermatch'
-            self['reason'] = "'user' field not in message"
-        elif 'commandline' not in self:
-            self['status'] = 'nevermatch'
-            self['reason'] = "'commandline' field not in message"
+        The most selective index is used, so the cost is in proportion to
+        the number of jobs under that index rather than the size of the
+        queue
+        """
+        if pids is not None:
+            jobs = [
+                self.jobs[pid] for pid in dict.fromkeys(pids)
+                if pid in self.jobs
+            ]
+        elif users is not None:
+            jobs = [
+                job for user in dict.fromkeys(users)
+                for job in self._by_user.get(user, {}).values()
+            ]
+        elif statuses is not None and priorities is not None:
+            jobs = [
+                job for key in self._by_key
+                if key[0] in priorities and key[1] in statuses
+                for job in self._by_key[key].values()
+            ]
+        elif statuses is not None:
+            jobs = [
+                job for status in dict.fromkeys(statuses)
+                for job in self._by_status.get(status, {}).values()
+            ]
+        elif priorities is not None:
+            jobs = [
+                job for key in self._by_key
+                if key[0] in priorities
+                for job in self._by_key[key].values()
+            ]
         else:
-            self['status'] = 'wait'
-            self['reason'] = ''
+            return list(self.jobs.values())
 
-        self['priority'] = self['require'].get('priority', 'med')
-        if self['priority'] not in PRIORITY_LIST:
-            self['status'] = 'nevermatch'
-            self['reason'] = (
-                "priority must be on of: " + ",".join(PRIORITY_LIST)
+        if users is not None and pids is not None:
+            jobs = [job for job in jobs if job['user'] in users]
+        if statuses is not None:
+            jobs = [job for job in jobs if job['status'] in statuses]
+        if priorities is not None:
+            jobs = [job for job in jobs if job['priority'] in priorities]
+
+        seq = self._seq
+        jobs.sort(key=lambda job: seq[job['pid']])
+        return jobs
+
+    def get_array_elements(self, pid):
+        """
+        get a list of the elements in the queue of the array with the given
+        pid, which are those running
+        """
+        return list(self._by_array.get(pid, {}).values())
+
+    def get_proc_jobs(self, proc):
+        """
+        get a list of the jobs run by the process with the given pid
+        """
+        return list(self._by_proc.get(proc, {}).values())
+
+    def has_proc(self, proc):
+        """
+        True if the process with the given pid runs any job in the queue
+        """
+        return proc in self._by_proc
+
+    def count_by_key(self):
+        """
+        get the number of jobs for each (priority, status)
+        """
+        return {key: len(jobs) for key, jobs in self._by_key.items()}
+
+    def count(self, status=None):
+        """
+        number of jobs, optionally with the given status
+        """
+        if status is None:
+            return len(self.jobs)
+        return len(self._by_status.get(status, {}))
+
+    def get_blocked(self):
+        """
+        get the groups blocked by waiting block jobs
+
+        Returns
+        -------
+        groups, block_all: list, bool
+            The groups requested by waiting block jobs, and whether a waiting
+            block job requested no group, in which case all groups are
+            blocked
+        """
+        return list(self._block_counts), self._nblock_all > 0
+
+    def _count_blocking(self, job, delta):
+        """
+        add delta to the counts for the groups requested by the block job
+        """
+        groups = job.reqs.group
+        if len(groups) == 0:
+            self._nblock_all += delta
+            if self._nblock_all == 0 or self._nblock_all == delta:
+                self.block_gen += 1
+            return
+
+        counts = self._block_counts
+        for group in groups:
+            num = counts.get(group, 0) + delta
+            if num == 0:
+                del counts[group]
+                self.block_gen += 1
+            else:
+                if num == delta:
+                    self.block_gen += 1
+                counts[group] = num
+
+    def _index(self, job):
+        pid = job['pid']
+        key = (job['priority'], job['status'])
+        self._keys[pid] = key
+
+        # jobs only get the 'wait' status when they are added, so waiting
+        # jobs stay in order of submission
+        self._by_key.setdefault(key, {})[pid] = job
+        self._by_status.setdefault(key[1], {})[pid] = job
+
+        if key == ('block', 'wait'):
+            self._count_blocking(job, 1)
+
+    def _unindex(self, job):
+        pid = job['pid']
+        priority, status = self._keys.pop(pid)
+
+        jobs = self._by_key[(priority, status)]
+        del jobs[pid]
+        if not jobs:
+            del self._by_key[(priority, status)]
+
+        jobs = self._by_status[status]
+        del jobs[pid]
+        if not jobs:
+            del self._by_status[status]
+
+        if (priority, status) == ('block', 'wait'):
+            self._count_blocking(job, -1)
+
+
+class QueueReader(object):
+    """
+    Answers the read only commands, from the jobs in self.queue, a JobIndex,
+    the users in self.users, and the cluster status from self.get_status()
+
+    This is shared by JobQueue, which answers from the live queue, and
+    QueueSnapshot, which answers from a copy.  The reply is put in
+    self.response
+    """
+    def _process_read_request(self, message):
+        """
+        process a read only command, one of CACHED_COMMANDS, sending the
+        generation of the queue.  If the client sent the current generation,
+        it already has the answer and is told the queue was not modified
+        """
+        if message.get('generation') == self.generation:
+            self.response = get_not_modified_response(
+                message, self.generation,
             )
+            return
 
-        self['time_sub'] = time.time()
-        self['spool_fname'] = None
+        # the response must not depend on the generation sent, so it can
+        # be kept for other clients
+        self.response.pop('generation', None)
+
+        command = message['command']
+        if command == 'ls':
+            self._process_listing_request(message)
+        elif command == 'lsfull':
+            self._process_full_listing_request(message)
+        elif command == 'stat':
+            self._process_status_request(message)
+        elif command == 'users':
+            self._process_userlist_request()
+        elif command == 'user':
+            self._process_user_request(message)
 
-    def _normalize_require(self):
+        self.response['generation'] = self.generation
+
+    def _process_listing_request(self, message):
         """
-        deal with old names
+        list the jobs in the queue, each entry with
+
+            'user'
+            'pid'
+            'priority'
+            'time_sub'
+            'time_run'
+            'status'
+            'hosts'
+            'job_name'
+            'reason' if the job is waiting
+
+        Arrays are listed as a single entry, with the running elements
+        included in the status, hosts and time_run, and the numbers of
+        elements in each state in 'array'
+
+        The listing can be limited to jobs with given 'user', 'status',
+        'priority' and 'pid' values, each a single value or a list; these
+        are looked up in the queue indexes, so the cost is in proportion
+        to the number of jobs selected.  See _page_listing for sorting,
+        paging and choosing the fields in each entry.
+
+        The number of jobs selected, running and waiting, counting the
+        elements of arrays, are sent in 'counts'
         """
-        reqs = self['require']
-        if 'notgroup' in reqs:
-            reqs['not_group'] = reqs['notgroup']
+        select = self._get_listing_selection(message)
+        if select is None:
+            return
 
-    def spool(self):
-        if self['status'] == 'ready':
-            self['status'] = 'run'
+        statuses = select.get('statuses')
+
+        listing = []
+        seen = set()
+        nrun = 0
+        nwait = 0
+        for job in self.queue.select(**select):
+            if 'array' in job:
+                # elements are listed with their array
+                job = self.queue.get(job['array'])
+                if job is None:
+                    continue
 
-        fname = self.get_spool_fname()
+            if job['pid'] in seen:
+                continue
+            seen.add(job['pid'])
 
-        # just remove the old one first we could just rename, but things that
-        # were waiting maybe running now
+            r = self._get_listing_entry(job)
+            if statuses is not None and r['status'] not in statuses:
+                continue
 
-        self.unspool()
+            if 'array' in r:
+                nrun += r['array']['run']
+                nwait += r['array']['wait']
+            elif r['status'] == 'run':
+                nrun += 1
+            else:
+                nwait += 1
 
-        self['spool_fname'] = fname
-        self['spool_wait'] = WAIT_SLEEP
-        if self['status'] in ['ready', 'run']:
-            self['time_run'] = time.time()
+            listing.append(r)
+
+        listing = self._page_listing(listing, message)
+        if listing is None:
+            return
+
+        self.response['response'] = listing
+        self.response['counts'] = {
+            'njobs': nrun + nwait,
+            'nrun': nrun,
+            'nwait': nwait,
+        }
+
+    def _get_listing_entry(self, job):
+        """
+        get the entry for the job in the listing
+        """
+        r = {}
+        r['user'] = job['user']
+        r['pid'] = job['pid']
+        r['priority'] = job['priority']
+        r['time_sub'] = job['time_sub']
+        r['time_run'] = job['time_run']
+        r['status'] = job['status']
+        if r['status'] == 'run':
+            r['hosts'] = job['hosts']
         else:
-            self['time_run'] = None
+            # should we do this?
+            r['hosts'] = []
 
-        with open(fname, 'w') as fobj:
-            yaml.dump(dict(self), fobj)
+        if 'reason' in job:
+            r['reason'] = job['reason']
+        r['job_name'] = job.job_name
 
-    def unspool(self):
-        if self['spool_fname'] is not None:
-            if os.path.exists(self['spool_fname']):
-                os.remove(self['spool_fname'])
-            self['spool_fname'] = None
+        if isinstance(job, ArrayJob):
+            self._add_array_listing(r, job, self._get_elements(job))
 
-    def get_spool_fname(self, status=None):
-        if status is None:
-            status = self['status']
+        return r
 
-        return os.path.join(
-            self.spool_dir,
-            str(self['pid'])+'.'+status,
-        )
+    def _add_array_listing(self, r, array, elements):
+        """
+        add the state of the elements to the listing entry of the array
+        """
+        nrun = len(elements)
+        nwait = array.nwaiting
+        r['array'] = {
+            'start': array['array_start'],
+            'stop': array['array_stop'],
+            'run': nrun,
+            'wait': nwait,
+            'done': array.size - nwait - nrun,
+        }
 
-    def match(self, cluster, blocked_groups):
-        if self['status'] == 'nevermatch':
+        if elements:
+            r['status'] = 'run'
+            r['hosts'] = [h for job in elements for h in job['hosts']]
+            r['time_run'] = min(job['time_run'] for job in elements)
+
+    def _get_elements(self, array):
+        """
+        get the running elements of the array
+        """
+        return self.queue.get_array_elements(array['pid'])
+
+    def _process_full_listing_request(self, message):
+        """
+        Send everything about each job, including the elements of arrays.
+        The jobs are selected as for ls, but by their own status
+        """
+        select = self._get_listing_selection(message)
+        if select is None:
             return
-        if self['status'] != 'wait':
+
+        listing = [job.asdict() for job in self.queue.select(**select)]
+
+        listing = self._page_listing(listing, message)
+        if listing is None:
             return
 
-        # We don't block ourserlves
-        if self['priority'] == 'block':
-            blocked_groups = []
+        self.response['response'] = listing
 
-        # default to bycore
-        submit_mode = self['require'].get('mode', 'by_core')
-        # can also add reasons from the match methods
-        # later
+    def _get_listing_selection(self, message):
+        """
+        get the arguments to JobIndex.select for a listing request, or None
+        if they are not valid
+        """
+        try:
+            return get_listing_selection(message)
+        except ValueError as err:
+            self.response['error'] = str(err)
+            return None
 
-        if submit_mode in ('by_core', 'bycore'):
-            pmatch, match, hosts, reason = (
-                self._match_by_core(cluster, blocked_groups)
-            )
-        elif submit_mode in ('by_core1', 'bycore1'):
-            pmatch, match, hosts, reason = (
-                self._match_by_core1(cluster, blocked_groups)
-            )
-        elif submit_mode in ('by_node', 'bynode'):
-            pmatch, match, hosts, reason = (
-                self._match_by_node(cluster, blocked_groups)
-            )
-        elif submit_mode in ('by_host', 'byhost'):
-            pmatch, match, hosts, reason = (
-                self._match_by_host(cluster, blocked_groups)
-            )
-        elif submit_mode in ('by_group', 'bygroup'):
-            pmatch, match, hosts, reason = (
-                self._match_by_group(cluster, blocked_groups)
+    def _page_listing(self, listing, message):
+        """
+        sort the listing, take the page requested and keep the fields
+        requested, returning None if the request was not valid
+
+        The listing is sorted by the 'sort' field of the message, one of
+        LISTING_SORT_KEYS, by default time_sub; with a leading - the order
+        is reversed.  If 'limit' is sent, only that many entries are kept,
+        and if there are more 'next_cursor' is set in the response; send it
+        as 'cursor' to get the next page.  If 'fields' is sent, a list,
+        entries only have those fields.
+        """
+        sort = message.get('sort', 'time_sub')
+        field = str(sort).lstrip('-')
+        if field not in LISTING_SORT_KEYS:
+            self.response['error'] = 'sort must be one of %s' % (
+                ', '.join(LISTING_SORT_KEYS)
             )
-        else:
-            pmatch = False  # unknown request never mathces
-            reason = "bad submit_mode '%s'" % submit_mode
+            return None
 
-        if pmatch:
-            if match:
-                self['hosts'] = hosts
-                self['status'] = 'ready'
-                self['reason'] = ''
+        reverse = str(sort).startswith('-')
+        key = get_listing_sort_key(field)
+
+        limit = message.get('limit')
+        if limit is not None:
+            if (not isinstance(limit, int) or isinstance(limit, bool)
+                    or limit < 1):
+                self.response['error'] = 'limit must be a positive integer'
+                return None
+
+        cursor = message.get('cursor')
+        try:
+            if cursor is not None:
+                cursor = tuple(cursor)
+                if reverse:
+                    listing = [r for r in listing if key(r) < cursor]
+                else:
+                    listing = [r for r in listing if key(r) > cursor]
+
+            if limit is not None and limit < len(listing):
+                if reverse:
+                    page = heapq.nlargest(limit, listing, key=key)
+                else:
+                    page = heapq.nsmallest(limit, listing, key=key)
+                self.response['next_cursor'] = list(key(page[-1]))
             else:
-                self['status'] = 'wait'
-                self['reason'] = reason
+                page = sorted(listing, key=key, reverse=reverse)
+                self.response.pop('next_cursor', None)
+        except TypeError:
+            # either the cursor doesn't fit the sort key, or the values
+            # sorted on can't be compared with each other
+            try:
+                sorted(listing, key=key)
+            except TypeError:
+                self.response['error'] = (
+                    "can't sort by %s, its values are not all of one type"
+                    % field
+                )
+            else:
+                self.response['error'] = 'bad cursor %s' % (cursor,)
+            return None
 
-        else:
-            self['status'] = 'nevermatch'
-            self['reason'] = reason
+        fields = message.get('fields')
+        if fields is not None:
+            if (not isinstance(fields, list)
+                    or not all(isinstance(name, str) for name in fields)):
+                self.response['error'] = 'fields must be a list of strings'
+                return None
+
+            page = [
+                {name: r[name] for name in fields if name in r}
+                for r in page
+            ]
+
+        return page
+
+    def _process_userlist_request(self):
+        self.response['response'] = self.users.asdict()
+
+    def _process_user_request(self, message):
+        ud = self.users.asdict()
+        self.response['response'] = {
+            user: ud[user] for user in ud if user == message['user']
+        }
+
+    def _process_status_request(self, message):
+        self.response['response'] = self.get_status()
+
+
+class QueueSnapshot(QueueReader):
+    """
+    A copy of the queue as it was at one generation, from which the read
+    only commands can be answered by other threads while the queue goes on
+    changing; see JobQueue.get_snapshot
+
+    The copies of the jobs are not changed afterwards.  They are indexed
+    on first use, by the thread answering the request rather than the one
+    that made the snapshot.
+
+    Requests are answered one at a time, and the encoded responses kept,
+    so the same request sent by many clients at once is only answered once.
+
+    Parameters
+    ----------
+    generation: int
+        The generation of the queue
+    jobs: dict
+        Copies of the jobs keyed by pid, in order of submission
+    status: dict
+        The cluster status
+    users: Users
+        A copy of the users
+    timers: Timers, optional
+        Where the time spent encoding responses is added
+    """
+    def __init__(self, generation, jobs, status, users, timers=None):
+        self.generation = generation
+        self.jobs = jobs
+        self.status = status
+        self.users = users
+        self.timers = timers
+
+        self.response = None
+        self._queue = None
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    @property
+    def queue(self):
+        """
+        the index of the copies of the jobs, made on first use
+        """
+        if self._queue is None:
+            queue = JobIndex()
+            for job in self.jobs.values():
+                queue.add(job)
+            self._queue = queue
 
-    def match_users(self, users):
+        return self._queue
+
+    def get_status(self):
+        return self.status
+
+    def get_cached_response(self, message, encoding):
         """
-        ret False if user specifications are not met
+        get the encoded response to a read only command if it is already
+        known, otherwise None.  This never waits for other threads
+        """
+        if message.get('generation') == self.generation:
+            return encode(
+                get_not_modified_response(message, self.generation),
+                encoding,
+            )
 
-        users is just a dictionary
+        return self._cache.get((encoding, get_cache_key(message)))
+
+    def get_encoded_response(self, message, encoding):
         """
+        answer a read only command, getting the response encoded as bytes
+
+        Parameters
+        ----------
+        message: dict
+            The request; the command must be one of CACHED_COMMANDS
+        encoding: int
+            The encoding, see wq.protocol
+        """
+        body = self.get_cached_response(message, encoding)
+        if body is not None:
+            return body
 
-        # if user is not even known, then we are good
-        if self['user'] in users:
-            udata = users.get(self['user'])
-            # if no limits are specified, we are good
-            ulimits = udata['limits']
-            if ulimits:
+        key = (encoding, get_cache_key(message))
+        with self._lock:
+            body = self._cache.get(key)
+            if body is None:
+                self.response = copy.deepcopy(message)
+                self._process_read_request(message)
 
-                if 'run' in ulimits:
-                    nrun_max = ulimits['run']
-                elif 'Njobs' in ulimits:
-                    nrun_max = ulimits['Njobs']
-                else:
-                    nrun_max = -1
+                start = time.time()
+                body = encode(self.response, encoding)
+                if self.timers is not None:
+                    self.timers.add('encode', time.time() - start)
 
-                if nrun_max is not None and nrun_max >= 0:
-                    # this is the actual number of jobs the user has running
-                    nrun = udata.get('run', 0)
-                    if nrun >= nrun_max:
-                        return False
+                if 'error' not in self.response:
+                    if len(self._cache) >= MAX_RESPONSE_CACHE:
+                        self._cache.clear()
+                    self._cache[key] = body
 
-                if 'cores' in ulimits:
-                    ncores_max = ulimits['cores']
-                elif 'Ncores' in ulimits:
-                    ncores_max = ulimits['Ncores']
-                else:
-                    ncores_max = -1
+        return body
 
-                if ncores_max is not None and ncores_max >= 0:
-                    # this is the actual number of cores the user has
-                    ncores = udata.get('cores', 0)
-                    if ncores >= ncores_max:
-                        return False
 
-        return True
+class JobQueue(QueueReader):
+    """
+    The queue of jobs and the state of the cluster
+
+    The jobs, user limits and node online states are saved by the named
+    backend, by default a journal in the spool directory, from which they
+    are recovered on startup; see wq.backends.  If compat_spool is True a
+    pid.wait or pid.run file is also kept for every job, as older versions
+    did; otherwise these are only written for clients that wait for them.
+
+    Changes are made durable at commit, as set by durability, one of
+    'none', 'batch' or 'always'; see wq.persist.  With group_commit the
+    owner calls commit, e.g. once per pass of a server loop.  Otherwise
+    each call that changes the queue commits before returning.
+    """
+    def __init__(self, cluster_file, spool_dir, loglevel='info',
+                 compat_spool=False, incremental_load=False,
+                 durability=DEFAULT_DURABILITY, group_commit=False,
+                 backend=DEFAULT_BACKEND):
 
-    def _get_req_list(self, reqs, key):
-        """
-        If a scalar is found, itis converted to a list using [val]
-        """
-        val = reqs.get(key, [])
-        if not isinstance(val, list):
-            val = [val]
-        return val
+        self.loglevel = loglevel.upper()
+        logging.basicConfig(stream=sys.stdout)
+        self.logger = logging.getLogger('Server')
+        self.logger.setLevel(getattr(logging, self.loglevel))
 
-    def _match_by_core(self, cluster, bgroups):
-        pmatch = False
-        match = False
-        hosts = []  # actually matched hosts
-        reason = ''
+        self.spool_dir = spool_dir
+        self.compat_spool = compat_spool
+        self.group_commit = group_commit
+        self.setup_spool()
 
-        reqs = self['require']
+        self.logger.info('Using the %s backend' % backend)
+        self.backend = get_backend(backend, spool_dir, durability=durability)
 
-        num, reason = _get_dict_int(reqs, 'N', 1)
-        if reason:
-            return pmatch, match, hosts, reason
+        # for the pid.wait and pid.run files
+        self.committer = Committer(durability=durability)
 
-        threads, reason = _get_dict_int(reqs, 'threads', 1)
-        if reason:
-            return pmatch, match, hosts, reason
+        self.logger.info('Loading cluster from: %s' % cluster_file)
+        self.cluster = Cluster(cluster_file)
+        self.load_nodes()
+        self.queue = JobIndex()
 
-        if threads < 1:
-            threads = 1
+        # changes in job state, e.g. jobs that started running; these
+        # are collected by the server using pop_events()
+        self.events = []
 
-        if num % threads > 0:
-            reason = 'Number of requested cores not divisible by threads'
-            return pmatch, match, hosts, reason
+        self.metrics = Metrics()
 
-        nump = num
+        # always on timers, and cProfile when started with the profile
+        # command; see wq.profiling
+        self.timers = Timers()
+        self.profiler = Profiler(spool_dir)
 
-        min_mem, reason = _get_dict_float(reqs, 'min_mem', 0.0)
-        if reason:
-            return pmatch, match, hosts, reason
+        # what the scheduler needs to look at on the next pass
+        self._sched_all = True
+        self._sched_users = set()
 
-        block_flag = False
-        for h in sorted(cluster.nodes):
-            nd = cluster.nodes[h]
-            if not nd.online:
-                continue
-            if nd.mem < min_mem:
-                continue
+        # mask of the blocked groups, and the queue.block_gen it is for
+        self._blocked_mask_cache = (None, 0)
 
-            # is this node actually what we want
-            ing = self._get_req_list(reqs, 'group')
-            if len(ing) > 0:  # any group in any group
-                ok = False
-                for g in ing:
-                    if g in nd.grps:
-                        ok = True
-                        break
-
-                if not ok:
-                    continue  # not in the group
-
-            ing = self._get_req_list(reqs, 'not_group')
-            if len(ing) > 0:  # any group in any group
-                ok = True
-                for g in ing:
-                    if g in nd.grps:
-                        ok = False
-                        break
-
-                if not ok:
-                    continue  # not in the group
-
-            # usable cores must be multiple of
-            # number of threads requested
-            pucores = (nd.ncores//threads)*threads
-
-            if pucores >= nump:
-                pmatch = True
-            else:
-                nump -= pucores
+        # id for the next job submitted with sub_many.  It is saved, so ids
+        # are not used again after a restart, even when the jobs that had
+        # them are gone
+        self._next_id = max(FIRST_JOB_ID, self.backend.load_next_id() or 0)
 
-            nfree = nd.ncores-nd.used
-            nfree = (nfree//threads)*threads
+        # counts the changes to the queue, users and nodes; read only
+        # commands are answered from a snapshot made when it changes.  It
+        # starts from the time in microseconds so that it still goes up
+        # when the server is restarted
+        self.generation = int(time.time() * 1000000)
+        self._snapshot = None
 
-            if len(bgroups) > 0:  # any group in any group
-                ok = True
-                for g in bgroups:
-                    if g in nd.grps:
-                        ok = False
-                        block_flag = True
-                        break
-                if not ok:
-                    nfree = 0
+        self.load_users()
+        self.load_spool(incremental=incremental_load)
 
-            if nfree >= num:
-                hosts += [h]*num
-                num = 0
-                match = True
-                break
-            else:
-                num -= nfree
-                hosts += [h]*nfree
+        self.verbosity = 1
 
-        if not pmatch:
-            reason = 'Not enough cores or mem satistifying condition.'
-        elif not match:
-            if block_flag:
-                reason = ('Not enough free cores or cores waiting '
-                          'for a blocking job.')
-            else:
-                reason = 'Not enough free cores.'
+    def setup_spool(self):
+        if not os.path.exists(self.spool_dir):
+            self.logger.info('making spool dir: %s' % self.spool_dir)
+            os.makedirs(self.spool_dir)
 
-        return pmatch, match, hosts, reason
+    def users_file(self):
+        return os.path.join(self.spool_dir, 'users.yaml')
+
+    def load_users(self):
+        self.users = Users()
+
+        data = self.backend.load_users()
+        if data is not None:
+            self.users.fromdict(data)
+        else:
+            # saved by an older version, or by another backend
+            fname = self.users_file()
+            self.logger.info('Loading user info from: %s' % fname)
+            self.users.fromfile(fname)
+
+    def save_users(self):
+        self.logger.debug('saving users')
+        self.backend.save_users(self.users)
+        self._changed()
+        self._autocommit()
 
-    def _match_by_core1(self, cluster, bgroups):
+    def load_nodes(self):
         """
-        Get cores all from one node.
+        set nodes online or offline as they were saved
         """
-        pmatch = False
-        match = False
-        hosts = []  # actually matched hosts
-        reason = ''
+        for host, online in self.backend.load_nodes().items():
+            if host in self.cluster.nodes:
+                self.cluster.set_online(host, online)
 
-        reqs = self['require']
+    def commit(self):
+        """
+        carry out the writes made since the last commit, making them durable
+        as requested
+        """
+        start = time.time()
+        self.backend.commit()
+        self.committer.commit()
+        self.timers.add('commit', time.time() - start)
 
-        num, reason = _get_dict_int(reqs, 'N', 1)
-        if reason:
-            return pmatch, match, hosts, reason
+    def close(self):
+        """
+        commit and close the backend
+        """
+        self.committer.commit()
+        self.backend.close()
 
-        nump = num
+    def _autocommit(self):
+        if not self.group_commit:
+            self.commit()
 
-        min_mem, reason = _get_dict_float(reqs, 'min_mem', 0.0)
+    def load_spool(self, incremental=False):
+        """
+        load the jobs from the backend.  If nothing was saved yet, they are
+        read from the pid.wait and pid.run files written by older versions
+
+        Parameters
+        ----------
+        incremental: bool, optional
+            If True, only read the saved jobs here; they are then added to
+            the queue by calls to load_some, which lets a server answer
+            clients in between.  Until that is done, loading is True, the
+            scheduler does not run, and process_message finishes the
+            loading for commands that change the queue.
+        """
+        self.logger.info('Loading jobs')
+        records = self.backend.load_jobs()
+        self._migrating = records is None
+        if self._migrating:
+            self.logger.info('Loading jobs from: %s' % self.spool_dir)
+            records = self._read_spool_files()
+
+        self.logger.info('found %d jobs' % len(records))
+        self._to_load = records
+        self._nloaded = 0
+
+        if not incremental:
+            self.finish_loading()
+
+    @property
+    def loading(self):
+        """
+        True if saved jobs are still being loaded
+        """
+        return self._to_load is not None
 
-        if reason:
-            return pmatch, match, hosts, reason
+    def load_some(self, njobs):
+        """
+        add up to njobs of the saved jobs to the queue.  The counts for the
+        users and the cluster are updated once for the whole chunk
+        """
+        if self._to_load is None:
+            return
 
-        block_flag = False
-        for h in sorted(cluster.nodes):
-            nd = cluster.nodes[h]
-            if not nd.online:
-                continue
-            if nd.mem < min_mem:
+        start = self._nloaded
+        records = self._to_load[start:start+njobs]
+        self._nloaded += len(records)
+
+        jobs = []
+        for record in records:
+            job = get_job_class(record).from_record(self.spool_dir, record)
+            if job['status'] not in ('wait', 'run'):
+                self.logger.info(
+                    "could not load job %s: '%s'" % (
+                        record.get('pid'), job['reason'],
+                    )
+                )
                 continue
 
-            # is this node actually what we want
-            ing = self._get_req_list(reqs, 'group')
-            if len(ing) > 0:  # any group in any group
-                ok = False
-                for g in ing:
-                    if g in nd.grps:
-                        ok = True
-                        break
-                if not ok:
-                    continue  # not in the group
-
-            ing = self._get_req_list(reqs, 'not_group')
-            if len(ing) > 0:  # any group in any group
-                ok = True
-                for g in ing:
-                    if g in nd.grps:
-                        ok = False
-                        break
-                if not ok:
-                    continue  # not in the group
-
-            if nd.ncores >= nump:
-                pmatch = True
-            else:
-                pass
+            jobs.append(job)
 
-            nfree = nd.ncores-nd.used
+        # here we need to reserve the cluster and increment the user data
+        self.users.count_jobs(jobs)
+        self.cluster.reserve([
+            host
+            for job in jobs if job['status'] == 'run'
+            for host in job['hosts']
+        ])
 
-            if len(bgroups) > 0:  # any group in any group
-                ok = True
-                for g in bgroups:
-                    if g in nd.grps:
-                        ok = False
-                        block_flag = True
-                        break
-                if not ok:
-                    nfree = 0
+        for job in jobs:
+            self._add_job(job)
 
-            if nfree >= num:
-                hosts += [h]*num
-                num = 0
-                match = True
-                break
-            else:
-                pass
+        if self._nloaded >= len(self._to_load):
+            self._to_load = None
 
-        if not pmatch:
-            reason = 'Not a node with that many cores.'
-        elif not match:
-            if block_flag:
-                reason = ('Not enough free cores or cores waiting '
-                          'for a blocking job.')
+            if self._migrating:
+                self.backend.save_jobs(self.queue)
             else:
-                reason = 'Not enough free cores on any one node.'
+                self.backend.maintain(self.queue)
+            self._mark_all()
 
-        return pmatch, match, hosts, reason
-
-    def _match_by_node(self, cluster, bgroups):
-        pmatch = False
-        match = False
-        hosts = []  # actually matched hosts
-        reason = ''
+            # always print these on startup
+            print_users(self.users.asdict())
+            print_status(self.cluster.status())
 
-        reqs = self['require']
-
-        num, reason = _get_dict_int(reqs, 'N', 1)
-        if reason:
-            return pmatch, match, hosts, reason
+        self._autocommit()
 
-        nump = num
+    def finish_loading(self):
+        """
+        add all remaining saved jobs to the queue
+        """
+        if self._to_load is not None:
+            self.load_some(len(self._to_load))
 
-        min_mem, reason = _get_dict_float(reqs, 'min_mem', 0.0)
-        if reason:
-            return pmatch, match, hosts, reason
+    def _read_spool_files(self):
+        """
+        read the pid.wait and pid.run files
+        """
+        records = []
+        pattern = os.path.join(self.spool_dir, '*')
+        flist = glob.glob(pattern)
+        for fname in sorted(flist):
+            if fname[-4:] == '.run' or fname[-5:] == '.wait':
+                with open(fname) as fobj:
+                    try:
+                        record = yaml_load(fobj)
+                    except YAMLError as err:
+                        self.logger.info('could not load job file: %s' % fname)
+                        self.logger.info("caught exception: '%s'" % str(err))
+                        continue
 
-        min_cores, reason = _get_dict_int(reqs, 'min_cores', 0)
-        if reason:
-            return pmatch, match, hosts, reason
+                if isinstance(record, dict):
+                    record['spool_fname'] = fname
+                    records.append(record)
 
-        block_flag = False
-        for h in sorted(cluster.nodes):
-            nd = cluster.nodes[h]
-            if not nd.online:
-                continue
-            if nd.mem < min_mem:
-                continue
-            if nd.ncores < min_cores:
-                continue
+        return records
 
-            # is this node actually what we want
-            ing = self._get_req_list(reqs, 'group')
-            if len(ing) > 0:  # any group in any group
-                ok = False
-                for g in ing:
-                    if g in nd.grps:
-                        ok = True
-                        break
-
-                if not ok:
-                    continue  # not in the group
-
-            ing = self._get_req_list(reqs, 'not_group')
-            if len(ing) > 0:  # any group in any group
-                ok = True
-                for g in ing:
-                    if g in nd.grps:
-                        ok = False
-                        break
-
-                if not ok:
-                    continue  # not in the group
-
-            nump -= 1
-            if nump == 0:
-                pmatch = True
-
-            ok = True
-            if len(bgroups) > 0:  # any group in any group ##########nfree?
-                for g in bgroups:
-                    if g in nd.grps:
-                        ok = False
-                        block_flag = True
-                        break
-
-            if nd.used == 0 and ok:
-                num -= 1
-                hosts += [h]*nd.ncores
-                if num == 0:
-                    match = True
-                    break
+    def process_message(self, message):
+        read_only = (
+            isinstance(message, dict)
+            and message.get('command') in READ_ONLY_COMMANDS
+        )
+        if self.loading and not read_only:
+            self.finish_loading()
 
-        if not pmatch:
-            reason = 'Not enough total cores satistifying condition.'
-        elif not match:
-            if block_flag:
-                reason = ('Not enough free cores or cores '
-                          'waiting for a blocking job.')
-            else:
-                reason = 'Not enough free cores.'
+        # we will overwrite this
+        if isinstance(message, dict) and 'jobs' in message:
+            # no need to send back all the jobs of a sub_many
+            self.response = copy.deepcopy({
+                key: val for key, val in message.items() if key != 'jobs'
+            })
+        else:
+            self.response = copy.deepcopy(message)
 
-        return pmatch, match, hosts, reason
+        if not isinstance(message, dict):
+            self.response = {
+                "error": "message should be a dictionary, got '%s'" % message
+            }
+        elif 'command' not in message:
+            self.response['error'] = (
+                "message should contain a "
+                "command, got '%s'" % message
+            )
+        elif message['command'] in CACHED_COMMANDS:
+            self._process_read_request(message)
+        else:
+            self._process_command(message)
 
-    def _match_by_host(self, cluster, bgroups):
+        self._autocommit()
 
-        pmatch = False
-        match = False
-        hosts = []  # actually matched hosts
-        reason = ''
+    def get_encoded_response(self, message, encoding):
+        """
+        answer a read only command from a snapshot of the queue, getting the
+        response encoded as bytes.  See QueueSnapshot.get_encoded_response
+        """
+        return self.get_snapshot().get_encoded_response(message, encoding)
 
-        reqs = self['require']
+    def get_snapshot(self):
+        """
+        get a QueueSnapshot of the queue as it is now
 
-        h = reqs.get('host', None)
-        if h is None:
-            reason = "'host' field not in requirements"
-            return pmatch, match, hosts, reason
+        A snapshot is made at most once for each generation.  Only the jobs
+        changed since the last one are copied, the rest are shared with it.
+        """
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.generation == self.generation:
+            return snapshot
+
+        start = time.time()
+        changed = self.queue.pop_changed()
+        if snapshot is None or changed is None:
+            jobs = {job['pid']: job.copy() for job in self.queue}
+        else:
+            jobs = dict(snapshot.jobs)
+            for pid in changed:
+                job = self.queue.get(pid)
+                if job is None:
+                    jobs.pop(pid, None)
+                else:
+                    jobs[pid] = job.copy()
 
-        # make sure the node name exists
-        if h not in cluster.nodes:
-            reason = "host '%s' does not exist" % h
-            return pmatch, match, hosts, reason
+        self._snapshot = QueueSnapshot(
+            self.generation, jobs, self.cluster.status(), self.users.copy(),
+            timers=self.timers,
+        )
+        self.timers.add('snapshot', time.time() - start)
+        return self._snapshot
 
-        nd = cluster.nodes[h]
+    def get_status(self):
+        return self.cluster.status()
 
-        if not nd.online:
-            reason = "host is offline"
-            return pmatch, match, hosts, reason
+    def _changed(self):
+        """
+        the queue, users or nodes changed, so the snapshot is stale.  This
+        is called next to each change that is saved to the backend, so
+        requests that change nothing, such as notify for an unknown pid,
+        leave cached replies valid
+        """
+        self.generation += 1
 
-        for g in nd.grps:
-            if g in bgroups:
-                reason = "host in blocked group"
-                return pmatch, match, hosts, reason
+    def refresh(self):
+        """
+        refresh the job list
 
-        num, reason = _get_dict_int(reqs, 'N', 1)
-        if reason:
-            return pmatch, match, hosts, reason
+        This is the key, as it tells the jobs when they can run.
 
-        if nd.ncores >= num:
-            pmatch = True
+            - Remove jobs where the pid no longer is valid.
+            - Run the scheduler, which tries to run waiting jobs if
+              anything happened that could let them run.
 
-        nfree = nd.ncores-nd.used
-        if nfree >= num:
-            hosts += [h]*num
-            num = 0
-            match = True
-        else:
-            reason = "Not enough free cores on "+h
+        This is profiled after profile start.
+        """
+        self.profiler.call(self._refresh)
 
-        return pmatch, match, hosts, reason
+    def _refresh(self):
+        start = time.time()
 
-    def _match_by_group(self, cluster, bgroups):
+        # one look at the process table for the whole queue
+        live_pids = liveness.get_live_pids()
 
-        pmatch = False
-        match = False
-        hosts = []  # actually matched hosts
-        reason = ''
+        for job in list(self.queue):
+            # see if the process is still running, if not remove the job
+            proc = get_job_proc(job)
+            if live_pids is not None:
+                exists = proc in live_pids
+            else:
+                exists = liveness.pid_exists(proc)
 
-        reqs = self['require']
-        g = reqs.get('group', None)
-        if not g:
-            pmatch = False
-            reason = 'Need to specify group'
-        else:
-            for h in sorted(cluster.nodes):
-                nd = cluster.nodes[h]
-                if not nd.online:
-                    continue
+            if not exists:
+                self.logger.debug(
+                    "removing job %s, pid no longer valid" % job['pid']
+                )
+                self._drop_job(job)
 
-                if g in nd.grps:
-                    pmatch = True
-                    match = True
-                    if nd.used > 0:
-                        match = False  # we actually demand the entire group
-                        reason = 'Host '+h+' not entirely free.'
-                        break
-                    ok = True
-                    for g in nd.grps:
-                        if g in bgroups:
-                            ok = False
-                            break
-                    if not ok:
-                        match = False
-                        reason = 'Host '+h+' in a blocked group.'
-                        break
+        self.schedule()
 
-                    else:
-                        hosts += [h]*nd.ncores
+        self.backend.maintain(self.queue)
 
-            if not pmatch:
-                reason = 'Not a single node in that group'
-        return pmatch, match, hosts, reason
+        self._autocommit()
+        self.metrics.refresh_seconds.observe(time.time() - start)
 
-    def asdict(self):
-        d = {}
-        for k in self:
-            d[k] = self[k]
-        return d
+    def remove_exited(self, pid):
+        """
+        the process running jobs has exited; remove its jobs and run
+        anything that can now run.  This is profiled after profile start
+        """
+        self.profiler.call(self._remove_exited, pid)
 
+    def _remove_exited(self, pid):
+        jobs = self.queue.get_proc_jobs(pid)
+        if not jobs:
+            return
 
-class JobQueue(object):
-    def __init__(self, cluster_file, spool_dir, loglevel='info'):
+        for job in jobs:
+            self.logger.debug(
+                "removing job %s, process %s exited" % (job['pid'], pid)
+            )
+            self._drop_job(job)
 
-        self.loglevel = loglevel.upper()
-        logging.basicConfig(stream=sys.stdout)
-        self.logger = logging.getLogger('Server')
-        self.logger.setLevel(getattr(logging, self.loglevel))
+        self.schedule()
+        self._autocommit()
 
-        self.spool_dir = spool_dir
-        self.setup_spool()
+    def schedule(self):
+        """
+        Try to run waiting jobs, in order of priority and then submission
+
+        Only jobs whose outcome could have changed since the last pass are
+        examined.  Nothing can newly run unless cores were freed, a node
+        came online, a blocking job went away, or a user's limits changed;
+        in the latter case only that user's jobs are examined.  See
+        _mark_all and _mark_user.
+
+        Within a pass resources only get used up, never freed, so once a
+        job fails to match, any later job with the same requirements will
+        also fail and need not be matched again.  Similarly, once a user is
+        over their limits, their later jobs are skipped, and once the
+        cluster is full the pass is over.
+        """
 
-        self.logger.info('Loading cluster from: %s' % cluster_file)
-        self.cluster = Cluster(cluster_file)
-        self.queue = []
+        if self.loading:
+            # we don't know all the jobs yet
+            return
 
-        self.load_users()
-        self.load_spool()
+        if self._sched_all:
+            jobs = None
+        elif self._sched_users:
+            jobs = self.queue.get_user_jobs(self._sched_users, status='wait')
+        else:
+            return
 
-        # always print these on startup
-        print_users(self.users.asdict())
-        print_status(self.cluster.status())
+        self._sched_all = False
+        self._sched_users = set()
 
-        self.verbosity = 1
+        if self.cluster.is_full():
+            # nothing can run; we will be told when cores are freed
+            return
 
-    def setup_spool(self):
-        if not os.path.exists(self.spool_dir):
-            self.logger.info('making spool dir:', self.spool_dir)
-            os.makedirs(self.spool_dir)
+        start = time.time()
+        nevents = len(self.events)
 
-    def users_file(self):
-        return os.path.join(self.spool_dir, 'users.yaml')
+        nexamined = self._schedule_pass(jobs)
+        if nexamined > 0:
+            # jobs may have been started or had their reason updated
+            self._changed()
 
-    def load_users(self):
-        self.users = Users()
-        fname = self.users_file()
-        self.logger.info('Loading user info from: %s' % fname)
-        self.users.fromfile(fname)
+        nstarted = sum(
+            1 for event in self.events[nevents:] if event['event'] == 'run'
+        )
+        self.metrics.schedule_seconds.observe(time.time() - start)
+        self.metrics.schedule_examined.observe(nexamined)
+        self.metrics.schedule_started.observe(nstarted)
 
-    def save_users(self):
-        fname = self.users_file()
-        self.logger.debug('saving users to: %s' % fname)
-        self.users.tofile(fname)
+    def _schedule_pass(self, jobs):
+        """
+        a pass of the scheduler over the waiting jobs, or the list of jobs
+        if sent, returning the number of jobs examined
+        """
+        nexamined = 0
 
-    def load_spool(self):
-        self.logger.info('Loading jobs from: %s' % self.spool_dir)
-        pattern = os.path.join(self.spool_dir, '*')
-        flist = glob.glob(pattern)
-        for fname in sorted(flist):
-            if fname[-4:] == '.run' or fname[-5:] == '.wait':
-                with open(fname) as fobj:
-                    try:
-                        job_config = yaml_load(fobj)
-                        job = Job(spool_dir=self.spool_dir, **job_config)
-                    except YAMLError as err:
-                        self.logger.info('could not load job file: %s' % fname)
-                        self.logger.info("caught exception: '%s'" % str(err))
-                        job = None
+        # outcome of matching, keyed by the requirements
+        failed = {}
+        over_limits = set()
 
-                if job is not None:
-                    # increment the total job count
-                    self.users.increment_user_jobcount(job)
-                    if job['status'] == 'run':
-                        # here we need to reserve the cluster and increment the
-                        # user data
-                        self.cluster.reserve(job['hosts'])
-                        # increment count of running jobs and cores used
-                        self.users.increment_user_running(job)
+        blocked_mask = 0
+        have_blocked_mask = False
+        for priority in PRIORITY_LIST:
+            if jobs is None:
+                pjobs = self.queue.get_jobs(priority=priority, status='wait')
+            else:
+                pjobs = [job for job in jobs if job['priority'] == priority]
+
+            for job in pjobs:
+                nexamined += 1
+                user = job['user']
+                if user in over_limits or not job.match_users(self.users):
+                    # blame yourself
+                    job['reason'] = 'user limits exceeded'
+                    self.queue.touch(job)
+                    over_limits.add(user)
+                    continue
 
-                    self.queue.append(job)
+                # see if we can now run the job.  After all blocked jobs have
+                # been scheduled (or not) we update the list of blocked
+                # groups (it can't change later)
+                if priority != 'block' and not have_blocked_mask:
+                    blocked_mask = self._blocked_mask()
+                    have_blocked_mask = True
+
+                key = (priority == 'block', job.get_match_key())
+                if key in failed:
+                    job['status'], job['reason'] = failed[key]
+                    self.queue.touch(job)
+                    continue
 
-    def process_message(self, message):
-        # we will overwrite this
-        self.response = copy.deepcopy(message)
+                self._match(job, blocked_mask)
+
+                if job['status'] == 'ready' and isinstance(job, ArrayJob):
+                    self._run_elements(job, blocked_mask)
+                    if self.cluster.is_full():
+                        return nexamined
+                elif job['status'] == 'ready':
+                    self.cluster.reserve(job['hosts'])
+                    # sets status to 'run' and records it, replacing any
+                    # pid.wait file with a pid.run file
+                    self._spool_run(job)
+
+                    # keep statistics for each user
+                    self.users.increment_user_running(job)
+                    self._emit_run(job)
+                    self.queue.reindex(job)
+
+                    if self.cluster.is_full():
+                        return nexamined
+                else:
+                    failed[key] = (job['status'], job['reason'])
+                    self.queue.reindex(job)
 
-        if not isinstance(message, dict):
-            self.response = {
-                "error": "message should be a dictionary, got '%s'" % message
-            }
-        elif 'command' not in message:
-            self.response['error'] = (
-                "message should contain a "
-                "command, got '%s'" % message
-            )
-        else:
-            self._process_command(message)
+        return nexamined
 
-    def refresh(self):
+    def _match(self, job, blocked_mask):
         """
-        refresh the job list
+        match the job to the nodes, timing it
+        """
+        start = time.time()
+        job.match(self.cluster, blocked_mask)
+        self.timers.add('match', time.time() - start)
 
-        This is the key, as it tells the jobs when they can run.
+    def _mark_all(self):
+        """
+        something happened that could let any waiting job run, such as cores
+        being freed
+        """
+        self._sched_all = True
 
-            - Remove jobs where the pid no longer is valid.
-        Otherwise run match(cluster) and
-            - are the requirements met and we can run?
-            - note we should have no 'nevermatch' status here
+    def _mark_user(self, user):
+        """
+        something happened that could let the user's waiting jobs run, such
+        as a change in their limits
+        """
+        self._sched_users.add(user)
 
+    def pop_events(self):
+        """
+        get the list of events since the last call, and clear it
         """
+        events = self.events
+        self.events = []
+        return events
+
+    def _emit_run(self, job):
+        if job.get('time_run') is not None:
+            self.metrics.job_wait_seconds.observe(
+                job['time_run'] - job['time_sub'], [job['priority']],
+            )
 
-        pids_to_del = []
-        blocked_groups = []
-        have_blocked_groups = False
-        for priority in PRIORITY_LIST:
-            for job in self.queue:
-                if job['priority'] != priority:
-                    continue
-                # job was told to run.
-                # see if the pid is still running, if not remove the job
-                if not self._pid_exists(job['pid']):
-                    self.logger.debug(
-                        "removing job %s, pid no longer valid" % job['pid']
-                    )
-                    pids_to_del.append(job['pid'])
+        event = {
+            'event': 'run',
+            'pid': job['pid'],
+            'hosts': job['hosts'],
+        }
+        if 'array' in job:
+            event['array'] = job['array']
+            event['index'] = job['index']
+        self.events.append(event)
+
+    def _add_job(self, job):
+        self.queue.add(job)
+        self._changed()
+
+        last_id = job['pid']
+        if isinstance(job, ArrayJob):
+            last_id = job.get_element_id(job['array_stop'])
+        if last_id >= self._next_id:
+            self._next_id = last_id + 1
+        self.events.append({
+            'event': 'add',
+            'pid': job['pid'],
+            'proc': get_job_proc(job),
+        })
+
+    def _remove_job(self, job):
+        start = time.time()
+        if job['spool_fname'] is not None:
+            self.committer.remove(job['spool_fname'])
+        self.backend.remove_job(job)
+        self.timers.add('spool', time.time() - start)
+
+        self.queue.remove(job['pid'])
+        self._changed()
+        event = {
+            'event': 'remove',
+            'pid': job['pid'],
+            'proc': get_job_proc(job),
+            'hosts': job['hosts'] if job['status'] == 'run' else [],
+        }
+        if 'array' in job:
+            event['array'] = job['array']
+        self.events.append(event)
+
+    def _spool_submit(self, job):
+        start = time.time()
+        self._spool(job)
+        self.backend.add_job(job)
+        self.timers.add('spool', time.time() - start)
+
+    def _spool_run(self, job):
+        start = time.time()
+        self._spool(job)
+        self.backend.update_job(job, {
+            'status': job['status'],
+            'hosts': job['hosts'],
+            'time_run': job['time_run'],
+            'spool_fname': job['spool_fname'],
+        })
+        self.timers.add('spool', time.time() - start)
+        self._changed()
+
+    def _spool(self, job):
+        """
+        set up the job for its new status, replacing its pid.wait or pid.run
+        file if it needs one
+        """
+        old_fname = job['spool_fname']
+        job.spool(write=self._write_spool_file(job))
 
-                    self._unreserve_job_and_decrement_user(job)
+        if old_fname is not None and old_fname != job['spool_fname']:
+            self.committer.remove(old_fname)
+        if job['spool_fname'] is not None:
+            self.committer.write(job['spool_fname'], yaml.dump(dict(job)))
 
-                elif job['status'] != 'run':
-                    if not job.match_users(self.users):
-                        # blame yourself
-                        job['reason'] = 'user limits exceeded'
-                    else:
-                        # see if we can now run the job.  After all blocked
-                        # jobs have been scheduled (or not) we updaate the list
-                        # of blocked groups (it can't change later)
-                        if priority != 'block' and not have_blocked_groups:
-                            blocked_groups = self._blocked_groups()
-                            have_blocked_groups = True
+    def _write_spool_file(self, job):
+        """
+        clients asking for a push don't need the pid.wait or pid.run file
+        """
+        return self.compat_spool or not job.get('push', False)
 
-                        job.match(self.cluster, blocked_groups)
+    def _drop_job(self, job):
+        """
+        remove a job from the queue, freeing its cores.  When the last
+        element of an array that has started all its elements goes, the
+        array goes too
+        """
+        if self.queue.get(job['pid']) is not job:
+            # already gone, e.g. along with its array
+            return
 
-                        if job['status'] == 'ready':
-                            self.cluster.reserve(job['hosts'])
-                            # this will remove any pid.wait file and write a
-                            # pid.run file sets status to 'run'
-                            job.spool()
+        self._unreserve_job_and_decrement_user(job)
+        self._remove_job(job)
 
-                            # keep statistics for each user
-                            self.users.increment_user_running(job)
+        if 'array' in job:
+            array = self.queue.get(job['array'])
+            if (array is not None
+                    and array['status'] == 'run'
+                    and not self._get_elements(array)):
+                self._drop_job(array)
 
-        # rebuild the queue without these items
-        if len(pids_to_del) > 0:
-            self.queue = [j for j in self.queue if j['pid'] not in pids_to_del]
+    def _get_element_hosts(self, array):
+        """
+        get the id, index and hosts of the running elements of the array
+        """
+        return [
+            {'pid': job['pid'], 'index': job['index'], 'hosts': job['hosts']}
+            for job in self._get_elements(array)
+        ]
 
     def _unreserve_job_and_decrement_user(self, job):
-        # try both wait and run.  This can be important after a server restart
-        # when a job may have disappeared while it was down
-        for status in ['run', 'wait']:
-            fname = job.get_spool_fname(status=status)
-            if os.path.exists(fname):
-                os.remove(fname)
-
         # decrement total job count
         self.users.decrement_user_jobcount(job)
+        if job['priority'] == 'block' and job['status'] == 'wait':
+            # groups may no longer be blocked
+            self._mark_all()
+
         if job['status'] == 'run':
+            # cores are freed
+            self._mark_all()
 
             # if running, decrement count of running and cores
             self.users.decrement_user_running(job)
@@ -1152,43 +3811,114 @@ class JobQueue(object):
         command = message['command']
         date = str(datetime.datetime.now())
         self.logger.debug("%s got command: '%s'" % (date, command))
+        start = time.time()
 
         if command == 'sub':
             self._process_submit_request(message)
+        elif command == 'sub_many':
+            self._process_submit_many_request(message)
         elif command in ('get_hosts', 'gethosts'):
             self._process_get_hosts(message)
-        elif command == 'ls':
-            self._process_listing_request(message)
-        elif command == 'lsfull':
-            self._process_full_listing_request(message)
-        elif command == 'stat':
-            self._process_status_request(message)
-        elif command == 'users':
-            self._process_userlist_request()
-        elif command == 'user':
-            self._process_user_request(message)
+        elif command == 'subscribe':
+            self._process_subscribe_request(message)
         elif command == 'limit':
             self._process_limit_request(message)
         elif command == 'rm':
             self._process_remove_request(message)
         elif command == 'notify':
             self._process_notification(message)
+        elif command == 'notify_many':
+            self._process_notify_many(message)
+        elif command == 'attach':
+            self._process_attach_request(message)
         elif command == 'refresh':
             self.refresh()
             self.response['response'] = 'OK'
         elif command == 'node':
             self._process_node_request(message)
+        elif command == 'metrics':
+            self.response['response'] = self.render_metrics()
+        elif command == 'profile':
+            self._process_profile_request(message)
         else:
             errmess = (
                 "got command '%s'"
-                "only support 'sub','get_hosts', "
-                "'ls', 'lsfull', 'stat', 'users', 'rm', 'notify', 'node', "
-                "'refresh' commands"
+                "only support 'sub', 'sub_many', 'get_hosts', "
+                "'ls', 'lsfull', 'stat', 'subscribe', 'users', 'rm', "
+                "'notify', 'notify_many', 'attach', 'node', 'refresh', "
+                "'metrics', 'profile' commands"
             )
             errmess = errmess % command
 
             self.response['error'] = errmess
 
+        self.count_request(get_command_label(message), time.time() - start)
+
+    def count_request(self, command, seconds):
+        """
+        count a request for the command in the metrics, with the time taken
+        """
+        self.metrics.requests.inc([command])
+        self.metrics.request_seconds.observe(seconds, [command])
+
+    def render_metrics(self):
+        """
+        get the metrics in the Prometheus text format; see wq.metrics
+        """
+        metrics = self.metrics
+
+        metrics.jobs.clear()
+        for (priority, status), njobs in self.queue.count_by_key().items():
+            metrics.jobs.set(njobs, [status, priority])
+
+        metrics.cores.clear()
+        for group, counts in self.cluster.count_cores().items():
+            for state, ncores in counts.items():
+                metrics.cores.set(ncores, [group, state])
+
+        return metrics.render()
+
+    def _process_profile_request(self, message):
+        """
+        start or stop profiling the server, or dump the statistics and the
+        timers to the spool directory; see wq.profiling.  Like the other
+        admin commands, such as limit and node, anyone who can reach the
+        server can do this
+        """
+        action = message.get('action', None)
+        profiler = self.profiler
+        if action == 'start':
+            if profiler.running:
+                self.response['error'] = 'the profiler is already running'
+                return
+            profiler.start()
+            self.logger.info('started profiling')
+            self.response['response'] = 'OK'
+        elif action == 'stop':
+            if not profiler.running:
+                self.response['error'] = 'the profiler is not running'
+                return
+            profiler.stop()
+            self.logger.info('stopped profiling')
+            self.response['response'] = 'OK'
+        elif action == 'dump':
+            try:
+                fnames = profiler.dump(timers=self.timers)
+            except OSError as err:
+                self.response['error'] = (
+                    'could not write the profile: %s' % str(err)
+                )
+                return
+            self.logger.info('wrote %s' % ', '.join(fnames))
+            self.response['response'] = 'OK'
+            self.response['files'] = fnames
+            self.response['timers'] = self.timers.render()
+        else:
+            self.response['error'] = (
+                "profile action should be 'start', 'stop' or 'dump', "
+                "got '%s'" % action
+            )
+
     def _process_node_request(self, message):
 
         nodename = message['node']
@@ -1206,52 +3936,44 @@ class JobQueue(object):
             self.response['error'] = "Don't understand this status"
             return None
 
-        found = False
-
-        for inode in self.cluster.nodes.keys():
-            if inode == nodename:
-                self.cluster.nodes[inode].set_online(setstat)
-                found = True
-                self.response['response'] = 'OK'
-                break
-
-        if not found:
+        if nodename in self.cluster.nodes:
+            self.cluster.set_online(nodename, setstat)
+            self.backend.save_node(nodename, setstat)
+            self._changed()
+            self.events.append({
+                'event': 'node',
+                'host': nodename,
+                'online': setstat,
+            })
+            if setstat:
+                self._mark_all()
+            self.response['response'] = 'OK'
+        else:
             self.response['error'] = ("Host not found.")
 
         return None
 
     def _blocking_job(self):
-        for job in self.queue:
-            if job['priority'] == 'block' and job['status'] == 'wait':
-                return job['pid']
+        for job in self.queue.get_jobs(priority='block', status='wait'):
+            return job['pid']
         return None
 
-    def _blocked_groups(self):
-        bg = []
-        block_all = False
-        for job in self.queue:
-            reqs = job['require']
-            if job['priority'] == 'block' and job['status'] == 'wait':
-
-                req_groups = job._get_req_list(reqs, 'group')
-                if len(req_groups) == 0:
-                    # didn't specify group, we need to block all
-                    block_all = True
-                    break
-                else:
-                    for group in req_groups:
-                        if group not in bg:
-                            bg.append(group)
-        if block_all:
-            for n in self.cluster.nodes.keys():
-                # Enough to take
-                cg = self.cluster.nodes[n].get_groups()
-                if len(cg) > 0:
-                    # Enough to add just the first group, this will block it
-                    if cg[0] not in bg:
-                        bg.append(cg[0])
-
-        return bg
+    def _blocked_mask(self):
+        """
+        get the mask of groups blocked by waiting block jobs.  The blocked
+        groups are counted by the queue as jobs come and go, so this only
+        does work when they have changed
+        """
+        gen, mask = self._blocked_mask_cache
+        if gen != self.queue.block_gen:
+            groups, block_all = self.queue.get_blocked()
+            if block_all:
+                mask = self.cluster.all_groups_mask
+            else:
+                mask = self.cluster.group_mask(groups)
+            self._blocked_mask_cache = (self.queue.block_gen, mask)
+
+        return mask
 
     def _process_submit_request(self, message):
         pid = message.get('pid')
@@ -1259,6 +3981,9 @@ class JobQueue(object):
             err = "submit requests must contain the 'pid' field"
             self.response['error'] = err
             return
+        if not _is_pid(pid):
+            self.response['error'] = 'pid must be an integer'
+            return
 
         req = message.get('require', None)
         if req is None:
@@ -1272,49 +3997,206 @@ class JobQueue(object):
             **message
         )
 
-        # no side effects on cluster inside here
-        newjob.match(self.cluster, self._blocked_groups())
+        self._admit_job(newjob)
 
         if newjob['status'] == 'nevermatch':
             self.response['error'] = newjob['reason']
         else:
+            self.response['response'] = newjob['status']
+            if newjob['spool_fname'] is not None:
+                self.response['spool_fname'] = (
+                    newjob.get_spool_fname(status='run')
+                )
+
+            self.response['spool_wait'] = newjob['spool_wait']
+
+            if self.response['response'] == 'run':
+                self.response['hosts'] = newjob['hosts']
+            elif self.response['response'] == 'wait':
+                self.response['reason'] = newjob['reason']
+
+    def _process_submit_many_request(self, message):
+        """
+        submit many jobs in one request.  The jobs are run by the owner,
+        the process with pid 'owner', and are given ids by the server; they
+        are removed when the owner exits.
+
+        The response holds a list with an entry for each job, in the order
+        sent, with the id as 'pid', the 'status', and the 'hosts' if the job
+        can run right away or the 'reason' if it can't.  Jobs that could
+        never run have status 'nevermatch' and are not added to the queue.
+
+        A job with array_start and array_stop is an array; see ArrayJob.
+        Its entry also has the 'elements' that could run right away, each
+        with its 'pid', 'index' and 'hosts'.
+        """
+        owner = message.get('owner')
+        if owner is None:
+            err = "sub_many requests must contain the 'owner' field"
+            self.response['error'] = err
+            return
+        if not _is_pid(owner):
+            self.response['error'] = 'owner must be an integer'
+            return
+
+        jobs = message.get('jobs')
+        if not isinstance(jobs, list):
+            err = "sub_many requests must contain a list of 'jobs'"
+            self.response['error'] = err
+            return
 
-            self.users.increment_user_jobcount(newjob)
+        common = {
+            key: val for key, val in message.items()
+            if key not in ('command', 'jobs')
+        }
 
-            if not newjob.match_users(self.users):
-                # the user limits would be exceeded (or something) if we run
-                # this job
-                newjob['status'] = 'wait'
-                newjob['reason'] = 'user limits exceeded'
-            elif newjob['status'] == 'ready':
+        # jobs with the same requirements that failed to match; nothing is
+        # freed while we go, so they would fail again
+        failed = {}
 
-                # only by reaching here to we reserve the hosts and
-                # update user info
-                self.cluster.reserve(newjob['hosts'])
+        results = []
+        for jobdata in jobs:
+            config = dict(common)
+            if isinstance(jobdata, dict):
+                config.update(jobdata)
+            config['pid'] = self._next_id
 
-                # keep statistics for each user
-                # increment count of running jobs and cores used
-                self.users.increment_user_running(newjob)
+            newjob = get_job_class(config)(spool_dir=self.spool_dir, **config)
+            if isinstance(newjob, ArrayJob) and 'array_next' in newjob:
+                self._next_id = newjob.get_element_id(newjob['array_stop'])
+            self._next_id += 1
 
-            # this will create a pid.wait or pid.run depending on status if
-            # status='ready', sets status to 'run' once the pid file is written
-            newjob.spool()
+            self._admit_job(newjob, failed=failed)
 
-            # if the status is 'run', the job will immediately
-            # run. Otherwise it will wait and can't run till
-            # we do a refresh
-            self.queue.append(newjob)
-            self.response['response'] = newjob['status']
-            self.response['spool_fname'] = (
-                newjob['spool_fname'].replace('wait', 'run')
+            jres = {'pid': newjob['pid'], 'status': newjob['status']}
+            if newjob['status'] == 'run':
+                jres['hosts'] = newjob['hosts']
+            else:
+                jres['reason'] = newjob['reason']
+
+            if isinstance(newjob, ArrayJob):
+                jres['elements'] = self._get_element_hosts(newjob)
+            results.append(jres)
+
+        if jobs:
+            self.backend.save_next_id(self._next_id)
+            self._autocommit()
+
+        self.response['response'] = 'OK'
+        self.response['jobs'] = results
+        self.response['spool_wait'] = WAIT_SLEEP
+
+    def _admit_job(self, newjob, failed=None):
+        """
+        add a new job to the queue, running it right away if it can run.
+        Jobs that could never run are not added, and keep the status
+        'nevermatch'
+
+        Parameters
+        ----------
+        newjob: Job
+            The new job
+        failed: dict, optional
+            The outcome of failed matches, keyed by the requirements and
+            blocked groups, for use over a series of submissions during
+            which no resources are freed
+        """
+        blocked_mask = self._blocked_mask()
+
+        key = None
+        if failed is not None and newjob['status'] != 'nevermatch':
+            key = (
+                newjob['priority'] == 'block', blocked_mask,
+                newjob.get_match_key(),
             )
 
-            self.response['spool_wait'] = newjob['spool_wait']
+        if key is not None and key in failed:
+            newjob['status'], newjob['reason'] = failed[key]
+        else:
+            # no side effects on cluster inside here
+            self._match(newjob, blocked_mask)
+            if key is not None and newjob['status'] != 'ready':
+                failed[key] = (newjob['status'], newjob['reason'])
 
-            if self.response['response'] == 'run':
-                self.response['hosts'] = newjob['hosts']
-            elif self.response['response'] == 'wait':
-                self.response['reason'] = newjob['reason']
+        if newjob['status'] == 'nevermatch':
+            return
+
+        self.users.increment_user_jobcount(newjob)
+
+        if not newjob.match_users(self.users):
+            # the user limits would be exceeded (or something) if we run
+            # this job
+            newjob['status'] = 'wait'
+            newjob['reason'] = 'user limits exceeded'
+        elif isinstance(newjob, ArrayJob):
+            # the array itself waits; its elements run
+            ready = newjob['status'] == 'ready'
+            newjob['status'] = 'wait'
+            self._spool_submit(newjob)
+            self._add_job(newjob)
+            if ready:
+                newjob['status'] = 'ready'
+                self._run_elements(newjob, blocked_mask)
+            return
+        elif newjob['status'] == 'ready':
+
+            # only by reaching here to we reserve the hosts and
+            # update user info
+            self.cluster.reserve(newjob['hosts'])
+
+            # keep statistics for each user
+            # increment count of running jobs and cores used
+            self.users.increment_user_running(newjob)
+
+        # sets status to 'run' if status='ready' and records the job,
+        # creating a pid.wait or pid.run file if needed
+        self._spool_submit(newjob)
+
+        # if the status is 'run', the job will immediately
+        # run. Otherwise it will wait and can't run till
+        # we do a refresh
+        self._add_job(newjob)
+        if newjob['status'] == 'run':
+            self._emit_run(newjob)
+
+    def _run_elements(self, array, blocked_mask):
+        """
+        run elements of the array, which has just matched, for as long as
+        there are elements waiting and they can run
+        """
+        while array['status'] == 'ready':
+            element = array.make_element()
+
+            # the element was counted in the user's total as one waiting
+            # in the array, so the total stays the same
+            self.cluster.reserve(element['hosts'])
+            self.users.increment_user_running(element)
+
+            # sets status to 'run' and records the element
+            self._spool_submit(element)
+            self._add_job(element)
+            self._emit_run(element)
+
+            if array.nwaiting == 0:
+                array['status'] = 'run'
+                array['hosts'] = []
+                array['reason'] = ''
+            elif self.cluster.is_full():
+                array['status'] = 'wait'
+                array['reason'] = 'Not enough free cores.'
+            elif not array.match_users(self.users):
+                array['status'] = 'wait'
+                array['reason'] = 'user limits exceeded'
+            else:
+                array['status'] = 'wait'
+                self._match(array, blocked_mask)
+
+        self.backend.update_job(array, {
+            'status': array['status'],
+            'array_next': array['array_next'],
+        })
+        self.queue.reindex(array)
+        self._changed()
 
     def _process_get_hosts(self, message):
         pid = message.get('pid', None)
@@ -1324,73 +4206,82 @@ class JobQueue(object):
             )
             return
 
-        for job in self.queue:
-            if job['pid'] == pid:
+        if not _is_pid(pid):
+            self.response['error'] = 'pid must be an integer'
+            return
+
+        job = self.queue.get(pid)
+        if job is not None:
+            if job['status'] == 'run':
                 self.response['hosts'] = job['hosts']
                 self.response['response'] = 'OK'
-                return
+            else:
+                self.response['response'] = job['status']
+                self.response['reason'] = job['reason']
+
+            if isinstance(job, ArrayJob):
+                self.response['elements'] = self._get_element_hosts(job)
+            return
 
         self.response['error'] = "we don't have this pid"
         return
 
-    def _process_listing_request(self, message):
+    def _process_subscribe_request(self, message):
         """
-        'user'
-        'pid'
-        'priority'
-        'time_sub'
-        'time_run'
-        'status'
-        'hosts'
+        the client will be sent changes to the queue and cluster as they
+        happen; see Server._push_updates.  The reply is the current state
+        to which the changes apply
 
-        These we can maybe not send if we extract job_name
-            or beginning of command
-            'require'
-            'commandline'
+        The 'topics' are a list of 'jobs', for the job listing as from ls
+        selected in the same way, and 'status', for the cluster status as
+        from stat
         """
-        listing = []
-        for job in self.queue:
-            r = {}
-            r['user'] = job['user']
-            r['pid'] = job['pid']
-            r['priority'] = job['priority']
-            r['time_sub'] = job['time_sub']
-            r['time_run'] = job['time_run']
-            r['status'] = job['status']
-            if r['status'] == 'run':
-                r['hosts'] = job['hosts']
-            else:
-                # should we do this?
-                r['hosts'] = []
+        topics = message.get('topics', ['jobs'])
+        if (not isinstance(topics, list)
+                or not topics
+                or not all(topic in SUBSCRIBE_TOPICS for topic in topics)):
+            self.response['error'] = (
+                'topics must be a list of %s' % ', '.join(SUBSCRIBE_TOPICS)
+            )
+            return
 
-            if 'reason' in job:
-                r['reason'] = job['reason']
-            if 'job_name' in job['require']:
-                r['job_name'] = job['require']['job_name']
-            else:
-                r['job_name'] = job['commandline'].split()[0]
-            listing.append(r)
+        response = {}
+        if 'jobs' in topics:
+            self._process_listing_request(message)
+            if 'error' in self.response:
+                return
+            response['jobs'] = self.response['response']
 
-        self.response['response'] = listing
+        if 'status' in topics:
+            response['status'] = self.cluster.status()
 
-    def _process_full_listing_request(self, message):
+        self.response['response'] = response
+
+    def get_listing_entries(self, pids):
         """
-        Send everything
+        get the listing entries of the jobs with the given pids, as sent by
+        ls, for telling subscribers about changes
+
+        Returns
+        -------
+        entries: dict
+            Keyed by pid; None for jobs no longer in the queue.  An element
+            of an array is given as the entry of its array
         """
-        listing = []
-        for job in self.queue:
-            listing.append(job.asdict())
-
-        self.response['response'] = listing
-
-    def _process_userlist_request(self):
-        self.response['response'] = self.users.asdict()
+        entries = {}
+        for pid in pids:
+            job = self.queue.get(pid)
+            if job is not None and 'array' in job:
+                pid = job['array']
+                job = self.queue.get(pid)
+
+            if pid not in entries:
+                if job is None:
+                    entries[pid] = None
+                else:
+                    entries[pid] = self._get_listing_entry(job)
 
-    def _process_user_request(self, message):
-        ud = self.users.asdict()
-        self.response['response'] = {
-            user: ud[user] for user in ud if user == message['user']
-        }
+        return entries
 
     def _process_limit_request(self, message):
         """
@@ -1422,12 +4313,10 @@ class JobQueue(object):
             for key, val in limits.items():
                 udata['limits'][key] = val
 
+        self._mark_user(user)
         self.save_users()
         self.response['response'] = 'OK'
 
-    def _process_status_request(self, message):
-        self.response['response'] = self.cluster.status()
-
     def _process_remove_request(self, message):
         self.refresh()
 
@@ -1446,34 +4335,62 @@ class JobQueue(object):
 
         if pid == 'all':
             self._process_remove_all_request(user)
+        elif not _is_pid(pid):
+            self.response['error'] = "pid must be an integer or 'all'"
         else:
-            found = False
-            for job in self.queue:
-                if job['pid'] == pid:
-                    # we don't actually remove anything, refresh will do it.
-                    if job['user'] != user and user != 'root':
-                        self.response['error'] = (
-                            'PID belongs to user '+job['user']
-                        )
-                        return
-
-                    self.response['response'] = 'OK'
-                    self.response['pids_to_kill'] = [pid]
-                    found = True
-                    break
-            if not found:
+            job = self.queue.get(pid)
+            if job is None:
                 self.response['error'] = 'pid %s not found' % pid
+                return
+
+            # we don't actually remove anything, refresh will do it.
+            if job['user'] != user and user != 'root':
+                self.response['error'] = (
+                    'PID belongs to user '+job['user']
+                )
+                return
+
+            self.response['response'] = 'OK'
+            if 'owner' in job:
+                self._remove_owned(job)
+                self.response['pids_to_kill'] = []
+            else:
+                self.response['pids_to_kill'] = [pid]
 
     def _process_remove_all_request(self, user):
         pids_to_kill = []
-        for job in self.queue:
-            if job['user'] == user:
+        for job in self.queue.get_user_jobs([user]):
+            if 'owner' in job:
+                self._remove_owned(job)
+            else:
                 pids_to_kill.append(job['pid'])
-                # we rely on the refresh to do this
-                # self._unreserve_job_and_decrement_user(job)
+            # we rely on the refresh to do this
+            # self._unreserve_job_and_decrement_user(job)
         self.response['response'] = 'OK'
         self.response['pids_to_kill'] = pids_to_kill
 
+    def _remove_owned(self, job):
+        """
+        remove a job submitted with sub_many.  There is no process of its
+        own for the client to kill, so we remove it here and ask the owner
+        to kill it.  Removing an array removes its running elements
+        """
+        if self.queue.get(job['pid']) is not job:
+            # already gone, e.g. along with its array
+            return
+
+        if isinstance(job, ArrayJob):
+            for element in self._get_elements(job):
+                self._remove_owned(element)
+
+        self._drop_job(job)
+        self.events.append({
+            'event': 'kill',
+            'pid': job['pid'],
+            'owner': job['owner'],
+        })
+        self.schedule()
+
     def _process_notification(self, message):
         notifi = message.get('notification', None)
         if notifi is None:
@@ -1489,6 +4406,9 @@ class JobQueue(object):
                     "remove requests must contain the 'pid' field"
                 )
                 return
+            if not _is_pid(pid):
+                self.response['error'] = 'pid must be an integer'
+                return
             self._remove_from_notify(pid)
             self.refresh()
         elif notifi == 'refresh':
@@ -1499,29 +4419,79 @@ class JobQueue(object):
             )
             return
 
-    def _remove_from_notify(self, pid):
+    def _process_notify_many(self, message):
         """
-        this is when the user has notified us the job is done.  we don't
-        send a kill message back
+        the jobs with the given pids are done.  They are all removed before
+        the scheduler runs once for the lot.  Any we don't have are listed
+        in 'unknown'
         """
-        found = False
-        for i, job in enumerate(self.queue):
-            if job['pid'] == pid:
+        if message.get('notification', 'done') != 'done':
+            self.response['error'] = (
+                "Only support 'done' notifications for notify_many"
+            )
+            return
 
-                self._unreserve_job_and_decrement_user(job)
+        pids = message.get('pids')
+        if not isinstance(pids, list) or not all(map(_is_pid, pids)):
+            self.response['error'] = (
+                "notify_many requests must contain a list of integer 'pids'"
+            )
+            return
 
-                del self.queue[i]
-                self.response['response'] = 'OK'
-                found = True
-                break
+        unknown = []
+        for pid in pids:
+            job = self.queue.get(pid)
+            if job is None:
+                unknown.append(pid)
+            else:
+                self._drop_job(job)
+
+        self.schedule()
+        self.response['response'] = 'OK'
+        self.response['unknown'] = unknown
+
+    def _process_attach_request(self, message):
+        """
+        a client that submitted jobs with sub_many, and lost its connection,
+        is back.  The response lists all jobs of the owner, each with the
+        'pid', 'status' and the 'hosts' if running or the 'reason' if not.
+        Elements of arrays also have the 'array' and 'index'.
+        """
+        owner = message.get('owner')
+        if owner is None:
+            self.response['error'] = (
+                "attach requests must contain the 'owner' field"
+            )
+            return
+        if not _is_pid(owner):
+            self.response['error'] = 'owner must be an integer'
+            return
+
+        results = []
+        for job in self.queue.get_proc_jobs(owner):
+            jres = {'pid': job['pid'], 'status': job['status']}
+            if job['status'] == 'run':
+                jres['hosts'] = job['hosts']
+            else:
+                jres['reason'] = job['reason']
 
-        if not found:
+            if 'array' in job:
+                jres['array'] = job['array']
+                jres['index'] = job['index']
+            results.append(jres)
+
+        self.response['response'] = 'OK'
+        self.response['jobs'] = results
+
+    def _remove_from_notify(self, pid):
+        """
+        this is when the user has notified us the job is done.  we don't
+        send a kill message back
+        """
+        job = self.queue.get(pid)
+        if job is None:
             self.response['error'] = 'pid %s not found' % pid
+            return
 
-    def _pid_exists(self, pid):
-        """ Check For the existence of a unix pid. """
-        pid_path = "/proc/%s" % pid
-        if os.path.exists(pid_path):
-            return True
-        else:
-            return False
+        self._drop_job(job)
+        self.response['response'] = 'OK'
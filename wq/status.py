@@ -1,5 +1,5 @@
 from optparse import OptionParser
-from .util import send_message
+from .util import send_message, subscribe, clear_screen
 from .defaults import DEFAULT_PORT
 
 
@@ -8,14 +8,25 @@ class Status(dict):
     usage: wq stat
 
     print the status of the queue and compute cluster
+
+    With -w/--watch the status is shown and kept up to date until
+    interrupted.  The server sends only the changes, so this is much
+    cheaper than running wq stat repeatedly.
     """
 
     def __init__(self, port, args):
         self.port = port
         parser = OptionParser(Status.__doc__)
+        parser.add_option("-w", "--watch", action='store_true',
+                          help="Keep the status up to date")
         options, args = parser.parse_args(args)
+        self.watch = options.watch
 
     def execute(self):
+        if self.watch:
+            watch_status(port=self.port)
+            return
+
         status = get_status(port=self.port)
         print_status(status)
 
@@ -42,6 +53,45 @@ def get_status(port=DEFAULT_PORT):
     return status
 
 
+def watch_status(port=DEFAULT_PORT, stream=None):
+    """
+    print the status every WATCH_INTERVAL seconds until interrupted.  The
+    status is kept up to date from the changes sent by the server; see the
+    subscribe command
+    """
+    import sys
+
+    if stream is None:
+        stream = sys.stdout
+
+    status = None
+    index = {}
+    try:
+        for updates in subscribe(port, {'topics': ['status']}):
+            if isinstance(updates, dict):
+                # the current state
+                status = updates['status']
+                index = {
+                    d['hostname']: i for i, d in enumerate(status['nodes'])
+                }
+                updates = []
+
+            for update in updates:
+                if 'status' not in update:
+                    continue
+
+                status['used'] = update['status']['used']
+                for d in update['status']['nodes']:
+                    status['nodes'][index[d['hostname']]] = d
+
+            clear_screen(stream)
+            stream.write('\n'.join(get_status_lines(status)) + '\n')
+            stream.flush()
+    except EOFError:
+        print('lost connection to the server', file=sys.stderr)
+        sys.exit(1)
+
+
 def get_status_lines(status):
     """
     input status is the result of cluster.status
@@ -1,16 +1,116 @@
 import sys
 from sys import stderr
+import time
 import socket
-import yaml
-from yaml import YAMLError
-from .defaults import HOST, BUFFSIZE
+import select
+from .defaults import HOST, BUFFSIZE, NOT_MODIFIED
+from .protocol import (
+    ProtocolError,
+    MAGIC,
+    ENC_JSON,
+    get_default_encoding,
+    get_legacy_frame,
+    is_framed,
+    pack_frame,
+    read_message,
+    split_message,
+)
+
+# read this much at a time on persistent connections
+RECV_SIZE = 65536
+
+# seconds between updates when watching the queue
+WATCH_INTERVAL = 1.0
+
+# commands that can be sent again if the connection is lost while waiting
+# for the reply, since running them twice does no harm.  Others, such as
+# sub or rm, may already have been run by the server
+RETRY_COMMANDS = (
+    'ls', 'lsfull', 'stat', 'users', 'user', 'metrics', 'get_hosts',
+    'gethosts', 'refresh',
+)
+
+
+class EncodingRejected(EOFError):
+    """
+    Raised when the server did not support the encoding of a request.  The
+    server did not run it, so it can be sent again in another encoding
+    """
+    pass
+
+
+# ports where we found an old server that only speaks YAML, or a server
+# that does not support our preferred encoding
+_port_encodings = {}
+
+
+def _can_resend(message):
+    return (
+        isinstance(message, dict)
+        and message.get('command') in RETRY_COMMANDS
+    )
 
 
 def send_message(port, message, timeout=None, crash_on_timeout=False):
+    """
+    Send a message to the server and return the reply
+
+    The framed protocol is used, falling back to plain YAML if the server
+    turns out to be an older version.
+    """
 
     if len(message) == 0:
         raise ValueError("message must have len > 0")
 
+    encoding = _port_encodings.get(port, get_default_encoding())
+
+    rdict, frame = _send_and_receive(
+        port, message, encoding,
+        timeout=timeout, crash_on_timeout=crash_on_timeout,
+    )
+
+    if frame is not None and encoding is not None and frame['legacy']:
+        # the server did not understand the frame, it is an old server
+        _port_encodings[port] = None
+        rdict, frame = _send_and_receive(
+            port, message, None,
+            timeout=timeout, crash_on_timeout=crash_on_timeout,
+        )
+    elif (isinstance(rdict, dict) and 'encodings' in rdict
+            and encoding != ENC_JSON):
+        # the server does not support our encoding, json always works
+        _port_encodings[port] = ENC_JSON
+        rdict, frame = _send_and_receive(
+            port, message, ENC_JSON,
+            timeout=timeout, crash_on_timeout=crash_on_timeout,
+        )
+
+    return check_response(rdict)
+
+
+def check_response(rdict):
+    """
+    check a reply from the server, raising RuntimeError if an
+    error was reported
+    """
+    if rdict is None:
+        sys.exit(1)
+
+    if 'error' in rdict:
+        raise RuntimeError("Error reported by server: %s" % rdict['error'])
+
+    if 'response' not in rdict:
+        raise RuntimeError("Internal error. Expected a response "
+                           "and got screwed.")
+
+    return rdict
+
+
+def _send_and_receive(port, message, encoding,
+                      timeout=None, crash_on_timeout=False):
+    """
+    send a message using the given encoding, None meaning legacy YAML
+    """
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     # make sure to set timeout *before* calling connect()
     if timeout is not None:
@@ -19,36 +119,378 @@ def send_message(port, message, timeout=None, crash_on_timeout=False):
     conninfo = (HOST, port)
     socket_connect(sock, conninfo, crash_on_timeout=crash_on_timeout)
 
-    rdict = None
     try:
-        jmess = yaml.dump(message)
+        if encoding is None:
+            import yaml
+            socket_send(sock, yaml.dump(message))
+        else:
+            sock.sendall(pack_frame(message, encoding=encoding))
 
-        socket_send(sock, jmess)
-        data = socket_receive(sock, BUFFSIZE)
+        try:
+            rdict, frame = read_message(sock, BUFFSIZE)
+        except ProtocolError as err:
+            print(str(err), file=stderr)
+            sys.exit(1)
 
+    finally:
         sock.close()
 
+    return rdict, frame
+
+
+class Connection(object):
+    """
+    A persistent connection to the server
+
+    Many requests can be sent over the one socket.  Each request is framed
+    with a tag that the server echoes in its reply, so requests can be
+    pipelined and replies matched up as they arrive.  Messages from the
+    server that were not asked for have tag 0 and are kept in the pushed
+    list.
+
+    If the server is an older version that only speaks YAML, each request
+    falls back to using a new connection.
+
+    Parameters
+    ----------
+    port: int
+        The port number
+    timeout: float, optional
+        Timeout for socket operations
+    crash_on_timeout: bool, optional
+        If True, raise an exception when the connect times out
+    """
+    def __init__(self, port, timeout=None, crash_on_timeout=False):
+        self.port = port
+        self.timeout = timeout
+        self.crash_on_timeout = crash_on_timeout
+
+        self.sock = None
+        self.legacy = _port_encodings.get(port, 0) is None
+        self.encoding = _port_encodings.get(port, get_default_encoding())
+
+        self._tag = 0
+        self._replies = {}
+        self._inbuf = bytearray()
+        self.pushed = []
+
+        # the last reply to each read, see read()
+        self._kept = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def connect(self):
+        """
+        open the socket if needed
+        """
+        if self.sock is not None:
+            return
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            sock.settimeout(self.timeout)
+
+        socket_connect(
+            sock, (HOST, self.port), crash_on_timeout=self.crash_on_timeout,
+        )
+        self.sock = sock
+
+    def close(self):
+        """
+        close the socket; it will be reopened by the next request
+        """
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self._replies.clear()
+        self._inbuf.clear()
+
+    def request(self, message, retry=True):
+        """
+        Send a message and wait for the reply
+
+        Parameters
+        ----------
+        message: dict
+            The message to send
+        retry: bool, optional
+            If the connection was lost, for example because the server was
+            restarted, reconnect and try once more.  Unless the command is
+            one of RETRY_COMMANDS, this is only done if the message could
+            not be sent.
+
+        Returns
+        -------
+        The reply from the server, after checking for errors
+        """
+        if self.legacy:
+            return send_message(
+                self.port, message,
+                timeout=self.timeout, crash_on_timeout=self.crash_on_timeout,
+            )
+
+        sent = False
         try:
-            rdict = yaml_load(data)
-        except YAMLError as err:
-            print(str(err), file=stderr)
-            print(data, file=stderr)
-            sys.exit(1)
+            tag = self.send(message)
+            sent = True
+            rdict = self.receive(tag)
+        except EncodingRejected:
+            # not run, so it is safe to send again in json
+            return self.request(message, retry=retry)
+        except (OSError, EOFError):
+            self.close()
+            if not retry or (sent and not _can_resend(message)):
+                raise
+            return self.request(message, retry=False)
 
-        if 'error' in rdict:
-            raise RuntimeError("Error reported by server: %s" % rdict['error'])
+        if rdict is None:
+            # server turned out to be an old version
+            return self.request(message)
 
-        if 'response' not in rdict:
-            raise RuntimeError("Internal error. Expected a response "
-                               "and got screwed.")
+        return check_response(rdict)
 
-    finally:
-        sock.close()
+    def read(self, message):
+        """
+        Send a read only request, such as ls or stat, and wait for the reply
 
-    if rdict is None:
-        sys.exit(1)
+        The last reply to each distinct request is kept, along with the
+        generation of the queue it was for.  When the request is repeated
+        that generation is sent, and if the queue has not changed since the
+        server only says so; the kept reply is then returned.
 
-    return rdict
+        Parameters
+        ----------
+        message: dict
+            The message to send
+
+        Returns
+        -------
+        The reply from the server, after checking for errors
+        """
+        key = repr(sorted(message.items()))
+        kept = self._kept.get(key)
+        if kept is not None:
+            message = dict(message, generation=kept['generation'])
+
+        rdict = self.request(message)
+        if kept is not None and rdict['response'] == NOT_MODIFIED:
+            return kept
+
+        if 'generation' in rdict:
+            # older servers don't send it
+            self._kept[key] = rdict
+
+        return rdict
+
+    def pipeline(self, messages):
+        """
+        Send all the messages before reading any of the replies
+
+        Returns
+        -------
+        The list of replies, in the same order as the messages.  The replies
+        are not checked for errors.
+        """
+        if self.legacy:
+            return [
+                _send_and_receive(self.port, message, None)[0]
+                for message in messages
+            ]
+
+        self.connect()
+        tags = []
+        data = []
+        for message in messages:
+            tag = self._next_tag()
+            tags.append(tag)
+            data.append(pack_frame(message, encoding=self.encoding, tag=tag))
+
+        self.sock.sendall(b''.join(data))
+
+        replies = []
+        for tag in tags:
+            try:
+                rdict = self.receive(tag)
+            except EncodingRejected:
+                # the server ran none of them
+                return self.pipeline(messages)
+            if rdict is None:
+                # server turned out to be an old version
+                return self.pipeline(messages)
+            replies.append(rdict)
+
+        return replies
+
+    def send(self, message):
+        """
+        send the message without waiting for the reply
+
+        Returns
+        -------
+        tag: int
+            The tag identifying the reply
+        """
+        self.connect()
+
+        tag = self._next_tag()
+        self.sock.sendall(pack_frame(message, encoding=self.encoding, tag=tag))
+        return tag
+
+    def receive(self, tag=None):
+        """
+        Receive the reply for the given tag.  If tag is None, receive the
+        next message from the server, whatever it is.
+
+        Returns None if the server turned out to be an older version that
+        does not support sessions.  Raises EncodingRejected if the server
+        does not support our encoding; we then use json
+        """
+        if tag is not None and tag in self._replies:
+            return self._replies.pop(tag)
+
+        while True:
+            rdict, frame = self._read_message()
+            if frame is None:
+                raise EOFError('connection closed by server')
+
+            if frame['legacy']:
+                self.legacy = True
+                _port_encodings[self.port] = None
+                self.close()
+                return None
+
+            if 'encodings' in rdict and self.encoding != ENC_JSON:
+                # the server does not support our encoding, the
+                # message will need to be resent
+                self.encoding = ENC_JSON
+                _port_encodings[self.port] = ENC_JSON
+                self.close()
+                raise EncodingRejected('server does not support encoding')
+
+            if tag is None or frame['tag'] == tag:
+                return rdict
+            elif frame['tag'] == 0:
+                self.pushed.append(rdict)
+            else:
+                self._replies[frame['tag']] = rdict
+
+    def receive_pushed(self, timeout=None):
+        """
+        Wait up to timeout seconds for messages pushed by the server.
+        Replies to requests that arrive meanwhile are kept for receive.
+
+        Returns
+        -------
+        The list of pushed messages, which may be empty
+
+        Raises EOFError if the connection was closed
+        """
+        if self.sock is None:
+            raise EOFError('not connected')
+
+        if not self.pushed and not self._split_buffered():
+            readable, _, _ = select.select([self.sock], [], [], timeout)
+            if readable:
+                data = self.sock.recv(RECV_SIZE)
+                if not data:
+                    raise EOFError('connection closed by server')
+                self._inbuf += data
+                self._split_buffered()
+
+        pushed = self.pushed
+        self.pushed = []
+        return pushed
+
+    def _split_buffered(self):
+        """
+        take the complete messages from the input buffer, keeping pushed
+        messages and replies.  Returns the number of messages found
+        """
+        nfound = 0
+        while len(self._inbuf) >= len(MAGIC) and is_framed(self._inbuf):
+            message, frame, nbytes = split_message(self._inbuf)
+            if frame is None:
+                break
+
+            del self._inbuf[:nbytes]
+            if frame['tag'] == 0:
+                self.pushed.append(message)
+            else:
+                self._replies[frame['tag']] = message
+            nfound += 1
+
+        return nfound
+
+    def _read_message(self):
+        """
+        read the next message from the server, keeping any extra data
+        for the next call
+        """
+        while True:
+            if len(self._inbuf) >= len(MAGIC):
+                if not is_framed(self._inbuf):
+                    # an old server replying in YAML
+                    return None, get_legacy_frame()
+
+                message, frame, nbytes = split_message(self._inbuf)
+                if frame is not None:
+                    del self._inbuf[:nbytes]
+                    return message, frame
+
+            data = self.sock.recv(RECV_SIZE)
+            if not data:
+                if self._inbuf:
+                    raise EOFError('connection closed inside a message')
+                return None, None
+
+            self._inbuf += data
+
+    def _next_tag(self):
+        # tag 0 is reserved for messages pushed by the server
+        self._tag = self._tag % 0xffffffff + 1
+        return self._tag
+
+
+def subscribe(port, message, interval=WATCH_INTERVAL):
+    """
+    subscribe to changes in the queue or cluster; see the server subscribe
+    command.  This is a generator, which first yields the current state sent
+    by the server, then every interval seconds the list of changes received
+    since, which may be empty
+
+    Raises EOFError if the connection to the server is lost
+    """
+    message = dict(message, command='subscribe')
+    with Connection(port) as conn:
+        yield conn.request(message, retry=False)['response']
+
+        while True:
+            updates = []
+            deadline = time.time() + interval
+            while True:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                updates += conn.receive_pushed(timeout=timeout)
+
+            yield updates
+
+
+def clear_screen(stream=None):
+    """
+    clear the terminal before showing an update, if writing to one
+    """
+    if stream is None:
+        stream = sys.stdout
+
+    if stream.isatty():
+        stream.write('\033[H\033[J')
+    else:
+        stream.write('\n')
 
 
 def socket_connect(sock, conninfo, crash_on_timeout=False):
@@ -98,7 +540,29 @@ def socket_receive(conn, buffsize):
 
 
 def yaml_load(obj):
-    return yaml.safe_load(obj)
+    # yaml is imported here, as it is slow to import and most commands
+    # never need it
+    import yaml
+
+    # the C loader is much faster for large documents
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    return yaml.load(obj, Loader=loader)
+
+
+def raise_file_limit():
+    """
+    allow as many open files as we can.  The server needs a descriptor for
+    each connected client and each process it watches, and the launcher
+    one for each running job
+    """
+    import resource
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
 
 
 def get_time_diff(dt):